@@ -0,0 +1,254 @@
+import os
+import shutil
+import asyncio
+from collections import deque
+from log import logger
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+
+class AssembleError(Exception):
+    """Custom exception for streaming assembly failures"""
+
+
+class DiskBudget:
+    """DiskBudget bounds the bytes of downloaded segments waiting in tmp directories to be assembled.
+
+    A download reserves the average size of the finished ones before it
+    starts and waits while the budget is spent; the bytes are given back
+    once its file was appended to the output and removed. The first
+    download reserves the whole budget, as nothing tells its size yet.
+    Downloads start in playlist order, so the segment the output waits for
+    is always in flight already: when nothing is in flight, the next one
+    may start even over budget, unless the output is stuck on a failed
+    segment, which no amount of waiting fixes: the download is then held
+    back until that segment is retried.
+    """
+
+    def __init__(self, max_size: int):
+        """Initialize disk budget
+
+        Args:
+            max_size (int): Bytes of segments kept on disk at most
+        """
+        self.max_size = max_size
+        self.used = 0
+        self.in_flight = 0
+        self.finished_files = 0
+        self.finished_bytes = 0
+        self.condition = asyncio.Condition()
+
+    def estimate(self) -> int:
+        """Bytes reserved for a download, the average size of the finished ones"""
+        if not self.finished_files:
+            return self.max_size
+        return self.finished_bytes // self.finished_files
+
+    async def acquire(self, stuck: Optional[Callable[[], bool]] = None) -> Optional[int]:
+        """Wait until a download fits in the budget and reserve space for it
+
+        Args:
+            stuck (Optional[Callable[[], bool]], optional): Tells whether the output of the video waits for a
+                failed segment. Defaults to None.
+
+        Returns:
+            Optional[int]: Bytes reserved, to be passed to done or failed, None if the budget is spent and the
+                output waits for a failed segment
+        """
+        async with self.condition:
+            while self.used and self.used + self.estimate() > self.max_size:
+                if not self.in_flight:
+                    if stuck is not None and stuck():
+                        return None
+                    break
+                await self.condition.wait()
+            reserved = self.estimate()
+            self.used += reserved
+            self.in_flight += 1
+            return reserved
+
+    async def done(self, reserved: int, size: int):
+        """Replace the reservation of a finished download by the size of its files"""
+        async with self.condition:
+            self.used += size - reserved
+            self.in_flight -= 1
+            self.finished_files += 1
+            self.finished_bytes += size
+            self.condition.notify_all()
+
+    async def failed(self, reserved: int):
+        """Give back the reservation of a failed download"""
+        async with self.condition:
+            self.used -= reserved
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def add(self, size: int):
+        """Count files that are on disk without a download, e.g. resumed or linked from the cache"""
+        async with self.condition:
+            self.used += size
+
+    async def release(self, size: int):
+        """Give back the bytes of files removed after they were assembled, or left to a failed video"""
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class SegmentAssembler:
+    """SegmentAssembler writes segments to the output in playlist order while they are downloading.
+
+    Segments may finish in any order, they wait in a reorder buffer keyed by
+    their index until every previous segment has been written. Outputs ending
+    with `.ts` are plain concatenations of the MPEG-TS segments, any other
+    output is remuxed by a single long-lived ffmpeg process reading stdin.
+    The output is written next to the segments and moved to `save_path` once
+    complete, so an interrupted run never leaves a truncated video behind.
+    """
+
+    def __init__(
+        self,
+        save_path: str,
+        tmp_path: str,
+        total: int,
+        remove_written: bool = False,
+        on_written: Optional[Callable[[int, str], Awaitable[None]]] = None,
+    ):
+        """Initialize segment assembler
+
+        Args:
+            save_path (str): Path of the final video
+            tmp_path (str): Directory of the segments, the output is written there until finished
+            total (int): Number of segments of the video, may grow until finish is called
+            remove_written (bool, optional): Delete every segment file once written. Defaults to False.
+            on_written (Optional[Callable[[int, str], Awaitable[None]]], optional): Awaited with the index and path
+                of every segment once written. Defaults to None.
+        """
+        self.save_path = save_path
+        self.total = total
+        self.remove_written = remove_written
+        self.on_written = on_written
+        self.mode = "concat" if save_path.endswith(".ts") else "ffmpeg"
+        self.part_path = os.path.join(tmp_path, "stream" + os.path.splitext(save_path)[1])
+        self.next_index = 0
+        self.pending: Dict[int, str] = dict()
+        self.lock = asyncio.Lock()
+        self.fp = None
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # the last lines ffmpeg wrote to stderr, read while streaming so the pipe never fills up
+        self.stderr_lines: Deque[str] = deque(maxlen=20)
+        self.stderr_task: Optional[asyncio.Future] = None
+
+    async def open(self):
+        """Open the output file or start ffmpeg"""
+        if self.mode == "concat":
+            self.fp = open(self.part_path, "wb")
+            return
+        self.process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-f",
+            "mpegts",
+            "-i",
+            "pipe:0",
+            "-c",
+            "copy",
+            self.part_path,
+            "-loglevel",
+            "error",
+            "-y",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self.stderr_task = asyncio.ensure_future(self._read_stderr())
+
+    async def _read_stderr(self):
+        async for line in self.process.stderr:
+            self.stderr_lines.append(line.decode(errors="replace").rstrip())
+
+    async def _ffmpeg_error(self, message: str) -> AssembleError:
+        """Wait for ffmpeg to exit and describe its failure with what it wrote to stderr"""
+        returncode = await self.process.wait()
+        await self.stderr_task
+        detail = "; ".join(line for line in self.stderr_lines if line)
+        return AssembleError(f"{message} (code {returncode}): {detail or 'no output'}")
+
+    async def add(self, index: int, path: Optional[str]):
+        """Add a downloaded segment, writing every segment that became contiguous
+
+        Args:
+            index (int): Index of the segment in the playlist
+            path (Optional[str]): Path of the downloaded segment, None to leave it out of the output
+        """
+        self.pending[index] = path
+        if self.lock.locked():
+            # the writer re-checks the buffer after every segment
+            return
+        async with self.lock:
+            while self.next_index in self.pending:
+                path = self.pending.pop(self.next_index)
+                if path is not None:
+                    await self._write(path)
+                    if self.remove_written:
+                        os.remove(path)
+                    if self.on_written is not None:
+                        await self.on_written(self.next_index, path)
+                self.next_index += 1
+
+    async def _write(self, path: str):
+        """Append one segment to the output"""
+        loop = asyncio.get_event_loop()
+        if self.mode == "concat":
+            await loop.run_in_executor(None, self._append_file, path)
+            return
+        data = await loop.run_in_executor(None, self._read_file, path)
+        try:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            raise await self._ffmpeg_error("ffmpeg exited while streaming")
+
+    def _append_file(self, path: str):
+        with open(path, "rb") as src:
+            shutil.copyfileobj(src, self.fp, 1024 * 1024)
+
+    def _read_file(self, path: str) -> bytes:
+        with open(path, "rb") as src:
+            return src.read()
+
+    async def finish(self) -> str:
+        """Close the output and move it to the save path
+
+        Returns:
+            str: Path to the assembled video
+
+        Raises:
+            AssembleError: if segments are missing or ffmpeg failed
+        """
+        if self.next_index != self.total:
+            await self.abort()
+            raise AssembleError(f"assembled {self.next_index} of {self.total} segments")
+        if self.mode == "concat":
+            self.fp.close()
+        else:
+            self.process.stdin.close()
+            returncode = await self.process.wait()
+            await self.stderr_task
+            if returncode != 0:
+                error = await self._ffmpeg_error("ffmpeg failed")
+                await self.abort()
+                raise error
+        shutil.move(self.part_path, self.save_path)
+        logger.info(f"finished download blob video! {self.save_path}")
+        return self.save_path
+
+    async def abort(self):
+        """Stop assembling and drop the partial output"""
+        if self.fp is not None:
+            self.fp.close()
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        if self.stderr_task is not None:
+            await self.stderr_task
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
@@ -0,0 +1,281 @@
+"""Local HLS server for benchmarks and load tests.
+
+Serves generated VOD playlists and MPEG-TS-looking segments for any video
+name, with injectable latency, stragglers, bandwidth caps, HTTP errors, disconnects,
+AES-128 encryption, EXT-X-BYTERANGE sub-ranges of a single media file and
+live sliding-window playlists.
+Request timings are kept in memory and served at /stats.
+
+    python benchmarks/hls_server.py --port 8000 --segments 500 --segment-kb 512 --latency-ms 20
+
+    http://127.0.0.1:8000/<video>/index.m3u8
+    http://127.0.0.1:8000/<video>/master.m3u8
+"""
+
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+from aiohttp import web
+
+TS_PACKET_SIZE = 188
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the server options to a parser, shared with the benchmark harness"""
+    parser.add_argument("--segments", type=int, default=100, help="segments per playlist")
+    parser.add_argument("--segment-kb", type=int, default=256, help="size of every segment")
+    parser.add_argument("--target-duration", type=float, default=4.0, help="EXTINF of every segment")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay before every response")
+    parser.add_argument("--bandwidth-kbps", type=float, default=0.0, help="per-connection cap in KiB/s, 0 is unlimited")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of segment requests answered with HTTP 503"
+    )
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After sent with HTTP 503, 0 for none")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of segment requests cut halfway")
+    parser.add_argument("--straggler-rate", type=float, default=0.0, help="share of segment requests answered late")
+    parser.add_argument("--straggler-ms", type=float, default=2000.0, help="extra delay of a straggler")
+    parser.add_argument("--encrypt", action="store_true", help="encrypt segments with AES-128")
+    parser.add_argument("--byterange", action="store_true", help="serve segments as byte ranges of media.ts")
+    parser.add_argument("--live", action="store_true", help="publish one segment every target duration")
+    parser.add_argument("--live-window", type=int, default=6, help="segments listed by a live playlist")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the injected failures")
+
+
+def server_argv(args: argparse.Namespace, port: int) -> list:
+    """Build the command line starting a server with the options of `args`"""
+    argv = [
+        sys.executable,
+        __file__,
+        "--port",
+        str(port),
+        "--segments",
+        str(args.segments),
+        "--segment-kb",
+        str(args.segment_kb),
+        "--target-duration",
+        str(args.target_duration),
+        "--latency-ms",
+        str(args.latency_ms),
+        "--bandwidth-kbps",
+        str(args.bandwidth_kbps),
+        "--error-rate",
+        str(args.error_rate),
+        "--retry-after",
+        str(args.retry_after),
+        "--disconnect-rate",
+        str(args.disconnect_rate),
+        "--straggler-rate",
+        str(args.straggler_rate),
+        "--straggler-ms",
+        str(args.straggler_ms),
+        "--seed",
+        str(args.seed),
+    ]
+    if args.encrypt:
+        argv.append("--encrypt")
+    if args.byterange:
+        argv.append("--byterange")
+    if args.live:
+        argv.extend(["--live", "--live-window", str(args.live_window)])
+    return argv
+
+
+def free_port() -> int:
+    """Find a free local TCP port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(args: argparse.Namespace) -> tuple:
+    """Start a server in a child process, so it does not count in the measured process
+
+    Returns:
+        tuple: server process and its base URL
+    """
+    port = free_port()
+    process = subprocess.Popen(server_argv(args, port))
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                break
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError(f"HLS server on port {port} did not start")
+            time.sleep(0.05)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def make_segment(index: int, size: int) -> bytes:
+    """Build a segment of 188-byte packets starting with the MPEG-TS sync byte"""
+    packet = bytes([0x47, (index >> 8) & 0xFF, index & 0xFF]) + bytes(TS_PACKET_SIZE - 3)
+    count = max(1, size // TS_PACKET_SIZE)
+    return packet * count
+
+
+class HLSServer:
+    """HLSServer answers playlist, key and segment requests of any video name"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.key = bytes(range(16))
+        self.segment_size = args.segment_kb * 1024
+        self.cache = dict()
+        self.started = time.monotonic()
+        # (path, seconds from request to last byte, bytes, status)
+        self.requests = []
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/{video}/index.m3u8", self.playlist)
+        app.router.add_get("/{video}/master.m3u8", self.master)
+        app.router.add_get("/{video}/key.bin", self.key_file)
+        app.router.add_get("/{video}/seg{index:\\d+}.ts", self.segment)
+        app.router.add_get("/{video}/media.ts", self.media)
+        return app
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests})
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        first, last = 0, self.args.segments
+        if self.args.live:
+            # a sliding window of the segments published since the server started
+            last = min(self.args.segments, 1 + int((time.monotonic() - self.started) / self.args.target_duration))
+            first = max(0, last - self.args.live_window)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(self.args.target_duration + 0.999)}",
+            f"#EXT-X-MEDIA-SEQUENCE:{first}",
+        ]
+        if self.args.encrypt:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="key.bin"')
+        # every segment has the same size, encrypted or not
+        size = len(self.segment_body(0))
+        for index in range(first, last):
+            lines.append(f"#EXTINF:{self.args.target_duration:.3f},")
+            if self.args.byterange:
+                lines.append(f"#EXT-X-BYTERANGE:{size}@{index * size}")
+                lines.append("media.ts")
+            else:
+                lines.append(f"seg{index}.ts")
+        if last == self.args.segments:
+            lines.append("#EXT-X-ENDLIST")
+        return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+
+    async def master(self, request: web.Request) -> web.Response:
+        """Master playlist of three variants, the highest one declares the real bitrate of the segments"""
+        bandwidth = int(self.segment_size * 8 / self.args.target_duration)
+        lines = ["#EXTM3U"]
+        for index, height in enumerate([360, 540, 720]):
+            resolution = f"{height * 16 // 9}x{height}"
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth * (index + 1) // 3},RESOLUTION={resolution}")
+            lines.append(f"../{request.match_info['video']}-{height}p/index.m3u8")
+        return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+
+    async def key_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.key, content_type="application/octet-stream")
+
+    def segment_body(self, index: int) -> bytes:
+        body = self.cache.get(index)
+        if body is None:
+            body = make_segment(index, self.segment_size)
+            if self.args.encrypt:
+                body = encrypt(body, self.key, index.to_bytes(16, "big"))
+            if len(self.cache) < 64:
+                self.cache[index] = body
+        return body
+
+    async def segment(self, request: web.Request) -> web.StreamResponse:
+        return await self.send(request, self.segment_body(int(request.match_info["index"])))
+
+    async def media(self, request: web.Request) -> web.StreamResponse:
+        """All the segments in one file, requested by byte ranges"""
+        body = self.cache.get("media")
+        if body is None:
+            body = self.cache["media"] = b"".join(self.segment_body(index) for index in range(self.args.segments))
+        return await self.send(request, body)
+
+    async def send(self, request: web.Request, body: bytes) -> web.StreamResponse:
+        start = time.monotonic()
+        if self.args.latency_ms:
+            await asyncio.sleep(self.args.latency_ms / 1000)
+        if self.random.random() < self.args.straggler_rate:
+            await asyncio.sleep(self.args.straggler_ms / 1000)
+        if self.random.random() < self.args.error_rate:
+            self.requests.append((request.path, time.monotonic() - start, 0, 503))
+            headers = {"Retry-After": str(self.args.retry_after)} if self.args.retry_after else None
+            return web.Response(status=503, headers=headers)
+
+        status, begin, end = 200, 0, len(body) - 1
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            begin = int(first)
+            end = min(int(last), end) if last else end
+            status = 206
+        response = web.StreamResponse(status=status)
+        response.content_length = end + 1 - begin
+        response.content_type = "video/mp2t"
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {begin}-{end}/{len(body)}"
+        await response.prepare(request)
+
+        data = memoryview(body)[begin : end + 1]
+        if self.random.random() < self.args.disconnect_rate:
+            await response.write(bytes(data[: len(data) // 2]))
+            request.transport.close()
+            self.requests.append((request.path, time.monotonic() - start, len(data) // 2, 0))
+            return response
+        await self.write_limited(response, data)
+        self.requests.append((request.path, time.monotonic() - start, len(data), status))
+        return response
+
+    async def write_limited(self, response: web.StreamResponse, data: memoryview):
+        """Write the body, sleeping between chunks to respect the bandwidth cap"""
+        if not self.args.bandwidth_kbps:
+            await response.write(bytes(data))
+            return
+        rate = self.args.bandwidth_kbps * 1024
+        chunk = max(1024, int(rate / 20))
+        start = time.monotonic()
+        for sent in range(0, len(data), chunk):
+            await response.write(bytes(data[sent : sent + chunk]))
+            delay = (sent + chunk) / rate - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+def encrypt(data: bytes, key: bytes, iv: bytes) -> bytes:
+    """Encrypt with AES-128-CBC and PKCS7 padding, as HLS expects"""
+    try:
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        raise SystemExit("--encrypt needs the cryptography package: pip install cryptography")
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(data) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(padded) + encryptor.finalize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(HLSServer(args).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
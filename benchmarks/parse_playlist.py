@@ -0,0 +1,121 @@
+"""Benchmark of playlist parsing on very long VOD playlists.
+
+Generates playlists of every shape below with `--segments` segments and
+measures, for each, the structured parse alone and the whole
+`parse_m3u8_file` of a new video and of a resumed one (state store query
+and directory scan included), with the peak Python memory of the parse.
+
+    python benchmarks/parse_playlist.py --segments 100000 --output parse.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from playlist import load_playlist  # noqa: E402
+
+PLAYLIST_URL = "https://cdn.example.com/vod/title/720p/index.m3u8?token=abc"
+
+
+def write_playlist(path: str, shape: str, segments: int):
+    """Write a playlist of one shape: relative, absolute, encrypted or byterange"""
+    with open(path, "w") as fp:
+        fp.write("#EXTM3U\n#EXT-X-VERSION:4\n#EXT-X-TARGETDURATION:4\n#EXT-X-MEDIA-SEQUENCE:0\n")
+        for index in range(segments):
+            if shape == "encrypted" and index % 1000 == 0:
+                fp.write(f'#EXT-X-KEY:METHOD=AES-128,URI="../keys/key{index // 1000}.bin?token=abc"\n')
+            if index and index % 5000 == 0:
+                fp.write("#EXT-X-DISCONTINUITY\n")
+            fp.write(f"#EXTINF:{3.9 + index % 3 * 0.05:.3f},\n")
+            if shape == "absolute":
+                fp.write(f"https://edge{index % 4}.example.com/vod/title/720p/seg{index}.ts?sig={index:08x}\n")
+            elif shape == "byterange":
+                fp.write(f"#EXT-X-BYTERANGE:188000@{index % 100 * 188000}\nfile{index // 100}.ts\n")
+            else:
+                fp.write(f"seg{index}.ts\n")
+        fp.write("#EXT-X-ENDLIST\n")
+
+
+def measure(func) -> tuple:
+    """Run a function, returning its result, seconds and peak traced memory in MB"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, round(seconds, 3), round(peak / 1024 / 1024, 1)
+
+
+def run_shape(shape: str, segments: int, tmp_dir: str) -> dict:
+    from core import BlobDownloader
+
+    blob = BlobDownloader(save_path=os.path.join(tmp_dir, "videos"), tmp_path=os.path.join(tmp_dir, "tmp_files"))
+    job = blob.new_job(PLAYLIST_URL, f"{shape}.mp4")
+    blob.start_job(job)
+    m3u8_file = os.path.join(job.tmp_path, "index.m3u8")
+    write_playlist(m3u8_file, shape, segments)
+
+    # tracing slows the parse down, timings are measured without it
+    start = time.perf_counter()
+    playlist = load_playlist(m3u8_file, job.blob_url)
+    load_seconds = time.perf_counter() - start
+    _, _, load_peak = measure(lambda: load_playlist(m3u8_file, job.blob_url))
+
+    start = time.perf_counter()
+    _, tasks = blob.parse_m3u8_file(job, m3u8_file)
+    first_seconds = time.perf_counter() - start
+    # a resumed video with half of its files downloaded
+    blob.record_tasks(job, tasks[: len(tasks) // 2])
+    for task in tasks[: len(tasks) // 2]:
+        task.attempts = 1
+        for part in task.parts or []:
+            part.done = True
+    blob.record_tasks(job, tasks[: len(tasks) // 2])
+    start = time.perf_counter()
+    _, resumed = blob.parse_m3u8_file(job, m3u8_file)
+    resume_seconds = time.perf_counter() - start
+    blob.state.close()
+    return {
+        "shape": shape,
+        "segments": len(playlist.segments),
+        "files": sum(len(task.save_paths) for task in tasks),
+        "requests": len(tasks),
+        "load_playlist_seconds": round(load_seconds, 3),
+        "load_playlist_peak_mb": load_peak,
+        "parse_m3u8_file_seconds": round(first_seconds, 3),
+        "resumed_parse_m3u8_file_seconds": round(resume_seconds, 3),
+        "resumed_files_left": sum(len(task.save_paths) for task in resumed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", type=int, default=100000)
+    parser.add_argument(
+        "--shape", choices=["relative", "absolute", "encrypted", "byterange"], action="append", help="all by default"
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    results = []
+    for shape in args.shape or ["relative", "absolute", "encrypted", "byterange"]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results.append(run_shape(shape, args.segments, tmp_dir))
+    text = json.dumps({"segments": args.segments, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
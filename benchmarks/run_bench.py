@@ -0,0 +1,207 @@
+"""Benchmark harness running the downloader against the local HLS server.
+
+Every scenario runs in its own child process so that peak RSS and CPU time
+belong to that scenario only, while the server runs in another process.
+The report is JSON: throughput, p50/p99 segment latency seen by the server,
+peak RSS and CPU time of every scenario.
+
+    python benchmarks/run_bench.py --segments 200 --latency-ms 20 --error-rate 0.01 --output report.json
+    python benchmarks/run_bench.py --scenario run_batch --videos 20 --max-concurrent 50 --adaptive
+    python benchmarks/run_bench.py --scenario run_batch --straggler-rate 0.02 --straggler-ms 3000 --hedge
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hls_server import add_arguments, make_segment, spawn_server  # noqa: E402
+
+SCENARIOS = ["run", "run_batch", "parse_m3u8_file", "merge_media"]
+
+
+def percentile(values: list, ratio: float) -> float:
+    """Get a percentile of a list of numbers, 0 if empty"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def new_blob_downloader(args: argparse.Namespace, tmp_dir: str):
+    from core import BlobDownloader
+    from downloader import Downloader
+
+    blob = BlobDownloader(
+        save_path=os.path.join(tmp_dir, "videos"),
+        tmp_path=os.path.join(tmp_dir, "tmp_files"),
+        stream_merge=args.stream_merge,
+    )
+    blob.downloader = Downloader(
+        max_concurrent=args.max_concurrent,
+        max_retry=args.max_retry,
+        adaptive=args.adaptive,
+        hedge=args.hedge,
+        metrics=blob.metrics,
+    )
+    blob.downloader.progress.disable = True
+    return blob
+
+
+def video_name(args: argparse.Namespace, name: str) -> str:
+    """Name of a downloaded video, MPEG-TS segments streamed to a .ts output need no ffmpeg"""
+    return f"{name}.ts" if args.stream_merge else f"{name}.mp4"
+
+
+def scenario_run(args: argparse.Namespace, tmp_dir: str) -> dict:
+    if not args.stream_merge and shutil.which("ffmpeg") is None:
+        return {"skipped": "ffmpeg not found", "ok": True}
+    blob = new_blob_downloader(args, tmp_dir)
+    ok = True
+    try:
+        blob.run(f"{args.base_url}/bench0/index.m3u8", video_name(args, "bench0"))
+    except Exception as e:
+        print(f"run failed: {e}", file=sys.stderr)
+        ok = False
+    return {"videos": 1, "ok": ok, "hedges": blob.metrics.summary()["hedges"]}
+
+
+def scenario_run_batch(args: argparse.Namespace, tmp_dir: str) -> dict:
+    if not args.stream_merge and shutil.which("ffmpeg") is None:
+        return {"skipped": "ffmpeg not found", "ok": True}
+    blob = new_blob_downloader(args, tmp_dir)
+    urls = [(f"{args.base_url}/bench{i}/index.m3u8", video_name(args, f"bench{i}")) for i in range(args.videos)]
+    results = blob.run_batch(urls)
+    return {
+        "videos": len(urls),
+        "ok": all(results),
+        "failed_videos": len([r for r in results if r is None]),
+        "hedges": blob.metrics.summary()["hedges"],
+    }
+
+
+def scenario_parse_m3u8_file(args: argparse.Namespace, tmp_dir: str) -> dict:
+    blob = new_blob_downloader(args, tmp_dir)
+    job = blob.new_job(f"{args.base_url}/parse/index.m3u8", "parse.mp4")
+    os.makedirs(job.tmp_path)
+    m3u8_file = os.path.join(job.tmp_path, "index.m3u8")
+    with open(m3u8_file, "w") as fp:
+        fp.write("#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXT-X-MEDIA-SEQUENCE:0\n")
+        for index in range(args.parse_segments):
+            fp.write(f"#EXTINF:4.000,\nseg{index}.ts\n")
+        fp.write("#EXT-X-ENDLIST\n")
+    start = time.monotonic()
+    _, tasks = blob.parse_m3u8_file(job, m3u8_file)
+    return {"segments": args.parse_segments, "parse_seconds": round(time.monotonic() - start, 3), "ok": len(tasks) > 0}
+
+
+def scenario_merge_media(args: argparse.Namespace, tmp_dir: str) -> dict:
+    if shutil.which("ffmpeg") is None:
+        return {"skipped": "ffmpeg not found", "ok": True}
+    blob = new_blob_downloader(args, tmp_dir)
+    job = blob.new_job(f"{args.base_url}/merge/index.m3u8", "merge.mp4")
+    os.makedirs(job.tmp_path)
+    local_m3u8_file = os.path.join(job.tmp_path, "local.m3u8")
+    with open(local_m3u8_file, "w") as fp:
+        fp.write("#EXTM3U\n#EXT-X-TARGETDURATION:4\n")
+        for index in range(args.segments):
+            path = os.path.join(job.tmp_path, f"seg{index}.ts")
+            with open(path, "wb") as segment:
+                segment.write(make_segment(index, args.segment_kb * 1024))
+            fp.write(f"#EXTINF:4.000,\n{path}\n")
+        fp.write("#EXT-X-ENDLIST\n")
+    start = time.monotonic()
+    blob.merge_media(job, local_m3u8_file)
+    return {"merge_seconds": round(time.monotonic() - start, 3), "ok": os.path.exists(job.save_path)}
+
+
+def run_child(args: argparse.Namespace):
+    """Run one scenario and print its measurements as JSON"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.monotonic()
+        result = globals()[f"scenario_{args.child}"](args, tmp_dir)
+        result["wall_seconds"] = round(time.monotonic() - start, 3)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result["cpu_seconds"] = round(usage.ru_utime + usage.ru_stime, 3)
+    # kilobytes on Linux, bytes on macOS
+    result["peak_rss_mb"] = round(usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    print(json.dumps(result))
+
+
+def server_requests(base_url: str) -> list:
+    with urllib.request.urlopen(f"{base_url}/stats") as response:
+        return json.load(response)["requests"]
+
+
+def run_scenario(args: argparse.Namespace, scenario: str, base_url: str) -> dict:
+    """Run a scenario in a child process and add the server side measurements"""
+    before = len(server_requests(base_url))
+    argv = [sys.executable, __file__, "--child", scenario, "--base-url", base_url] + sys.argv[1:]
+    child = subprocess.run(argv, stdout=subprocess.PIPE, text=True)
+    lines = child.stdout.strip().splitlines()
+    result = json.loads(lines[-1]) if child.returncode == 0 and lines else {"ok": False, "error": child.returncode}
+    requests = server_requests(base_url)[before:]
+    latencies = [seconds for _, seconds, _, status in requests if status in (200, 206)]
+    transferred = sum(size for _, _, size, _ in requests)
+    result.update(
+        {
+            "scenario": scenario,
+            "segment_requests": len(requests),
+            "failed_requests": len([status for _, _, _, status in requests if status not in (200, 206)]),
+            "bytes": transferred,
+            "p50_segment_latency_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_segment_latency_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+    )
+    if result.get("wall_seconds"):
+        result["throughput_mb_s"] = round(transferred / 1024 / 1024 / result["wall_seconds"], 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="scenarios to run, all by default")
+    parser.add_argument("--videos", type=int, default=10, help="videos of the run_batch scenario")
+    parser.add_argument("--parse-segments", type=int, default=100000, help="segments of the parse_m3u8_file scenario")
+    parser.add_argument("--max-concurrent", type=int, default=20)
+    parser.add_argument("--max-retry", type=int, default=3)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument("--hedge", action="store_true", help="send duplicate requests for stragglers")
+    parser.add_argument("--stream-merge", action="store_true")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    server, base_url = spawn_server(args)
+    try:
+        results = [run_scenario(args, scenario, base_url) for scenario in args.scenario or SCENARIOS]
+    finally:
+        server.terminate()
+        server.wait()
+    report = {
+        "settings": {key: value for key, value in vars(args).items() if key not in ("child", "base_url", "output")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
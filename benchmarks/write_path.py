@@ -0,0 +1,84 @@
+"""Measure event-loop CPU per GB of the segment write path.
+
+Runs the Downloader against the local HLS server in a child process with the old
+write path (1 KiB reads written on the event loop) and with `config.IOConfig`,
+then prints a JSON report.
+
+    python benchmarks/write_path.py --segments 64 --segment-mb 16
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloader import Downloader, Task  # noqa: E402
+from config import IOConfig  # noqa: E402
+from hls_server import add_arguments, spawn_server  # noqa: E402
+
+PROFILES = {
+    "before": {
+        "chunk_size": 1024,
+        "whole_body_size": 0,
+        "write_buffer_size": 0,
+        "threaded_writes": False,
+        "preallocate": False,
+    },
+    "after": dict(IOConfig),
+}
+
+
+def run_profile(name: str, io_config: dict, base_url: str, segments: int, segment_mb: int, concurrent: int) -> dict:
+    downloader = Downloader(max_concurrent=concurrent, max_retry=0)
+    downloader.io_config = dict(io_config)
+    downloader.progress.disable = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tasks = [Task(f"{base_url}/write/seg{i}.ts", os.path.join(tmp_dir, f"{i}.ts")) for i in range(segments)]
+        loop = asyncio.get_event_loop()
+        loop_cpu, process_cpu, wall = time.thread_time(), time.process_time(), time.monotonic()
+        results = loop.run_until_complete(downloader.async_run(tasks, name))
+        loop_cpu = time.thread_time() - loop_cpu
+        process_cpu = time.process_time() - process_cpu
+        wall = time.monotonic() - wall
+    gigabytes = segments * segment_mb / 1024
+    return {
+        "profile": name,
+        "io_config": io_config,
+        "ok": all(results),
+        "gigabytes": gigabytes,
+        "wall_seconds": round(wall, 3),
+        "throughput_mb_s": round(segments * segment_mb / wall, 1),
+        "event_loop_cpu_s_per_gb": round(loop_cpu / gigabytes, 3),
+        "process_cpu_s_per_gb": round(process_cpu / gigabytes, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segment-mb", type=int, default=16)
+    parser.add_argument("--concurrent", type=int, default=8)
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append")
+    add_arguments(parser)
+    parser.set_defaults(segments=64)
+    args = parser.parse_args()
+    args.segment_kb = args.segment_mb * 1024
+
+    server, base_url = spawn_server(args)
+    try:
+        report = [
+            run_profile(name, PROFILES[name], base_url, args.segments, args.segment_mb, args.concurrent)
+            for name in args.profile or ["before", "after"]
+        ]
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import os
+import time
+import sqlite3
+import hashlib
+from log import logger
+from fileio import link_file
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str, ignore_params: Iterable[str] = ()) -> str:
+    """Normalize a segment URL so that the same file gets the same cache key
+
+    The scheme and host are lowercased, default ports and fragments dropped,
+    query parameters sorted and the ignored ones (e.g. expiring signatures)
+    removed.
+
+    Args:
+        url (str): Segment URL
+        ignore_params (Iterable[str], optional): Query parameters not identifying the file. Defaults to ().
+
+    Returns:
+        str: Normalized URL
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    if parts.username:
+        netloc = f"{parts.username}@{netloc}"
+    ignored = set(ignore_params)
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    query = sorted((name, value) for name, value in params if name not in ignored)
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+
+class SegmentCache:
+    """SegmentCache keeps downloaded segments on disk, shared by every video and run.
+
+    Files are stored under a hash of their normalized URL, the byte range
+    and, for segments decrypted while downloading, the key and IV, so a
+    segment showing up again under another save name or in another batch is
+    linked into place instead of downloaded. An SQLite index answers lookups
+    by key and keeps the last use of every file; once the files exceed
+    `max_size`, the least recently used ones are removed.
+    """
+
+    def __init__(self, root: str, max_size: int, ignore_params: Iterable[str] = ()):
+        """Initialize segment cache
+
+        Args:
+            root (str): Directory of the cached files and their index, created if missing
+            max_size (int): Disk budget of the cached files in bytes
+            ignore_params (Iterable[str], optional): Query parameters left out of the cache key. Defaults to ().
+        """
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.max_size = max_size
+        self.ignore_params = frozenset(ignore_params)
+        self.conn = sqlite3.connect(os.path.join(root, "index.db"), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            """
+        )
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def key(
+        self, url: str, byterange: Optional[Tuple[int, int]] = None, key_url: str = "", iv: Optional[bytes] = None
+    ) -> str:
+        """Cache key of a segment
+
+        Args:
+            url (str): Segment URL
+            byterange (Optional[Tuple[int, int]], optional): (length, offset) of a sub-range. Defaults to None.
+            key_url (str, optional): URL of the AES-128 key the file is decrypted with, empty if stored as
+                received. Defaults to "".
+            iv (Optional[bytes], optional): IV the file is decrypted with. Defaults to None.
+
+        Returns:
+            str: Hex digest
+        """
+        fields = [normalize_url(url, self.ignore_params)]
+        if byterange is not None:
+            fields.append(f"{byterange[1]}-{byterange[0]}")
+        if key_url:
+            fields.extend([normalize_url(key_url, self.ignore_params), iv.hex() if iv else ""])
+        return hashlib.sha256("\n".join(fields).encode()).hexdigest()
+
+    def path_of(self, key: str) -> str:
+        """Path of a cached file, spread over 256 directories"""
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, keys: Dict[str, str]) -> Dict[str, int]:
+        """Link the cached files of some segments into place
+
+        Args:
+            keys (Dict[str, str]): Cache key of every save path
+
+        Returns:
+            Dict[str, int]: Size of every save path found in the cache
+        """
+        found: Dict[str, int] = dict()
+        if not keys:
+            return found
+        by_key: Dict[str, List[str]] = dict()
+        for save_path, key in keys.items():
+            by_key.setdefault(key, []).append(save_path)
+        sizes: Dict[str, int] = dict()
+        unique = list(by_key)
+        # SQLite allows 999 parameters per query in old versions
+        for start in range(0, len(unique), 900):
+            chunk = unique[start : start + 900]
+            rows = self.conn.execute(
+                f"SELECT key, size FROM entries WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            sizes.update(rows.fetchall())
+        used, gone = [], []
+        for key, size in sizes.items():
+            try:
+                for save_path in by_key[key]:
+                    link_file(self.path_of(key), save_path)
+                    found[save_path] = size
+                used.append(key)
+            except FileNotFoundError:
+                # removed behind the index's back
+                gone.append(key)
+        with self.conn:
+            now = time.time()
+            self.conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", ((now, key) for key in used))
+            self.conn.executemany("DELETE FROM entries WHERE key = ?", ((key,) for key in gone))
+        self.size -= sum(sizes[key] for key in gone)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def store(self, key: str, url: str, save_path: str):
+        """Add a downloaded segment to the cache, evicting the least recently used files over the budget
+
+        Args:
+            key (str): Cache key of the segment
+            url (str): Segment URL, kept for inspection
+            save_path (str): Downloaded file
+        """
+        size = os.path.getsize(save_path)
+        if size > self.max_size:
+            return
+        cache_path = self.path_of(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        link_file(save_path, cache_path)
+        with self.conn:
+            row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, url, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, url, size, time.time()),
+            )
+        self.size += size - (row[0] if row else 0)
+        if self.size > self.max_size:
+            # other processes sharing the cache may have added or evicted files meanwhile
+            self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if self.size > self.max_size:
+                self.evict(self.size - self.max_size)
+
+    def evict(self, nbytes: int):
+        """Remove the least recently used files until nbytes are freed"""
+        freed, keys = 0, []
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if freed >= nbytes:
+                break
+            freed += size
+            keys.append(key)
+        for key in keys:
+            try:
+                os.remove(self.path_of(key))
+            except FileNotFoundError:
+                pass
+        with self.conn:
+            self.conn.executemany("DELETE FROM entries WHERE key = ?", ((key,) for key in keys))
+        self.size -= freed
+        logger.debug(f"segment cache: evicted {len(keys)} files, {freed / 1024 / 1024:.1f} MB")
+
+    def close(self):
+        """Close the index"""
+        self.conn.close()
@@ -0,0 +1,338 @@
+"""Download blob videos listed in a manifest
+
+A manifest has one video per line, read and downloaded as a stream so its
+length does not matter:
+
+    JSONL  {"url": "https://example.com/a.m3u8", "save_name": "a.mp4", "referer": "https://example.com/"}
+    CSV    url,save_name,output,referer,max_concurrent,headers
+
+Besides "url", every field is optional: "save_name", "output" (path of the
+video, or a directory when it ends with "/"), "headers" (an object, a JSON
+object in CSV), "referer" and "max_concurrent" (segments of the video
+downloading at the same time). Blank lines and JSONL lines starting with
+"#" are skipped.
+
+    python main.py run videos.jsonl --results results.jsonl
+    upstream-job | python main.py run - --stream-merge
+    python main.py check videos.csv
+"""
+
+import io
+import sys
+import csv
+import json
+import logging
+import argparse
+import threading
+from log import logger, setup_logging
+from typing import IO, Dict, Iterator, NamedTuple, Optional
+
+MANIFEST_FIELDS = ("url", "save_name", "output", "headers", "referer", "max_concurrent")
+
+
+class ManifestError(ValueError):
+    """An invalid manifest line"""
+
+    def __init__(self, line: int, message: str):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+        self.message = message
+
+
+class ManifestEntry(NamedTuple):
+    """A manifest line, with its item for BlobDownloader.parse_batch_item or the reason it is invalid"""
+
+    line: int
+    item: Optional[dict]
+    error: Optional[ManifestError]
+
+
+def parse_entry(line: int, entry: dict) -> dict:
+    """Check the fields of a manifest line
+
+    Args:
+        line (int): Line number, for the error message
+        entry (dict): Fields of the line, empty CSV cells are left out
+
+    Returns:
+        dict: Item for BlobDownloader.parse_batch_item
+
+    Raises:
+        ManifestError: if a field is unknown or has the wrong type
+    """
+    unknown = [name for name in entry if name not in MANIFEST_FIELDS]
+    if unknown:
+        raise ManifestError(line, f"unknown fields {', '.join(map(str, unknown))}")
+    url = entry.get("url")
+    if not isinstance(url, str) or not url.strip():
+        raise ManifestError(line, "url is missing")
+    item = {"url": url.strip()}
+    for name in ("save_name", "output", "referer"):
+        value = entry.get(name)
+        if value is None or value == "":
+            continue
+        if not isinstance(value, str):
+            raise ManifestError(line, f"{name} must be a string")
+        item[name] = value
+    headers = entry.get("headers")
+    if isinstance(headers, str) and headers:
+        try:
+            headers = json.loads(headers)
+        except ValueError:
+            raise ManifestError(line, "headers must be a JSON object")
+    if headers:
+        if not isinstance(headers, dict) or not all(isinstance(value, str) for value in headers.values()):
+            raise ManifestError(line, "headers must be an object of strings")
+        item["headers"] = headers
+    max_concurrent = entry.get("max_concurrent")
+    if max_concurrent is not None and max_concurrent != "":
+        try:
+            max_concurrent = int(max_concurrent)
+        except (TypeError, ValueError):
+            max_concurrent = -1
+        if isinstance(entry["max_concurrent"], bool) or max_concurrent < 0:
+            raise ManifestError(line, "max_concurrent must be a non-negative integer")
+        item["max_concurrent"] = max_concurrent
+    return item
+
+
+def read_manifest(fp: IO[str], fmt: str = "jsonl") -> Iterator[ManifestEntry]:
+    """Read a manifest line by line
+
+    Invalid lines are yielded with their error instead of raised, so a bad
+    line does not stop the videos after it.
+
+    Args:
+        fp (IO[str]): Manifest file or stdin
+        fmt (str, optional): "jsonl" or "csv". Defaults to "jsonl".
+
+    Yields:
+        ManifestEntry: Each video of the manifest
+
+    Raises:
+        ManifestError: if a CSV manifest has no header row with a url column
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(fp, skipinitialspace=True)
+        if reader.fieldnames is None:
+            return
+        if "url" not in reader.fieldnames:
+            raise ManifestError(1, "CSV manifest needs a header row with a url column")
+        for row in reader:
+            if not any(row.values()):
+                continue
+            # DictReader puts extra cells under None
+            fields = {name: value for name, value in row.items() if value not in (None, "")}
+            try:
+                yield ManifestEntry(reader.line_num, parse_entry(reader.line_num, fields), None)
+            except ManifestError as e:
+                yield ManifestEntry(reader.line_num, None, e)
+        return
+    for number, text in enumerate(fp, 1):
+        text = text.strip()
+        if not text or text.startswith("#"):
+            continue
+        try:
+            try:
+                entry = json.loads(text)
+            except ValueError as e:
+                raise ManifestError(number, f"invalid JSON: {e}")
+            if isinstance(entry, str):
+                entry = {"url": entry}
+            if not isinstance(entry, dict):
+                raise ManifestError(number, "expected a JSON object")
+            yield ManifestEntry(number, parse_entry(number, entry), None)
+        except ManifestError as e:
+            yield ManifestEntry(number, None, e)
+
+
+def manifest_format(path: str, fmt: str = "") -> str:
+    """Format of a manifest, given or guessed from its extension, JSONL for stdin"""
+    if fmt:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def open_manifest(path: str) -> IO[str]:
+    """Open a manifest file, "-" for stdin"""
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+class ResultWriter:
+    """ResultWriter appends the result of every video to a JSONL file as soon as it is known.
+
+    Results come from the event loop and from the thread reading the
+    manifest, every line is written whole and flushed, so a crashed run
+    keeps the results of its finished videos.
+    """
+
+    def __init__(self, path: str = ""):
+        """Initialize result writer
+
+        Args:
+            path (str, optional): JSONL file, "-" for stdout, empty to only count the results. Defaults to "".
+        """
+        self.fp: Optional[IO[str]] = None
+        if path == "-":
+            self.fp = sys.stdout
+        elif path:
+            self.fp = open(path, "a", encoding="utf-8")
+        self.counts: Dict[str, int] = dict()
+        self.lock = threading.Lock()
+
+    def write(self, line: int, url: str, status: str, save_name: str = "", path: str = "", error: str = ""):
+        """Record the result of a manifest line"""
+        record = {"line": line, "url": url, "save_name": save_name, "status": status, "path": path, "error": error}
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if self.fp is not None:
+                self.fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.fp.flush()
+
+    def close(self):
+        """Close the results file"""
+        if self.fp is not None and self.fp is not sys.stdout:
+            self.fp.close()
+
+
+def check_manifest(args: argparse.Namespace) -> int:
+    """Validate a manifest without downloading, listing its invalid lines"""
+    valid, invalid = 0, 0
+    writer = ResultWriter(args.results)
+    try:
+        with open_manifest(args.manifest) as fp:
+            for entry in read_manifest(fp, manifest_format(args.manifest, args.format)):
+                if entry.error is not None:
+                    invalid += 1
+                    logger.error(f"{args.manifest}: {entry.error}")
+                    writer.write(entry.line, "", "invalid", error=entry.error.message)
+                else:
+                    valid += 1
+                    writer.write(entry.line, entry.item["url"], "valid", entry.item.get("save_name", ""))
+    except ManifestError as e:
+        logger.error(f"{args.manifest}: {e}")
+        return 2
+    finally:
+        writer.close()
+    print(f"{valid} valid, {invalid} invalid videos in {args.manifest}")
+    return 1 if invalid else 0
+
+
+def run_manifest(args: argparse.Namespace) -> int:
+    """Download the videos of a manifest, or of config.BlobUrls without one"""
+    if args.dry_run:
+        if not args.manifest:
+            logger.error("--dry-run needs a manifest")
+            return 2
+        return check_manifest(args)
+    # aiohttp and rich are only needed once something is downloaded
+    from config import BlobDownloaderConfig, BlobUrls, SchedulerConfig
+    from core import BlobDownloader
+    from scheduler import BatchScheduler
+
+    blob_config = dict(BlobDownloaderConfig)
+    if args.save_path:
+        blob_config["save_path"] = args.save_path
+    if args.tmp_path:
+        blob_config["tmp_path"] = args.tmp_path
+    if args.stream_merge:
+        blob_config["stream_merge"] = True
+    blob = BlobDownloader(**blob_config)
+    writer = ResultWriter(args.results)
+    # manifest line of every video in flight
+    lines: Dict[int, int] = dict()
+
+    def jobs(entries: Iterator[ManifestEntry]):
+        for entry in entries:
+            if entry.error is not None:
+                logger.error(f"{args.manifest}: {entry.error}")
+                writer.write(entry.line, "", "invalid", error=entry.error.message)
+                continue
+            job = blob.parse_batch_item(entry.item)
+            if args.max_concurrent and not job.max_concurrent:
+                job.max_concurrent = args.max_concurrent
+            lines[id(job)] = entry.line
+            yield job
+
+    def on_finish(job, video_path: Optional[str], error: Optional[Exception]):
+        line = lines.pop(id(job), 0)
+        status = "done" if error is None else "failed"
+        writer.write(line, job.blob_url, status, job.save_name, video_path or "", str(error or ""))
+
+    scheduler = BatchScheduler(blob, **SchedulerConfig)
+    try:
+        if args.manifest:
+            with open_manifest(args.manifest) as fp:
+                scheduler.run_stream(jobs(read_manifest(fp, manifest_format(args.manifest, args.format))), on_finish)
+        else:
+            entries = (
+                ManifestEntry(0, {"url": url, "save_name": save_name}, None) for url, save_name in BlobUrls if url
+            )
+            scheduler.run_stream(jobs(entries), on_finish)
+    except ManifestError as e:
+        logger.error(f"{args.manifest}: {e}")
+        return 2
+    finally:
+        writer.close()
+        blob.state.close()
+    done = writer.counts.get("done", 0)
+    total = sum(writer.counts.values())
+    print(f"✅ Successfully downloaded {done}/{total} videos!")
+    return 0 if done == total else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Arguments of the command line"""
+    parser = argparse.ArgumentParser(
+        prog="download-blob-videos", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="print debug logs")
+    parser.add_argument("-q", "--quiet", action="store_true", help="print warnings and errors only")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="download the videos of a manifest")
+    run.add_argument(
+        "manifest", nargs="?", default="", help='JSONL or CSV file, "-" for stdin, config.BlobUrls if left out'
+    )
+    run.add_argument(
+        "--results", default="", help='append the result of every video to this JSONL file, "-" for stdout'
+    )
+    run.add_argument("--save-path", default="", help="directory of the videos, see BlobDownloaderConfig")
+    run.add_argument("--tmp-path", default="", help="directory of the segments and the state store")
+    run.add_argument("--stream-merge", action="store_true", help="assemble segments in order while they download")
+    run.add_argument("--max-concurrent", type=int, default=0, help="segments of a video downloading at the same time")
+    run.add_argument("--dry-run", action="store_true", help="only validate the manifest, like check")
+    run.set_defaults(handler=run_manifest)
+
+    check = commands.add_parser("check", aliases=["validate"], help="validate a manifest without downloading")
+    check.add_argument("manifest", help='JSONL or CSV file, "-" for stdin')
+    check.add_argument("--results", default="", help="append the validation of every line to this JSONL file")
+    check.set_defaults(handler=check_manifest)
+
+    for command in (run, check):
+        command.add_argument("--format", choices=("jsonl", "csv"), default="", help="guessed from the extension")
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Run the command line
+
+    Args:
+        argv (Optional[list], optional): Arguments, sys.argv[1:] if None. Defaults to None.
+
+    Returns:
+        int: Exit status, 1 when a video failed or a line is invalid, 2 for an unreadable manifest
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = build_parser().parse_args(argv or ["run"])
+    if args.command is None:
+        build_parser().print_help()
+        return 2
+    setup_logging(logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,11 +7,21 @@ BlobUrls = [
     ),
 ]
 
+# BlobDownloaderConfig
+BlobDownloaderConfig = {
+    "clean_tmp": True,  # delete temporary files after download
+    "stream_merge": False,  # write segments to the video in order while downloading, instead of merging at the end
+    "decrypt": True,  # decrypt AES-128 segments while downloading (needs cryptography), instead of in ffmpeg
+    "cache": False,  # keep segments in a cache shared by all videos and runs, see CacheConfig
+    "max_tmp_size": 0,  # bytes of segments in tmp_path at most, removed once streamed to the video, 0 for no limit
+}
 
 # DownloaderConfig
 DownloaderConfig = {
     "max_retry": 3,  # if failed as expected error, retry download
     "max_concurrent": 20,  # the number of files downloaded at same time
+    "adaptive": False,  # adjust the files downloaded at same time of every host at runtime, up to max_concurrent
+    "hedge": False,  # send a duplicate request for files much slower than the others, see HedgeConfig
 }
 
 # to avoid timeout error, please always consider about the size of files
@@ -19,6 +29,7 @@ DownloaderConfig = {
 # 1. limit the number of downloading file at same time
 # 2. increase timeout
 # 3. choose a proper connection limit
+# or set "adaptive" to let the downloader find the limit of every host by itself
 HeaderConfig = {
     "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 11_2_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.90 Safari/537.36",
     # "referer": ""
@@ -30,4 +41,103 @@ GetConfig = {
 ConnectorConfig = {
     "verify_ssl": False,
     "limit": 5,  # control the connection limit
+    "limit_per_host": 0,  # connections to one host at most, 0 for no limit besides "limit"
+    "keepalive_timeout": 30,  # seconds an idle connection is kept for the next request to its host
+    "ttl_dns_cache": 300,  # seconds a DNS answer is reused, None to keep it for the whole session
+}
+
+# SchedulerConfig, used by BlobDownloader.run_batch
+SchedulerConfig = {
+    "max_active_videos": 4,  # videos downloading segments at same time, they share max_concurrent
+    "prefetch_playlists": 4,  # upcoming videos whose m3u8 file is fetched and parsed ahead
+    "state_batch": 100,  # finished segments recorded in the state store per write, a crash loses at most these
+    "max_merges": 0,  # videos merged by ffmpeg or concatenated at the same time, 0 for the number of CPUs
+}
+
+# QueueConfig, used by workqueue.QueueWorker, workers of one or several hosts share the videos of a queue file
+QueueConfig = {
+    "lease": 300.0,  # seconds a claimed video stays with its worker without a heartbeat, then another worker takes it
+    "heartbeat": 30.0,  # seconds between two lease renewals of the video being downloaded
+    "max_attempts": 3,  # claims of a video before it is failed for good, crashed workers count
+    "poll_interval": 10.0,  # seconds between two claims while other workers hold every remaining video
+}
+
+# HedgeConfig, when a slow download gets a duplicate request, the first one to finish wins
+HedgeConfig = {
+    "percentile": 0.95,  # a request is hedged once it runs longer than this percentile of finished downloads
+    "multiplier": 1.0,  # times this factor
+    "min_delay": 0.2,  # and at least this many seconds
+    "min_samples": 20,  # finished downloads needed before hedging starts
+    "max_ratio": 0.05,  # largest share of requests hedged, the duplicates also wait for a free slot
+    "window": 1000,  # latest downloads the percentile is computed from
+    "mirrors": {},  # hosts serving the same files, e.g. {"cdn1.example.com": ["cdn2.example.com"]}
+}
+
+# RetryConfig, how failed requests are tried again, up to DownloaderConfig["max_retry"] times
+RetryConfig = {
+    "base_delay": 0.5,  # longest wait before the first retry in seconds, doubled every retry, a random share is waited
+    "max_delay": 30.0,  # longest wait between retries
+    "retry_statuses": [408, 425, 429, 500, 502, 503, 504],  # HTTP statuses retried, any other one fails the file
+    "max_retry_after": 120.0,  # longest Retry-After honored, in seconds
+    "breaker_failures": 10,  # failures in a row after which requests to a host pause, 0 never pauses
+    "breaker_cooldown": 10.0,  # seconds of the first pause, doubled while the host keeps failing
+    "final_pass": True,  # retry the failed files of a video once more after all others, instead of failing it
+}
+
+# CacheConfig, segments already downloaded by any video are linked from the cache instead of downloaded again
+CacheConfig = {
+    "path": "",  # directory of the cache, default: <tmp_path>/segment_cache
+    "max_size": 20 * 1024 * 1024 * 1024,  # disk budget in bytes, least recently used segments are removed beyond it
+    "ignore_params": [],  # query parameters not identifying a segment, e.g. ["token", "Expires", "Signature"]
+}
+
+# IOConfig, how downloaded bytes go to disk
+IOConfig = {
+    "chunk_size": 256 * 1024,  # bytes read from the response at a time
+    "whole_body_size": 2 * 1024 * 1024,  # responses up to this size are gathered in memory and written at once
+    "write_buffer_size": 1024 * 1024,  # bytes gathered before a disk write, 0 writes every chunk directly
+    "threaded_writes": True,  # write in a worker thread so a slow disk never blocks the event loop
+    "preallocate": False,  # reserve disk blocks from Content-Length before writing (Linux only)
+}
+
+# ValidateConfig, segments are checked while they are written, a corrupt one is fetched again like a failed request
+ValidateConfig = {
+    "enabled": True,  # check MPEG-TS sync bytes or MP4 boxes and reject HTML pages, see validate.SegmentValidator
+    "checksum": "",  # hashlib algorithm of a checksum recorded with every segment in the state store, e.g. "sha256"
+}
+
+# VariantConfig, which variant of a master playlist is downloaded
+VariantConfig = {
+    "policy": "highest",  # highest, lowest, max_bandwidth, resolution, or auto to fit the deadline
+    "max_bandwidth": 0,  # bits per second, the max_bandwidth policy takes the highest variant within it
+    "resolution": "",  # e.g. "720p" or "1280x720", the resolution policy takes the highest variant not above it
+    "deadline": 0,  # seconds a video may take to download with auto, 0 for its duration (real time)
+    "sample_segments": 3,  # segments fetched by auto to measure the throughput
+}
+
+# LiveConfig, used by BlobDownloader.record_live
+LiveConfig = {
+    "max_duration": 0,  # seconds to record, 0 records until the playlist ends with #EXT-X-ENDLIST
+    "start_segments": 3,  # segments before the live edge the recording starts with, 0 for the whole playlist
+    "max_poll_failures": 5,  # playlist polls failing in a row before the recording stops
+}
+
+# RangeConfig, how EXT-X-BYTERANGE segments are requested, every sub-range is still saved to its own file
+RangeConfig = {
+    "max_request_size": 16 * 1024 * 1024,  # adjacent sub-ranges of a file share one Range request up to this size
+    "max_gap": 64 * 1024,  # sub-ranges this close are still fetched together, the bytes between them are dropped
+}
+
+# MetricsConfig, a summary of every run is always kept in BlobDownloader.metrics
+MetricsConfig = {
+    "jsonl_path": "",  # append one JSON line per segment and per video to this file
+    "prometheus_path": "",  # write Prometheus text format to this file, e.g. for the node exporter textfile collector
+}
+
+# ProgressConfig, how downloads are shown
+ProgressConfig = {
+    "refresh_per_second": 4,  # redraws of the progress bars, counters are only read when drawing
+    "headless": None,  # log one stats line every log_interval instead of bars, None when stderr is not a terminal
+    "log_interval": 10.0,  # seconds between two stats lines in headless mode
+    "show_hosts": True,  # add a row with the throughput of every host
 }
@@ -1,31 +1,113 @@
 import os
-import re
 import shutil
+import hashlib
+import asyncio
 from log import logger
-from typing import Tuple
-from utils import get_url_basename, get_url_prefix
-from downloader import Downloader, Task
-from config import DownloaderConfig
+from typing import Dict, Optional, Tuple
+from utils import get_url_basename
+from downloader import Downloader, Task, TaskPart
+from decrypt import AESKey, decrypt_available, parse_iv, sequence_iv
+from playlist import InitSection, Key, PlaylistError, Variant, load_playlist
+from state import StateStore
+from cache import SegmentCache
+from metrics import Metrics
+from merge import async_run_ffmpeg, concat_segments, run_ffmpeg
+from config import (
+    CacheConfig,
+    DownloaderConfig,
+    LiveConfig,
+    MetricsConfig,
+    RangeConfig,
+    SchedulerConfig,
+    VariantConfig,
+)
+
+
+class VideoJob:
+    """VideoJob holds the paths of a single video, so that several videos can be in flight at once"""
+
+    def __init__(self, blob_url: str, save_name: str, base_save_path: str, base_tmp_path: str) -> None:
+        """Initialize video job
+
+        Args:
+            blob_url (str): M3U8 URL to download
+            save_name (str): Output filename (default: extracted from URL)
+            base_save_path (str): Directory to save final videos
+            base_tmp_path (str): Directory to save temporary files
+        """
+        self.blob_url = blob_url.strip()
+        # URL of the media playlist, the selected variant when blob_url is a master playlist
+        self.media_url = self.blob_url
+        self.save_name = get_url_basename(self.blob_url) if not save_name else save_name
+        self.save_path = os.path.join(base_save_path, self.save_name)
+        self.tmp_path = os.path.join(base_tmp_path, self.save_name)
+        # id in the state store, set when the job starts
+        self.video_id: Optional[int] = None
+        # filled by BlobDownloader.parse_m3u8_file
+        self.segment_paths: list[str] = []
+        self.streamable = False
+        # files linked from the segment cache
+        self.cached_files = 0
+        # request headers on top of HeaderConfig, e.g. a Referer, None for none
+        self.headers: Optional[Dict[str, str]] = None
+        # segments of the video downloading at the same time at most, 0 for DownloaderConfig["max_concurrent"]
+        self.max_concurrent = 0
 
 
 class BlobDownloader:
     """Blob video downloader that supports both single and batch downloads"""
 
-    def __init__(self, save_path: str = "", tmp_path: str = "", clean_tmp: bool = False):
+    def __init__(
+        self,
+        save_path: str = "",
+        tmp_path: str = "",
+        clean_tmp: bool = False,
+        stream_merge: bool = False,
+        decrypt: bool = True,
+        cache: bool = False,
+        max_tmp_size: int = 0,
+    ):
         """Initialize blob downloader
 
         Args:
             save_path (str): Directory to save final videos (default: ./videos)
             tmp_path (str): Directory to save temporary files (default: ./tmp_files)
             clean_tmp (bool): Whether to clean up temporary files after download (default: False)
+            stream_merge (bool): Whether to assemble segments in order while they download (default: False)
+            decrypt (bool): Whether to decrypt AES-128 segments while they download, otherwise ffmpeg does at merge (default: True)
+            cache (bool): Whether to reuse segments downloaded by any video or run (default: False)
+            max_tmp_size (int): Bytes of segments kept in tmp_path at most, streaming the merge and removing every
+                segment once assembled, 0 for no limit (default: 0)
         """
         self.base_save_path = self.gen_video_path() if not save_path else save_path
         self.base_tmp_path = self.gen_tmp_path() if not tmp_path else tmp_path
         os.makedirs(self.base_save_path, exist_ok=True)
 
         self.clean_tmp = clean_tmp
+        self.max_tmp_size = max_tmp_size
+        # a bounded tmp space needs segments assembled, and removed, while they download
+        self.stream_merge = stream_merge or max_tmp_size > 0
+        self.decrypt = decrypt and decrypt_available()
+        if decrypt and not self.decrypt:
+            logger.warning("cryptography is not installed, encrypted segments are decrypted by ffmpeg when merging")
+        # Measurements of every segment and video, see config.MetricsConfig
+        self.metrics = Metrics(**MetricsConfig)
         # Reuse the same downloader instance for efficiency
-        self.downloader = Downloader(**DownloaderConfig)
+        self.downloader = Downloader(**DownloaderConfig, metrics=self.metrics)
+        # Which variant of a master playlist is downloaded, see config.VariantConfig
+        self.variant_config = dict(VariantConfig)
+        # How EXT-X-BYTERANGE segments are grouped into range requests, see config.RangeConfig
+        self.range_config = dict(RangeConfig)
+        # Remember segments of past runs to resume without checking every file
+        self.state = StateStore(os.path.join(self.base_tmp_path, "state.db"))
+        # Segments shared by all videos and runs, see config.CacheConfig
+        self.cache: Optional[SegmentCache] = None
+        if cache:
+            self.cache = SegmentCache(
+                CacheConfig["path"] or os.path.join(self.base_tmp_path, "segment_cache"),
+                CacheConfig["max_size"],
+                CacheConfig["ignore_params"],
+            )
 
     def gen_video_path(self) -> str:
         """Generate path to save final videos
@@ -43,6 +125,25 @@ class BlobDownloader:
         """
         return os.path.join(os.path.dirname(os.path.abspath(__file__)), "tmp_files")
 
+    def new_job(self, blob_url: str, save_name: str = "") -> VideoJob:
+        """Create a video job rooted at this downloader's save and tmp paths
+
+        Args:
+            blob_url (str): M3U8 URL to download
+            save_name (str): Output filename (default: extracted from URL)
+
+        Returns:
+            VideoJob: Job describing where the video and its segments are stored
+        """
+        return VideoJob(blob_url, save_name, self.base_save_path, self.base_tmp_path)
+
+    async def __aenter__(self) -> "BlobDownloader":
+        await self.downloader.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.downloader.close()
+
     def run(self, blob_url: str, save_name: str = "") -> str:
         """Download a single blob video
 
@@ -55,37 +156,143 @@ class BlobDownloader:
         """
         return self._download_single(blob_url, save_name)
 
-    def run_batch(self, url_list: list) -> list[str]:
+    def run_batch(self, url_list: list) -> list[Optional[str]]:
         """Download multiple blob videos
 
+        Segments of all videos share one session and one concurrency budget,
+        see `scheduler.BatchScheduler`.
+
+        Args:
+            url_list (list): List of (url, save_name) tuples or just URLs
+
+        Returns:
+            list[Optional[str]]: List of paths to downloaded video files, None for failed videos
+        """
+        from scheduler import BatchScheduler
+
+        scheduler = BatchScheduler(self, **SchedulerConfig)
+        return scheduler.run(self._batch_jobs(url_list))
+
+    async def async_run(self, blob_url: str, save_name: str = "") -> str:
+        """Download a single blob video asynchronously, from a running event loop
+
+        Inside `async with BlobDownloader() as blob:` every call reuses the
+        same session, its open connections and cached DNS answers.
+
+        Args:
+            blob_url (str): M3U8 URL to download
+            save_name (str): Output filename (default: extracted from URL)
+
+        Returns:
+            str: Path to the downloaded video file
+        """
+        from scheduler import BatchScheduler
+
+        job = self.new_job(blob_url, save_name)
+        if os.path.exists(job.save_path):
+            return job.save_path
+        return await BatchScheduler(self, **SchedulerConfig).async_run_single(job)
+
+    async def async_run_batch(self, url_list: list) -> list[Optional[str]]:
+        """Download multiple blob videos asynchronously, from a running event loop
+
         Args:
             url_list (list): List of (url, save_name) tuples or just URLs
 
         Returns:
-            list[str]: List of paths to downloaded video files
+            list[Optional[str]]: List of paths to downloaded video files, None for failed videos
         """
-        results = []
+        from scheduler import BatchScheduler
+
+        scheduler = BatchScheduler(self, **SchedulerConfig)
+        return await scheduler.async_run(self._batch_jobs(url_list))
+
+    def _batch_jobs(self, url_list: list) -> list[VideoJob]:
+        """Video jobs of the valid items of a batch list"""
+        jobs = []
         for item in url_list:
-            if isinstance(item, (list, tuple)) and len(item) >= 2:
-                url, save_name = item[0], item[1]
-            elif isinstance(item, str):
-                url, save_name = item, ""
-            else:
-                logger.error(f"Invalid item format: {item}")
-                continue
+            job = self.parse_batch_item(item)
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    def record_live(self, blob_url: str, save_name: str = "", max_duration: Optional[float] = None) -> str:
+        """Record a live or event playlist until it ends or max_duration elapsed
+
+        The playlist is polled every target duration and new segments are
+        appended to the video as they arrive, see `live.LiveRecorder`.
+
+        Args:
+            blob_url (str): M3U8 URL of the live stream
+            save_name (str): Output filename (default: extracted from URL)
+            max_duration (Optional[float]): Seconds to record, None for LiveConfig["max_duration"]
+
+        Returns:
+            str: Path to the recorded video file
+        """
+        from live import LiveRecorder
+
+        job = self.parse_batch_item((blob_url, save_name))
+        if os.path.exists(job.save_path):
+            return job.save_path
+        config = dict(LiveConfig)
+        if max_duration is not None:
+            config["max_duration"] = max_duration
+        return LiveRecorder(self, **config).run(job)
+
+    def retry_failed(self) -> list[Optional[str]]:
+        """Download again the videos that failed in previous runs
 
-            if not save_name.endswith(".mp4"):
-                save_name = f"{save_name}.mp4"
+        Only their failed or missing segments are fetched, finished segments are kept. Every video keeps
+        the output path, headers and max_concurrent of its job.
 
-            try:
-                result = self._download_single(url, save_name)
-                results.append(result)
-                logger.info(f"✅ Successfully downloaded: {save_name or get_url_basename(url)}")
-            except Exception as e:
-                logger.error(f"❌ Failed to download {url}: {e}")
-                results.append(None)
+        Returns:
+            list[Optional[str]]: List of paths to downloaded video files, None for failed videos
+        """
+        return self.run_batch(self.state.failed_videos())
+
+    def parse_batch_item(self, item) -> Optional[VideoJob]:
+        """Turn an entry of a batch list into a video job
 
-        return results
+        A dict item overrides the settings of its video: "url", "save_name",
+        "output" (path of the video, or a directory when it ends with a path
+        separator), "headers", "referer" and "max_concurrent".
+
+        Args:
+            item: (url, save_name) tuple, dict or just an URL
+
+        Returns:
+            Optional[VideoJob]: Video job, None if the item is invalid
+        """
+        options: dict = dict()
+        if isinstance(item, dict) and isinstance(item.get("url"), str):
+            options = item
+            url, save_name = item["url"], item.get("save_name") or ""
+        elif isinstance(item, (list, tuple)) and len(item) >= 2:
+            url, save_name = item[0], item[1]
+        elif isinstance(item, str):
+            url, save_name = item, ""
+        else:
+            logger.error(f"Invalid item format: {item}")
+            return None
+
+        output = options.get("output") or ""
+        if output and not output.endswith(("/", os.sep)) and not save_name:
+            save_name = os.path.basename(output)
+        if not save_name:
+            save_name = os.path.splitext(get_url_basename(url))[0]
+        if not save_name.endswith((".mp4", ".ts")):
+            save_name = f"{save_name}.mp4"
+        job = self.new_job(url, save_name)
+        if output:
+            is_dir = output.endswith(("/", os.sep))
+            job.save_path = os.path.join(output, save_name) if is_dir else output
+        headers = dict(options.get("headers") or {})
+        if options.get("referer"):
+            headers["Referer"] = options["referer"]
+        job.headers = headers or None
+        job.max_concurrent = int(options.get("max_concurrent") or 0)
+        return job
 
     def _download_single(self, blob_url: str, save_name: str = "") -> str:
         """Internal method to download a single video
@@ -97,179 +304,518 @@ class BlobDownloader:
         Returns:
             str: Path to the downloaded video file
         """
-        # Set up instance variables for this download
-        self.blob_url = blob_url.strip()
-        self.save_name = get_url_basename(self.blob_url) if not save_name else save_name
-        self.save_path = os.path.join(self.base_save_path, self.save_name)
-        self.tmp_path = os.path.join(self.base_tmp_path, self.save_name)
-        self.url_prefix = get_url_prefix(self.blob_url)
+        from scheduler import BatchScheduler
 
-        if os.path.exists(self.save_path):
-            return self.save_path
+        job = self.new_job(blob_url, save_name)
+        if os.path.exists(job.save_path):
+            return job.save_path
+        return BatchScheduler(self, **SchedulerConfig).run_single(job)
 
-        # Create tmp directory for this specific download
-        os.makedirs(self.tmp_path, exist_ok=True)
+    def finish_job(self, job: VideoJob, video_path: str) -> str:
+        """Check the merged video and clean up temporary files
+
+        Args:
+            job (VideoJob): Finished video job
+            video_path (str): Path returned by merge_media
 
-        m3u8_file = self.load_m3u8_file()
-        local_m3u8_file, tasks = self.parse_m3u8_file(m3u8_file)
-        self.async_load_media(tasks)
-        video_path = self.merge_media(local_m3u8_file)
+        Returns:
+            str: Path to the downloaded video file
+        """
         if self.clean_tmp and os.path.exists(video_path):
-            logger.info(f"clean up tmp_path: {self.tmp_path}")
-            shutil.rmtree(self.tmp_path)
+            logger.info(f"clean up tmp_path: {job.tmp_path}")
+            shutil.rmtree(job.tmp_path)
+            if job.video_id is not None:
+                self.state.reset_segments(job.video_id)
         elif not os.path.exists(video_path):
             raise Exception("merge media failed")
+        if job.video_id is not None:
+            self.state.set_video_status(job.video_id, StateStore.STATUS_DONE)
         return video_path
 
-    def load_m3u8_file(self) -> str:
-        """Download m3u8 file to temporary directory
+    def start_job(self, job: VideoJob):
+        """Register a job in the state store and create its tmp directory
+
+        Args:
+            job (VideoJob): Video job
+        """
+        job.video_id = self.state.add_video(job.blob_url, job.save_name, job.save_path, job.headers, job.max_concurrent)
+        # a job may save its video outside base_save_path
+        os.makedirs(os.path.dirname(job.save_path), exist_ok=True)
+        if not os.path.isdir(job.tmp_path):
+            # recorded segments are gone with the directory
+            self.state.reset_segments(job.video_id)
+            os.makedirs(job.tmp_path, exist_ok=True)
+
+    def fail_job(self, job: VideoJob, error: Exception):
+        """Record a failed job in the state store
+
+        Args:
+            job (VideoJob): Video job
+            error (Exception): Reason of the failure
+        """
+        if job.video_id is not None:
+            self.state.set_video_status(job.video_id, StateStore.STATUS_FAILED, str(error))
+            # a segment file may have been removed behind the store's back, the others are kept for the retry
+            if os.path.isdir(job.tmp_path):
+                on_disk = set(os.path.join(job.tmp_path, name) for name in os.listdir(job.tmp_path))
+                self.state.recheck_segments(job.video_id, self.state.done_segments(job.video_id) - on_disk)
+
+    def record_tasks(self, job: VideoJob, tasks: list[Task]):
+        """Record the outcome of finished download tasks in the state store
+
+        Args:
+            job (VideoJob): Video job
+            tasks (list[Task]): Finished tasks, attempts since their last record are added
+        """
+        if job.video_id is None:
+            return
+        attempts = {id(task): task.attempts - task.recorded_attempts for task in tasks}
+        rejected = {id(task): task.rejected - task.recorded_rejected for task in tasks}
+        for task in tasks:
+            task.recorded_attempts = task.attempts
+            task.recorded_rejected = task.rejected
+        self.state.update_segments(
+            job.video_id,
+            (
+                (
+                    task.save_path,
+                    StateStore.STATUS_FAILED if task.error else StateStore.STATUS_DONE,
+                    task.size,
+                    attempts[id(task)],
+                    task.error,
+                )
+                for task in tasks
+                if task.parts is None
+            ),
+        )
+        # sub-ranges saved before a range request failed are kept
+        self.state.update_segments(
+            job.video_id,
+            (
+                (
+                    part.save_path,
+                    StateStore.STATUS_DONE if part.done else StateStore.STATUS_FAILED,
+                    part.size if part.done else 0,
+                    attempts[id(task)],
+                    "" if part.done else task.error,
+                )
+                for task in tasks
+                if task.parts is not None
+                for part in task.parts
+            ),
+        )
+        # checksums and corrupt bodies fetched again, see config.ValidateConfig
+        checks = []
+        for task in tasks:
+            if task.parts is None:
+                files = [(task.save_path, task.checksum)]
+            else:
+                files = [(part.save_path, part.checksum) for part in task.parts]
+            for index, (path, checksum) in enumerate(files):
+                # corrupt bodies of a range request count against its first sub-range
+                count = rejected[id(task)] if index == 0 else 0
+                if checksum or count:
+                    checks.append((path, checksum, count))
+        if checks:
+            self.state.update_checks(job.video_id, checks)
+
+    def m3u8_task(self, job: VideoJob) -> Tuple[str, Optional[Task]]:
+        """Get local m3u8 path and the task to download it
+
+        Args:
+            job (VideoJob): Video job
 
         Returns:
-            str: Path to downloaded m3u8 file
+            str: Path to m3u8 file
+            Optional[Task]: Task to download m3u8 file, None if it is already downloaded
         """
-        m3u8_file = os.path.join(self.tmp_path, get_url_basename(self.blob_url))
+        if job.media_url == job.blob_url:
+            m3u8_file = os.path.join(job.tmp_path, get_url_basename(job.blob_url))
+        else:
+            m3u8_file = os.path.join(job.tmp_path, "variant-" + get_url_basename(job.media_url))
         if os.path.exists(m3u8_file):
-            return m3u8_file
-        task = Task(self.blob_url, m3u8_file)
-        result = self.downloader.run(tasks=[task], desc="downloading m3u8 file")
+            return m3u8_file, None
+        return m3u8_file, Task(job.media_url, m3u8_file, headers=job.headers, validate=False)
+
+    def load_variant(self, job: VideoJob) -> bool:
+        """Restore the variant selected by a previous run, a resumed video must not mix variants
 
-        if len(result) == 0 or result[0] is False:
-            raise Exception("failed to download m3u8 file")
-        return m3u8_file
+        Args:
+            job (VideoJob): Video job whose blob_url is a master playlist
+
+        Returns:
+            bool: True if a variant was selected before, job.media_url is set to it
+        """
+        variant_file = os.path.join(job.tmp_path, "variant.url")
+        if not os.path.exists(variant_file):
+            return False
+        with open(variant_file, "r") as fp:
+            job.media_url = fp.read().strip()
+        return bool(job.media_url)
+
+    def use_variant(self, job: VideoJob, variant: Variant):
+        """Download a variant of a master playlist and remember it for resumed runs
 
-    def parse_m3u8_file(self, m3u8_file: str) -> Tuple[str, list[Task]]:
+        Args:
+            job (VideoJob): Video job whose blob_url is a master playlist
+            variant (Variant): Selected variant
+        """
+        logger.info(f"[{job.save_name}] variant: {variant.bandwidth} bps, resolution: {variant.resolution}")
+        job.media_url = variant.url
+        with open(os.path.join(job.tmp_path, "variant.url"), "w") as fp:
+            fp.write(variant.url + "\n")
+
+    def parse_m3u8_file(self, job: VideoJob, m3u8_file: str) -> Tuple[str, list[Task]]:
         """Parse m3u8 file and generate local m3u8 file with local paths
 
         Args:
+            job (VideoJob): Video job
             m3u8_file (str): Path to downloaded m3u8 file
 
         Returns:
             str: Path to local m3u8 file
             list[Task]: List of tasks to download media files
         """
-        local_m3u8_file = os.path.join(self.tmp_path, "local.m3u8")
-        local_m3u8 = open(local_m3u8_file, "w")
-
-        tasks = []
-        total_count = 0
-        raw_m3u8 = open(m3u8_file, "r")
-        for line in raw_m3u8.readlines():
-            if line.startswith("#"):
-                ts_url, line = self.parse_meta_data(line)
+        playlist = load_playlist(m3u8_file, job.media_url)
+        if playlist.is_master:
+            raise PlaylistError(f"a variant of the master playlist must be selected first: {job.media_url}")
+        local_m3u8_file = os.path.join(job.tmp_path, "local.m3u8")
+
+        entries: list[Tuple[str, str]] = []
+        # save path of every URL, URLs with the same basename get distinct files
+        save_paths: Dict[str, str] = dict()
+        used_paths = {m3u8_file, local_m3u8_file}
+        # keys decrypted while downloading
+        aes_keys: Dict[str, AESKey] = dict()
+        encryption: Dict[str, Tuple[AESKey, bytes]] = dict()
+        # key files and segments left encrypted for ffmpeg, their bytes cannot be validated
+        unchecked: set[str] = set()
+
+        def save_path_of(url: str) -> str:
+            save_path = save_paths.get(url)
+            if save_path is None:
+                save_path = self.get_media_save_path(job, url)
+                if save_path in used_paths:
+                    name, ext = os.path.splitext(save_path)
+                    save_path = f"{name}-{len(used_paths)}{ext}"
+                save_paths[url] = save_path
+                used_paths.add(save_path)
+                entries.append((url, save_path))
+            return save_path
+
+        # sub-ranges are saved to files of their own, (length, offset) of every such file
+        byteranges: Dict[str, Tuple[int, int]] = dict()
+        range_paths: Dict[Tuple[str, Tuple[int, int]], str] = dict()
+
+        def range_path_of(url: str, byterange: Tuple[int, int]) -> str:
+            save_path = range_paths.get((url, byterange))
+            if save_path is None:
+                name, ext = os.path.splitext(self.get_media_save_path(job, url))
+                save_path = f"{name}.{byterange[1]}-{byterange[1] + byterange[0]}{ext}"
+                if save_path in used_paths:
+                    save_path = f"{name}.{byterange[1]}-{byterange[1] + byterange[0]}-{len(used_paths)}{ext}"
+                range_paths[(url, byterange)] = save_path
+                byteranges[save_path] = byterange
+                used_paths.add(save_path)
+                entries.append((url, save_path))
+            return save_path
+
+        job.segment_paths = []
+        # only whole MPEG-TS segments can be concatenated while downloading
+        job.streamable = True
+        lines = ["#EXTM3U", *playlist.header]
+        # key and init section in effect in the local playlist
+        local_key: Optional[Key] = None
+        local_init: Optional[InitSection] = None
+        for segment in playlist.segments:
+            key = segment.key
+            aes_key = self.decrypt_key(job, key, aes_keys) if key is not None else None
+            if aes_key is not None:
+                # decrypted while downloading, the local playlist points to cleartext
+                key = None
+            if key is not local_key:
+                if key is None:
+                    lines.append("#EXT-X-KEY:METHOD=NONE")
+                else:
+                    job.streamable = False
+                    key_line = key.line
+                    if key.uri:
+                        key_line = key_line.replace(f'URI="{key.uri}"', f'URI="{save_path_of(key.url)}"')
+                        unchecked.add(save_path_of(key.url))
+                    lines.append(key_line)
+                local_key = key
+            if segment.init is not local_init:
+                job.streamable = False
+                init = segment.init
+                if init.byterange is not None:
+                    lines.append(f'#EXT-X-MAP:URI="{range_path_of(init.url, init.byterange)}"')
+                else:
+                    lines.append(init.line.replace(f'URI="{init.uri}"', f'URI="{save_path_of(init.url)}"'))
+                local_init = init
+            if segment.discontinuity:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append(f"#EXTINF:{segment.duration},")
+            if segment.byterange is not None:
+                save_path = range_path_of(segment.url, segment.byterange)
             else:
-                ts_url, line = self.parse_media_segment(line)
-            local_m3u8.write(line)
-            if not ts_url:
+                save_path = save_path_of(segment.url)
+            lines.append(save_path)
+            job.segment_paths.append(save_path)
+            if key is not None:
+                unchecked.add(save_path)
+            if aes_key is not None and save_path not in encryption:
+                # without an explicit IV, the media sequence number of the segment is the IV
+                iv = parse_iv(segment.key.iv) if segment.key.iv else sequence_iv(segment.sequence)
+                encryption[save_path] = (aes_key, iv)
+        lines.append("#EXT-X-ENDLIST")
+        with open(local_m3u8_file, "w") as local_m3u8:
+            local_m3u8.write("\n".join(lines) + "\n")
+
+        done = self.downloaded_paths(job, entries)
+        job.cached_files = 0
+        if self.cache is not None:
+            missing = [(url, path) for url, path in entries if path not in done]
+            cached = self.cached_paths(job, missing, byteranges, encryption)
+            job.cached_files = len(cached)
+            done |= cached
+        tasks = []
+        # task of the range request still growing, by URL and key
+        range_tasks: Dict[Tuple[str, Optional[AESKey]], Task] = dict()
+        for ts_url, save_path in entries:
+            if save_path in done:
                 continue
-            total_count += 1
-            save_path = self.get_media_save_path(ts_url)
-            if os.path.exists(save_path):
+            aes_key, iv = encryption.get(save_path, (None, None))
+            byterange = byteranges.get(save_path)
+            if byterange is None:
+                task = Task(ts_url, save_path, job.save_name, aes_key, iv, headers=job.headers)
+                task.validate = save_path not in unchecked
+                tasks.append(task)
                 continue
-            tasks.append(Task(ts_url, save_path))
-        logger.info(f"total: {total_count}, need to download: {len(tasks)}")
+            part = TaskPart(byterange[1], byterange[0], save_path, iv)
+            task = range_tasks.get((ts_url, aes_key))
+            if task is None or not self.joins_range(task.parts, part):
+                task = Task(ts_url, save_path, job.save_name, aes_key, parts=[], headers=job.headers)
+                task.validate = save_path not in unchecked
+                range_tasks[(ts_url, aes_key)] = task
+                tasks.append(task)
+            task.parts.append(part)
+        logger.info(
+            f"[{job.save_name}] total: {len(entries)}, cached: {job.cached_files}, need to download: {len(tasks)}"
+        )
         return local_m3u8_file, tasks
 
-    def async_load_media(self, tasks: list[Task]):
-        """Download media files asynchronously
+    def joins_range(self, parts: list[TaskPart], part: TaskPart) -> bool:
+        """Whether a sub-range can be fetched in the same range request as the sub-ranges before it
+
+        Args:
+            parts (list[TaskPart]): Sub-ranges of the request so far, sorted by offset
+            part (TaskPart): Next sub-range of the same URL
+
+        Returns:
+            bool: True if it starts after the last one, close enough and within the request size limit
+        """
+        end = parts[-1].offset + parts[-1].length
+        return (
+            end <= part.offset <= end + self.range_config["max_gap"]
+            and part.offset + part.length - parts[0].offset <= self.range_config["max_request_size"]
+        )
+
+    def decrypt_key(self, job: VideoJob, key: Key, aes_keys: Dict[str, AESKey]) -> Optional[AESKey]:
+        """Get the key of segments decrypted while downloading
 
         Args:
-            tasks (list[Task]): List of tasks to download media files
+            job (VideoJob): Video job
+            key (Key): Key of the segments in the playlist
+            aes_keys (Dict[str, AESKey]): Keys of the video by URL, a key used again is shared
+
+        Returns:
+            Optional[AESKey]: Key to decrypt with, None if left to ffmpeg (SAMPLE-AES, other key formats, no cryptography)
         """
-        results = self.downloader.run(tasks=tasks, desc="downloading media files")
-        failed_count = len([r for r in results if not r])
-        assert (
-            failed_count == 0
-        ), f"""
-        total task: {len(tasks)}, failed task: {failed_count}
-        Please check error and retry again, some media are still not downloaded yet.
+        if not self.decrypt or key.method != "AES-128" or key.key_format != "identity" or not key.url:
+            return None
+        aes_key = aes_keys.get(key.url)
+        if aes_key is None:
+            # named after the key URL, a rotated key or a reused tmp path never finds the file of another key
+            name = hashlib.sha1(key.url.encode()).hexdigest()[:16]
+            aes_key = aes_keys[key.url] = AESKey(key.url, os.path.join(job.tmp_path, f"key-{name}.bin"))
+        return aes_key
+
+    def downloaded_paths(self, job: VideoJob, entries: list[Tuple[str, str]]) -> set[str]:
+        """Find which files of a video are already downloaded
+
+        The state store answers with one query, files it does not know about
+        (e.g. finished right before a crash) are found with one directory scan.
+
+        Args:
+            job (VideoJob): Video job
+            entries (list[Tuple[str, str]]): (url, save_path) of the files of the video
+
+        Returns:
+            set[str]: Paths of the downloaded files
         """
-        logger.info("download media success!")
+        done = set()
+        if job.video_id is not None:
+            # a resumed video usually has all its segments registered already
+            if self.state.segment_count(job.video_id) != len(entries):
+                self.state.add_segments(job.video_id, entries)
+            done = self.state.done_segments(job.video_id)
+        on_disk: Optional[set[str]] = None
+        if self.max_tmp_size > 0 and done:
+            # segments are removed once assembled, and the assembled output is lost with an interrupted run
+            on_disk = set(os.path.join(job.tmp_path, name) for name in os.listdir(job.tmp_path))
+            done &= on_disk
+        unknown = [(url, path) for url, path in entries if path not in done]
+        if not unknown:
+            return done
+        if on_disk is None:
+            # part files are unfinished downloads and never match a save path
+            on_disk = set(os.path.join(job.tmp_path, name) for name in os.listdir(job.tmp_path))
+        found = [(url, path) for url, path in unknown if path in on_disk]
+        if found and job.video_id is not None:
+            self.state.update_segments(
+                job.video_id,
+                ((path, StateStore.STATUS_DONE, 0, 0, "") for url, path in found),
+            )
+        return done | set(path for url, path in found)
+
+    def cached_paths(
+        self,
+        job: VideoJob,
+        entries: list[Tuple[str, str]],
+        byteranges: Dict[str, Tuple[int, int]],
+        encryption: Dict[str, Tuple[AESKey, bytes]],
+    ) -> set[str]:
+        """Link the files of a video found in the segment cache into its tmp directory
+
+        Args:
+            job (VideoJob): Video job
+            entries (list[Tuple[str, str]]): (url, save_path) of the files not downloaded yet
+            byteranges (Dict[str, Tuple[int, int]]): (length, offset) of the files of sub-ranges
+            encryption (Dict[str, Tuple[AESKey, bytes]]): Key and IV of the files decrypted while downloading
 
-    def merge_media(self, local_m3u8_file: str) -> str:
-        """Merge media files into a single video file using ffmpeg
+        Returns:
+            set[str]: Paths of the files taken from the cache
+        """
+        keys = dict()
+        for url, save_path in entries:
+            aes_key, iv = encryption.get(save_path, (None, None))
+            keys[save_path] = self.cache.key(url, byteranges.get(save_path), aes_key.url if aes_key else "", iv)
+        found = self.cache.fetch(keys)
+        if found and job.video_id is not None:
+            self.state.update_segments(
+                job.video_id,
+                ((path, StateStore.STATUS_DONE, size, 0, "") for path, size in found.items()),
+            )
+        return set(found)
+
+    def cache_key(self, task: Task) -> Optional[str]:
+        """Segment cache key of a task downloading a whole file
 
         Args:
-            local_m3u8_file (str): Path to local m3u8 file with local media paths
+            task (Task): Download task
+
+        Returns:
+            Optional[str]: Cache key, None without a cache or for a task of sub-ranges
         """
-        logger.info("ffmpeg is merging...")
-        cmd = """
-        ffmpeg \
-        -extension_picky false \
-        -allowed_segment_extensions ALL \
-        -protocol_whitelist "file,http,https,tcp,tls,crypto" \
-        -allowed_extensions ALL \
-        -i "{}" \
-        -c copy "{}" \
-        -loglevel quiet \
-        -y
-        """.format(
-            local_m3u8_file, self.save_path
-        )
-        os.system(cmd)
-        logger.info(f"finished download blob video! {self.save_path}")
-        return self.save_path
+        if self.cache is None or task.parts is not None:
+            return None
+        return self.cache.key(task.url, None, task.key.url if task.key is not None else "", task.iv)
 
-    def parse_meta_data(self, line: str) -> Tuple[str, str]:
-        """Parse metadata line to extract key URL and modified line
+    def cache_task(self, task: Task):
+        """Add the files of a finished download task to the segment cache
 
         Args:
-            line (str): Metadata line from m3u8 file
+            task (Task): Successful task
+        """
+        if self.cache is None:
+            return
+        key_url = task.key.url if task.key is not None else ""
+        try:
+            if task.parts is None:
+                self.cache.store(self.cache_key(task), task.url, task.save_path)
+                return
+            for part in task.parts:
+                key = self.cache.key(task.url, (part.length, part.offset), key_url, part.iv)
+                self.cache.store(key, task.url, part.save_path)
+        except OSError as e:
+            # the download itself succeeded
+            logger.warning(f"failed to cache {task.url}: {e}")
+
+    def merge_media(self, job: VideoJob, local_m3u8_file: str) -> str:
+        """Merge media files into a single video file, concatenated or with ffmpeg
+
+        Args:
+            job (VideoJob): Video job
+            local_m3u8_file (str): Path to local m3u8 file with local media paths
 
         Returns:
-            Tuple[str, str]: Key URL and modified line
+            str: Path to the merged video file
+
+        Raises:
+            MergeError: if ffmpeg is missing or failed
         """
-        search_res = re.search(r'URI="(.+?)"', line)
-        if not search_res:
-            return "", line
-        key_ts = search_res.group(1)
-        if "/" not in key_ts:
-            key_ts_path, key_ts_name = None, key_ts
-            key_url = f"{self.url_prefix}/{key_ts_name}"
+        merged_path = self.merged_path(job)
+        if self.can_concat(job):
+            concat_segments(job.segment_paths, merged_path)
         else:
-            # todo can't cover all cases
-            key_ts_path, key_ts_name = key_ts.rsplit("/", 1)
-            if key_ts_path not in self.url_prefix:
-                key_url = f"{self.url_prefix}/{key_ts}"
-            else:
-                part_prefix = self.url_prefix.split(key_ts_path)[0]
-                key_url = f"{part_prefix}/{key_ts}"
-        clean_key_ts_name = key_ts_name.split("?")[0]
-        key_line = line.replace(key_ts, f"{self.tmp_path}/{clean_key_ts_name}")
-        return key_url, key_line
+            logger.info("ffmpeg is merging...")
+            run_ffmpeg(local_m3u8_file, merged_path)
+        return self.move_merged(job, merged_path)
 
-    def parse_media_segment(self, line: str) -> Tuple[str, str]:
-        """Parse media segment line to extract media URL and modified line
+    async def async_merge_media(self, job: VideoJob, local_m3u8_file: str) -> str:
+        """Merge media files into a single video file without blocking the event loop
+
+        ffmpeg runs as a subprocess awaited by the loop, a concatenation in a
+        worker thread, so downloads of other videos go on meanwhile.
 
         Args:
-            line (str): Media segment line from m3u8 file
+            job (VideoJob): Video job
+            local_m3u8_file (str): Path to local m3u8 file with local media paths
 
         Returns:
-            Tuple[str, str]: URL and local path
+            str: Path to the merged video file
+
+        Raises:
+            MergeError: if ffmpeg is missing or failed
         """
-        if line.startswith("http"):
-            ts_url = line.rstrip()
+        merged_path = self.merged_path(job)
+        if self.can_concat(job):
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, concat_segments, job.segment_paths, merged_path)
         else:
-            ts_line = line.rstrip()
-            if "/" in ts_line:
-                path, name = ts_line.rsplit("/", 1)
-            else:
-                path, name = "", ts_line
-            if path not in self.url_prefix:
-                ts_url = f"{self.url_prefix}/{ts_line}"
-            else:
-                ts_url = f"{self.url_prefix}/{name}"
-        file_name = get_url_basename(ts_url)
-        local_line = os.path.join(self.tmp_path, file_name) + "\n"
-        return ts_url, local_line
+            logger.info("ffmpeg is merging...")
+            await async_run_ffmpeg(local_m3u8_file, merged_path)
+        return self.move_merged(job, merged_path)
+
+    def can_concat(self, job: VideoJob) -> bool:
+        """Whether the segments of a job make the video by plain concatenation, without ffmpeg
+
+        Only whole cleartext MPEG-TS segments saved to a .ts output do, ffmpeg
+        decrypts, reads init sections and remuxes to other containers.
+        """
+        return job.streamable and bool(job.segment_paths) and job.save_path.endswith(".ts")
+
+    def merged_path(self, job: VideoJob) -> str:
+        """Path the video is merged to, next to the segments so an interrupted merge never looks finished"""
+        return os.path.join(job.tmp_path, "merged" + os.path.splitext(job.save_path)[1])
+
+    def move_merged(self, job: VideoJob, merged_path: str) -> str:
+        """Move a merged video to its save path"""
+        if os.path.exists(merged_path):
+            shutil.move(merged_path, job.save_path)
+        logger.info(f"finished download blob video! {job.save_path}")
+        return job.save_path
 
-    def get_media_save_path(self, url: str) -> str:
+    def get_media_save_path(self, job: VideoJob, url: str) -> str:
         """Get media save path
 
         Args:
+            job (VideoJob): Video job
             url (str): Media URL
 
         Returns:
             str: Media save path
         """
-        save_name = get_url_basename(url)
-        return os.path.join(self.tmp_path, save_name)
+        # same as os.path.join(job.tmp_path, get_url_basename(url)), called for every segment
+        save_name = url.split("?", 1)[0].rsplit("/", 1)[-1]
+        return job.tmp_path + os.sep + save_name
@@ -0,0 +1,81 @@
+from typing import Optional
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # decryption is left to ffmpeg
+    Cipher = None
+
+AES_BLOCK_SIZE = 16
+
+
+def decrypt_available() -> bool:
+    """Whether segments can be decrypted in-process, which needs the cryptography package"""
+    return Cipher is not None
+
+
+class AESKey:
+    """AESKey is an AES-128 key of a video, shared by all the segments it encrypts"""
+
+    __slots__ = ("url", "path")
+
+    def __init__(self, url: str, path: str) -> None:
+        self.url = url
+        # the key file is kept next to the segments, so a resumed video does not fetch it again
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"AESKey({self.url})"
+
+
+def sequence_iv(sequence: int) -> bytes:
+    """Get the IV of a segment without an explicit IV, its media sequence number as a 128-bit big-endian integer"""
+    return sequence.to_bytes(AES_BLOCK_SIZE, "big")
+
+
+def parse_iv(value: str) -> bytes:
+    """Parse the hexadecimal IV attribute of an EXT-X-KEY tag, e.g. 0x00000000000000000000000000000001"""
+    value = value[2:] if value[:2].lower() == "0x" else value
+    return bytes.fromhex(value.rjust(AES_BLOCK_SIZE * 2, "0"))
+
+
+class SegmentDecryptor:
+    """SegmentDecryptor decrypts an AES-128-CBC segment chunk by chunk as it is downloaded.
+
+    Without an IV, the first block of the data is used as IV: a download
+    resumed at `offset` requests the data from `offset - 16`, the last
+    ciphertext block before the bytes already decrypted on disk.
+    """
+
+    def __init__(self, key: bytes, iv: Optional[bytes] = None):
+        """Initialize segment decryptor
+
+        Args:
+            key (bytes): 16-byte AES key
+            iv (bytes, optional): 16-byte IV, None to take it from the first block of the data. Defaults to None.
+        """
+        self.key = key
+        self.head = b""
+        self.decryptor = None if iv is None else Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        self.unpadder = padding.PKCS7(AES_BLOCK_SIZE * 8).unpadder()
+
+    def update(self, data: bytes) -> bytes:
+        """Decrypt the next chunk, the cleartext returned is always a whole number of blocks"""
+        if self.decryptor is None:
+            self.head += data
+            if len(self.head) < AES_BLOCK_SIZE:
+                return b""
+            iv, data, self.head = self.head[:AES_BLOCK_SIZE], self.head[AES_BLOCK_SIZE:], b""
+            self.decryptor = Cipher(algorithms.AES(self.key), modes.CBC(iv)).decryptor()
+        # the unpadder holds back the last block until it knows it is not the padding
+        return self.unpadder.update(self.decryptor.update(data))
+
+    def finalize(self) -> bytes:
+        """Decrypt what is left and remove the padding
+
+        Raises:
+            ValueError: if the data is not a whole number of blocks or the padding is invalid, e.g. with a wrong key
+        """
+        if self.decryptor is None:
+            raise ValueError("encrypted data shorter than one block")
+        return self.unpadder.update(self.decryptor.finalize()) + self.unpadder.finalize()
@@ -1,11 +1,66 @@
+import os
+import re
 import aiohttp
 import asyncio
+import time
 import traceback
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 from log import logger
-from typing import List
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sized,
+    Tuple,
+    Union,
+)
 from rich.progress import TaskID
-from progress import files_progress
-from config import GetConfig, ConnectorConfig, HeaderConfig
+from progress import FileTransfer, TransferProgress
+from limiter import AdaptiveLimiter, FixedLimiter
+from hedge import HedgePolicy
+from retry import CircuitBreaker, RetryPolicy, parse_retry_after
+from metrics import Metrics, SegmentMetric, pool_wait_trace_config
+from fileio import BufferPool, BufferedFileWriter, preallocate
+from decrypt import AES_BLOCK_SIZE, AESKey, SegmentDecryptor
+from validate import CorruptSegmentError, SegmentValidator
+from config import (
+    GetConfig,
+    ConnectorConfig,
+    HedgeConfig,
+    HeaderConfig,
+    IOConfig,
+    ProgressConfig,
+    RetryConfig,
+    ValidateConfig,
+)
+
+
+class TaskPart:
+    """TaskPart is one EXT-X-BYTERANGE sub-range of a task, saved to a file of its own"""
+
+    __slots__ = ("offset", "length", "save_path", "iv", "done", "size", "checksum")
+
+    def __init__(self, offset: int, length: int, save_path: str, iv: Optional[bytes] = None) -> None:
+        self.offset = offset
+        self.length = length
+        self.save_path = save_path
+        # IV of an encrypted sub-range, every sub-range is encrypted on its own
+        self.iv = iv
+        self.done = False
+        # size of the saved file, smaller than length once decrypted
+        self.size = 0
+        # checksum of the saved file, see config.ValidateConfig
+        self.checksum = ""
+
+    def __repr__(self) -> str:
+        return f"TaskPart({self.offset}, {self.length}, {self.save_path})"
 
 
 class Task:
@@ -13,113 +68,732 @@ class Task:
 
     url: str
     save_path: str
+    # name of the video the task belongs to, used to label metrics
+    video: str
+    # AES-128 key and IV of an encrypted segment, decrypted while downloading
+    key: Optional[AESKey]
+    iv: Optional[bytes]
+    # sub-ranges of the URL fetched with a single Range request, None for the whole file
+    parts: Optional[List[TaskPart]]
+    # request headers of the video on top of the session's, e.g. a Referer
+    headers: Optional[Dict[str, str]]
+    # whether the body is checked as a segment, not for keys or segments saved encrypted
+    validate: bool
+    # filled by the downloader once the task finished
+    size: int
+    attempts: int
+    error: str
+    checksum: str
+    # bodies that failed validation and were fetched again
+    rejected: int
+    # attempts and rejected bodies already recorded in the state store, a task may be recorded again after a final pass
+    recorded_attempts: int
+    recorded_rejected: int
 
-    def __init__(self, url: str, save_path: str) -> None:
+    def __init__(
+        self,
+        url: str,
+        save_path: str,
+        video: str = "",
+        key: Optional[AESKey] = None,
+        iv: Optional[bytes] = None,
+        parts: Optional[List[TaskPart]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        validate: bool = True,
+    ) -> None:
         self.url = url
         self.save_path = save_path
+        self.video = video
+        self.key = key
+        self.iv = iv
+        self.parts = parts
+        self.headers = headers
+        self.validate = validate
+        self.size = 0
+        self.attempts = 0
+        self.error = ""
+        self.checksum = ""
+        self.rejected = 0
+        self.recorded_attempts = 0
+        self.recorded_rejected = 0
+
+    @property
+    def save_paths(self) -> List[str]:
+        """Files written by the task, one per part of a range request"""
+        if self.parts is None:
+            return [self.save_path]
+        return [part.save_path for part in self.parts]
+
+
+TaskSource = Union[Iterable[Task], AsyncIterable[Task]]
 
 
 class DownloadError(Exception):
     """Custom exception for download failures"""
 
-    def __init__(self, url: str, message: str, retry_count: int = 0):
+    def __init__(self, url: str, message: str, retry_count: int = 0, status: int = 0, retry_after: float = 0.0):
         self.url = url
         self.message = message
         self.retry_count = retry_count
+        self.status = status
+        # seconds the server asked to wait with Retry-After, 0 if it did not
+        self.retry_after = retry_after
         super().__init__(f"Download failed for {url}: {message} (retries: {retry_count})")
 
 
+class IncompleteDownloadError(Exception):
+    """Raised when a response ended before the expected size, the part file is kept to resume"""
+
+
+def error_kind(e: Exception) -> str:
+    """Classify a request failure for the concurrency limiter
+
+    Args:
+        e: exception raised by the request
+
+    Returns:
+        str: "timeout", "disconnect", "throttle" or "error"
+    """
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, (aiohttp.ServerDisconnectedError, aiohttp.ClientPayloadError, aiohttp.ClientOSError)):
+        return "disconnect"
+    if isinstance(e, DownloadError) and (e.status == 429 or e.status >= 500):
+        # the server or a proxy in front of it is overloaded
+        return "throttle"
+    return "error"
+
+
+def is_retryable(e: Exception, retry_statuses: Iterable[int]) -> bool:
+    """Tell a request failure worth retrying from a fatal one
+
+    Args:
+        e: exception raised by the request
+        retry_statuses: HTTP statuses worth retrying
+
+    Returns:
+        bool: True for timeouts, connection errors, incomplete or corrupt bodies and retryable statuses
+    """
+    if isinstance(e, DownloadError):
+        return e.status in retry_statuses
+    return isinstance(
+        e,
+        (
+            asyncio.TimeoutError,
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            IncompleteDownloadError,
+            CorruptSegmentError,
+        ),
+    )
+
+
+def error_name(e: Exception) -> str:
+    """Name the class of a request failure for metrics
+
+    Args:
+        e: exception raised by the request
+
+    Returns:
+        str: "HTTP <status>" for bad statuses, the exception class name otherwise
+    """
+    if isinstance(e, DownloadError) and e.status:
+        return f"HTTP {e.status}"
+    return type(e).__name__
+
+
 class Downloader:
-    def __init__(self, max_concurrent: int = 20, max_retry: int = 3):
+    def __init__(
+        self,
+        max_concurrent: int = 20,
+        max_retry: int = 3,
+        adaptive: bool = False,
+        hedge: bool = False,
+        metrics: Optional[Metrics] = None,
+    ):
         """Initialize downloader with configuration parameters
 
         Args:
             max_concurrent (int, optional): Maximum concurrent downloads. Defaults to 20.
             max_retry (int, optional): Maximum retry attempts for failed downloads. Defaults to 3.
+            adaptive (bool, optional): Adjust concurrent downloads of every host at runtime, up to max_concurrent for all hosts together. Defaults to False.
+            hedge (bool, optional): Send a duplicate request for very slow downloads. Defaults to False.
+            metrics (Metrics, optional): Where measurements of every download go. Defaults to an in-memory summary.
         """
-        self.sem = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.adaptive = adaptive
+        self.limiter = AdaptiveLimiter(max_concurrent) if adaptive else FixedLimiter(max_concurrent)
+        if not adaptive and 0 < ConnectorConfig.get("limit", 100) < max_concurrent:
+            logger.warning(
+                f"connection limit {ConnectorConfig['limit']} is lower than max_concurrent {max_concurrent}, "
+                "extra downloads wait for a free connection"
+            )
         self.max_retry = max_retry
-        self.progress = files_progress
-        self.lock = asyncio.Lock()
+        self.retry_config = dict(RetryConfig)
+        self.retry_policy = RetryPolicy(
+            self.retry_config["base_delay"],
+            self.retry_config["max_delay"],
+            self.retry_config["retry_statuses"],
+            self.retry_config["max_retry_after"],
+        )
+        self.breaker = CircuitBreaker(self.retry_config["breaker_failures"], self.retry_config["breaker_cooldown"])
+        # duplicate requests for stragglers, see config.HedgeConfig
+        self.hedging = HedgePolicy(**HedgeConfig) if hedge else None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.trace_config = pool_wait_trace_config()
+        self.io_config = dict(IOConfig)
+        self.validate_config = dict(ValidateConfig)
+        self.buffers = BufferPool(max(self.io_config["write_buffer_size"], 1), max_free=max_concurrent * 2)
+        self.progress = TransferProgress(**ProgressConfig)
+        # AES keys by key file path, named after the key URL, fetched once per video however many segments use them
+        self.keys: Dict[str, asyncio.Future] = dict()
+        # long-lived session between open and close, every run opens its own otherwise
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "Downloader":
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self) -> aiohttp.ClientSession:
+        """Open the session shared by every following run until close
+
+        Its connection pool keeps connections alive and DNS answers cached
+        between runs, so playlists, segments and videos of the same host skip
+        new TCP and TLS handshakes.
+
+        Returns:
+            aiohttp.ClientSession: Shared session
+        """
+        if self.session is None or self.session.closed:
+            self.session = self.init_session()
+        return self.session
+
+    async def close(self):
+        """Close the shared session and its connections"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @asynccontextmanager
+    async def session_scope(self) -> AsyncIterator[aiohttp.ClientSession]:
+        """Session of a run, the shared one when open, otherwise one closed when the run ends"""
+        if self.session is not None and not self.session.closed:
+            yield self.session
+            return
+        async with self.init_session() as session:
+            yield session
+
+    def new_validator(self) -> Optional[SegmentValidator]:
+        """Validator of a segment body, None when validation is disabled, see config.ValidateConfig"""
+        if not self.validate_config["enabled"]:
+            return None
+        return SegmentValidator(self.validate_config["checksum"])
 
     def run(
         self,
-        tasks: List[Task],
+        tasks: TaskSource,
         desc: str = "downloading",
     ) -> List[bool]:
         """
         Run download tasks synchronously.
 
         Args:
-            tasks: List of download tasks
+            tasks: List, lazy iterable or async iterator of download tasks
             desc: Description for progress bar
 
         Returns:
-            List[bool]: List of results, True for successful downloads, False for failed downloads
+            List[bool]: List of results in task order, True for successful downloads, False for failed downloads
         """
-        if not tasks:
+        if isinstance(tasks, Sized) and len(tasks) == 0:
             return list()
         loop = asyncio.get_event_loop()
-        task_id = self.progress.add_task(description=desc, total=len(tasks))
-        result = loop.run_until_complete(self.async_run(task_id, tasks))
-        return result
+        return loop.run_until_complete(self.async_run(tasks, desc))
+
+    def run_iter(
+        self,
+        tasks: TaskSource,
+        desc: str = "downloading",
+    ) -> Iterator[Tuple[Task, bool]]:
+        """
+        Run download tasks synchronously, yielding each task with its result as soon as it finished.
+
+        Tasks are pulled from `tasks` only when a worker is free, so memory
+        does not grow with the number of tasks.
+
+        Args:
+            tasks: List, lazy iterable or async iterator of download tasks
+            desc: Description for progress bar
+
+        Yields:
+            Tuple[Task, bool]: finished task and its result
+        """
+        loop = asyncio.get_event_loop()
+        stream = self.async_stream(tasks, desc)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(stream.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(stream.aclose())
 
     async def async_run(
         self,
-        task_id: TaskID,
-        Tasks: List[Task],
+        Tasks: TaskSource,
+        desc: str = "downloading",
     ) -> List[bool]:
         """
         Run download tasks asynchronously.
 
         Args:
-            Tasks: List of download tasks
+            Tasks: List, lazy iterable or async iterator of download tasks
+            desc: Description for progress bar
 
         Returns:
-            List[bool]: List of results, True for successful downloads, False for failed downloads
+            List[bool]: List of results in task order, True for successful downloads, False for failed downloads
         """
-        assert len(Tasks) > 0, "Tasks should not be empty"
-        with self.progress:
-            # make sure session close after all request
-            async with self.init_session() as session:
-                tasks = []
-                for task_item in Tasks:
-                    task = asyncio.create_task(
-                        self._safe_fetch_url(
-                            session=session,
-                            task_id=task_id,
-                            url=task_item.url,
-                            save_path=task_item.save_path,
-                        )
-                    )
-                    tasks.append(task)
-                result = await asyncio.gather(*tasks)
+        results: Dict[int, bool] = dict()
+        total = len(Tasks) if isinstance(Tasks, Sized) else None
+        task_id = self.progress.add_task(description=desc, total=total)
+        try:
+            with self.progress:
+                async with self.session_scope() as session:
+                    async for index, _, result in self._pool(session, task_id, Tasks):
+                        results[index] = result
+        finally:
+            self.progress.remove_task(task_id)
+        return [results[index] for index in range(len(results))]
+
+    async def async_stream(
+        self,
+        Tasks: TaskSource,
+        desc: str = "downloading",
+    ) -> AsyncIterator[Tuple[Task, bool]]:
+        """
+        Run download tasks asynchronously, yielding each task with its result as soon as it finished.
+
+        Args:
+            Tasks: List, lazy iterable or async iterator of download tasks
+            desc: Description for progress bar
+
+        Yields:
+            Tuple[Task, bool]: finished task and its result
+        """
+        total = len(Tasks) if isinstance(Tasks, Sized) else None
+        task_id = self.progress.add_task(description=desc, total=total)
+        try:
+            with self.progress:
+                async with self.session_scope() as session:
+                    async for _, task, result in self._pool(session, task_id, Tasks):
+                        yield task, result
+        finally:
+            self.progress.remove_task(task_id)
+
+    async def fetch_tasks(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        Tasks: TaskSource,
+        callback: Optional[Callable[[Task, bool], Awaitable[None]]] = None,
+        max_workers: int = 0,
+    ) -> List[bool]:
+        """
+        Download tasks with an already opened session.
+
+        All callers share the downloader's limiter, so tasks of several
+        videos fetched at the same time still respect max_concurrent.
+
+        Args:
+            session: aiohttp session
+            task_id: progress task ID
+            Tasks: List, lazy iterable or async iterator of download tasks
+            callback: coroutine function awaited with each task and its result once it finished
+            max_workers: tasks of this call downloading at the same time at most, 0 for max_concurrent
+
+        Returns:
+            List[bool]: List of results in task order, True for successful downloads, False for failed downloads
+        """
+        results: Dict[int, bool] = dict()
+        async for index, _, result in self._pool(session, task_id, Tasks, callback, max_workers):
+            results[index] = result
+        return [results[index] for index in range(len(results))]
+
+    async def fetch_stream(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        Tasks: TaskSource,
+        callback: Optional[Callable[[Task, bool], Awaitable[None]]] = None,
+        max_workers: int = 0,
+    ) -> AsyncIterator[Tuple[Task, bool]]:
+        """
+        Download tasks with an already opened session, yielding each task with its result as soon as it finished.
+
+        Unlike fetch_tasks, no result is kept, so an endless task source runs in constant memory.
+
+        Args:
+            session: aiohttp session
+            task_id: progress task ID
+            Tasks: List, lazy iterable or async iterator of download tasks
+            callback: coroutine function awaited with each task and its result once it finished
+            max_workers: tasks of this call downloading at the same time at most, 0 for max_concurrent
+
+        Yields:
+            Tuple[Task, bool]: finished task and its result
+        """
+        async for _, task, result in self._pool(session, task_id, Tasks, callback, max_workers):
+            yield task, result
+
+    async def _pool(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        Tasks: TaskSource,
+        callback: Optional[Callable[[Task, bool], Awaitable[None]]] = None,
+        max_workers: int = 0,
+    ) -> AsyncIterator[Tuple[int, Task, bool]]:
+        """
+        Download tasks with a fixed pool of workers fed through a bounded queue.
+
+        Only `max_concurrent` workers, or `max_workers` if lower, and twice as
+        many queued tasks exist at any time, however many tasks the source yields.
+        The next task is pulled from the source once a result was handed over,
+        so a lazy source is never read further ahead than that.
+
+        Yields:
+            Tuple[int, Task, bool]: index of the task in the source, task and its result
+        """
+        worker_count = min(self.max_concurrent, max_workers) if max_workers > 0 else self.max_concurrent
+        todo: asyncio.Queue = asyncio.Queue(maxsize=worker_count * 2)
+        done: asyncio.Queue = asyncio.Queue(maxsize=worker_count)
+        # tasks pulled from the source and not handed over yet
+        room = asyncio.Semaphore(worker_count + todo.maxsize)
+
+        async def produce():
+            try:
+                index = 0
+                if isinstance(Tasks, AsyncIterable):
+                    tasks = Tasks.__aiter__()
+                    while True:
+                        await room.acquire()
+                        try:
+                            task = await tasks.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        await todo.put((index, task))
+                        index += 1
+                else:
+                    tasks = iter(Tasks)
+                    while True:
+                        await room.acquire()
+                        try:
+                            task = next(tasks)
+                        except StopIteration:
+                            break
+                        await todo.put((index, task))
+                        index += 1
+            except Exception:
+                # the workers end too, the consumer raises the error of the source once they did
+                await stop()
+                raise
+            # not when cancelled, the workers are cancelled with it and the queue may stay full
+            await stop()
+
+        async def stop():
+            for _ in range(worker_count):
+                await todo.put(None)
+
+        async def work():
+            try:
+                while True:
+                    item = await todo.get()
+                    if item is None:
+                        break
+                    index, task = item
+                    result = await self._fetch_task(session, task_id, task, callback)
+                    await done.put((index, task, result))
+            except Exception as e:
+                await done.put(e)
+            await done.put(None)
+
+        producer = asyncio.create_task(produce())
+        workers = [asyncio.create_task(work()) for _ in range(worker_count)]
+        try:
+            finished = 0
+            while finished < worker_count:
+                item = await done.get()
+                if item is None:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    room.release()
+                    yield item
+            # raise errors of the task source
+            await producer
+        finally:
+            for worker in [producer, *workers]:
+                worker.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+
+    async def _fetch_task(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        task: Task,
+        callback: Optional[Callable[[Task, bool], Awaitable[None]]] = None,
+    ) -> bool:
+        """Download a task and hand its result to the callback"""
+        result = await self._safe_fetch_url(session=session, task_id=task_id, task=task)
+        if callback is not None:
+            await callback(task, result)
         return result
 
     async def _safe_fetch_url(
         self,
         session: aiohttp.ClientSession,
         task_id: TaskID,
-        url: str,
-        save_path: str,
+        task: Task,
     ) -> bool:
         """
-        Safe wrapper for fetch_url that handles exceptions.
+        Safe wrapper for fetch_url that handles exceptions and records the outcome on the task.
 
         Args:
             session: aiohttp session
-            url: URL to download
-            save_path: path to save the file
             task_id: progress task ID
+            task: download task
 
         Returns:
-            Optional[bool]: True if successful, None if failed
+            bool: True if successful, False if failed
         """
+        host = urlsplit(task.url).netloc
+        metric = SegmentMetric(task.video, task.url, host)
+        transfer = self.progress.transfer(task_id, host)
+        validator = self.new_validator() if task.validate else None
         try:
-            return await self.fetch_url(session, task_id, url, save_path)
+            key = await self.load_key(session, task_id, task.key, task.headers) if task.key is not None else b""
+            if task.parts is not None:
+                await self.fetch_ranges(
+                    session,
+                    task_id,
+                    task.url,
+                    task.parts,
+                    metric=metric,
+                    transfer=transfer,
+                    key=key,
+                    headers=task.headers,
+                    validate=task.validate,
+                )
+            elif self.hedging is not None:
+                await self.fetch_hedged(
+                    session, task_id, task, metric=metric, transfer=transfer, key=key, validator=validator
+                )
+            else:
+                await self.fetch_url(
+                    session,
+                    task_id,
+                    task.url,
+                    task.save_path,
+                    metric=metric,
+                    transfer=transfer,
+                    key=key,
+                    iv=task.iv,
+                    headers=task.headers,
+                    validator=validator,
+                )
         except DownloadError as e:
             logger.error(f"Download failed: {e}")
+            transfer.failed()
+            # attempts add up over the final pass of a video
+            task.attempts += e.retry_count + 1
+            task.rejected += metric.rejected
+            task.error = e.message
+            metric.status = "failed"
+            metric.error = metric.error or "DownloadError"
+            self.metrics.segment(metric)
             return False
+        task.attempts += metric.retries + 1
+        task.rejected += metric.rejected
+        task.error = ""
+        task.checksum = validator.checksum if validator is not None else ""
+        if task.parts is not None:
+            task.size = sum(part.size for part in task.parts)
+        else:
+            task.size = os.path.getsize(task.save_path)
+        metric.status = "done"
+        metric.error = ""
+        self.metrics.segment(metric)
+        return True
+
+    async def fetch_hedged(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        task: Task,
+        metric: SegmentMetric,
+        transfer: FileTransfer,
+        key: bytes = b"",
+        validator: Optional[SegmentValidator] = None,
+    ) -> bool:
+        """
+        Fetch a file, sending a duplicate request once it runs slower than its peers.
+
+        The duplicate is saved to `<save_path>.hedge` and goes through the
+        limiter like any request, so hedging never exceeds max_concurrent. The
+        first request to finish wins, the other one is cancelled and its part
+        file removed.
+
+        Args:
+            session: aiohttp session
+            task_id: progress task ID
+            task: download task of a whole file
+            metric: measurements of the task, the duplicate's bytes are added to it
+            transfer: byte counter of the task in the progress display
+            key: AES-128 key of an encrypted body, empty if not encrypted
+            validator: checks the body of the primary request, the duplicate gets its own
+
+        Returns:
+            bool: True if successful
+
+        Raises:
+            DownloadError: if both requests failed
+        """
+        hedging = self.hedging
+        primary = asyncio.ensure_future(
+            self.fetch_url(
+                session,
+                task_id,
+                task.url,
+                task.save_path,
+                metric=metric,
+                transfer=transfer,
+                key=key,
+                iv=task.iv,
+                headers=task.headers,
+                validator=validator,
+            )
+        )
+        delay = hedging.delay()
+        while delay is not None and not primary.done():
+            # the delay runs from when the current attempt got its slot, not while it waits for one
+            if not metric.started_at:
+                await asyncio.wait([primary], timeout=delay / 4)
+                continue
+            remaining = metric.started_at + delay - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait([primary], timeout=remaining)
+        if primary.done() or delay is None or not hedging.allow():
+            result = await primary
+            hedging.observe(time.monotonic() - metric.started_at)
+            return result
+
+        url = hedging.hedge_url(task.url)
+        hedge_path = task.save_path + ".hedge"
+        hedge_metric = SegmentMetric(task.video, url, urlsplit(url).netloc)
+        hedge_transfer = self.progress.transfer(task_id, hedge_metric.host)
+        hedge_validator = SegmentValidator(validator.algorithm) if validator is not None else None
+        hedge = asyncio.ensure_future(
+            self.fetch_url(
+                session,
+                task_id,
+                url,
+                hedge_path,
+                metric=hedge_metric,
+                transfer=hedge_transfer,
+                key=key,
+                iv=task.iv,
+                headers=task.headers,
+                validator=hedge_validator,
+            )
+        )
+        pending = {primary, hedge}
+        winner: Optional[asyncio.Future] = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((future for future in done if future.exception() is None), None)
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        metric.bytes += hedge_metric.bytes
+        metric.rejected += hedge_metric.rejected
+        if winner is hedge:
+            os.replace(hedge_path, task.save_path)
+            if validator is not None:
+                validator.checksum = hedge_validator.checksum
+            # the primary request is taken back, its unfinished part file is not resumed
+            transfer.cancel()
+            if os.path.exists(task.save_path + ".part"):
+                os.remove(task.save_path + ".part")
+            metric.hedge = "won"
+            metric.ttfb = hedge_metric.ttfb
+            hedging.observe(time.monotonic() - hedge_metric.started_at)
+            return True
+        hedge_transfer.cancel()
+        if os.path.exists(hedge_path + ".part"):
+            os.remove(hedge_path + ".part")
+        metric.hedge = "lost"
+        if winner is None:
+            # both failed, report the primary request
+            return await primary
+        hedging.observe(time.monotonic() - metric.started_at)
+        return True
+
+    async def load_key(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        key: AESKey,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> bytes:
+        """
+        Get an AES key, fetching it once however many segments wait for it.
+
+        The key is saved to its path, a resumed video reads it from there.
+
+        Args:
+            session: aiohttp session
+            task_id: progress task ID
+            key: key of the segment
+            headers: request headers of the video on top of the session's
+
+        Returns:
+            bytes: 16-byte key
+
+        Raises:
+            DownloadError: if the key cannot be fetched or is not 16 bytes long
+        """
+        future = self.keys.get(key.path)
+        if future is None:
+            future = self.keys[key.path] = asyncio.ensure_future(self._fetch_key(session, task_id, key, headers))
+
+            def forget_failed(future: asyncio.Future):
+                # the next segment tries again
+                if future.cancelled() or future.exception() is not None:
+                    self.keys.pop(key.path, None)
+
+            future.add_done_callback(forget_failed)
+        # a cancelled segment must not cancel the fetch shared with the others
+        return await asyncio.shield(future)
+
+    async def _fetch_key(
+        self, session: aiohttp.ClientSession, task_id: TaskID, key: AESKey, headers: Optional[Dict[str, str]]
+    ) -> bytes:
+        if not os.path.exists(key.path):
+            self.progress.add_total(task_id, 1)
+            await self.fetch_url(session, task_id, key.url, key.path, headers=headers)
+        with open(key.path, "rb") as fp:
+            data = fp.read()
+        if len(data) != AES_BLOCK_SIZE:
+            os.remove(key.path)
+            raise DownloadError(key.url, f"AES-128 key of {len(data)} bytes")
+        return data
 
     async def fetch_url(
         self,
@@ -128,16 +802,35 @@ class Downloader:
         url: str,
         save_path: str,
         retry: int = 0,
+        metric: Optional[SegmentMetric] = None,
+        transfer: Optional[FileTransfer] = None,
+        key: bytes = b"",
+        iv: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+        validator: Optional[SegmentValidator] = None,
     ) -> bool:
         """
         Fetch URL and save to file.
 
+        The body is written to `<save_path>.part` and renamed to `save_path`
+        once its size matches Content-Length, so an existing `save_path` is
+        always complete. A leftover part file is resumed with a Range request.
+        With a key, the body is decrypted with AES-128-CBC while it arrives
+        and only cleartext reaches the disk. With a validator, a body that is
+        not a valid segment is dropped and fetched again from its start.
+
         Args:
             session: aiohttp session
             url: URL to download
             task_id: progress task ID
             retry: current retry count
             save_path: path to save the file
+            metric: measurements of the task, summed over retries
+            transfer: byte counter of the task in the progress display
+            key: AES-128 key of an encrypted body, empty if not encrypted
+            iv: IV of the encrypted body
+            headers: request headers on top of the session's
+            validator: checks the body while it is written, see validate.SegmentValidator
 
         Returns:
             Optional[str]: save_path if successful, None if save_path is None
@@ -145,56 +838,523 @@ class Downloader:
         Raises:
             DownloadError: if download fails after all retries
         """
-        try:
-            async with self.sem:
-                async with session.get(url, **GetConfig) as response:
-                    if response.status != 200:
-                        error_msg = f"HTTP {response.status}"
-                        await asyncio.sleep(0.5)
-                        raise DownloadError(url, error_msg, retry)
-                    await self.save_as_file(response, save_path=save_path)
-                    self.progress.advance(task_id, advance=1)
-                    return True
-        except (
-            asyncio.TimeoutError,
-            aiohttp.ServerDisconnectedError,
-        ) as e:
-            if retry < self.max_retry:
-                logger.error(f"FAILED: [{url}][retry: {retry+1}][error: {type(e).__name__}]")
-                return await self.fetch_url(session, task_id, url, save_path=save_path, retry=retry + 1)
-            else:
-                error_msg = f"Connection error after {retry} retries: {type(e).__name__}"
-                logger.error(f"FAILED: [{url}][retry_done: {retry}][error: {error_msg}]")
-                raise DownloadError(url, error_msg, retry)
-        except Exception as e:
-            error_msg = f"Unexpected error: {type(e).__name__}"
-            logger.error(f"FAILED: [{url}][error: {traceback.format_exc()}]")
-            raise DownloadError(url, error_msg, retry)
+        part_path = save_path + ".part"
+        host = urlsplit(url).netloc
+        metric = metric if metric is not None else SegmentMetric("", url, host)
+        transfer = transfer if transfer is not None else self.progress.transfer(task_id, host)
+
+        async def attempt(retry: int):
+            queued = time.monotonic()
+            async with self.limiter.slot(host):
+                start = time.monotonic()
+                metric.slot_wait += start - queued
+                metric.started_at = start
+                ttfb, nbytes = 0.0, 0
+                try:
+                    # resume an interrupted download from the bytes already on disk
+                    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                    if key:
+                        # cleartext on disk is whole blocks, the block before it is fetched again as IV
+                        offset = offset - AES_BLOCK_SIZE if offset % AES_BLOCK_SIZE == 0 else 0
+                        offset = max(offset, 0)
+                    request_headers = dict(headers or {})
+                    if offset:
+                        request_headers["Range"] = f"bytes={offset}-"
+                    async with session.get(
+                        url, headers=request_headers, trace_request_ctx=metric, **GetConfig
+                    ) as response:
+                        ttfb = time.monotonic() - start
+                        if response.status == 416 and offset:
+                            # the part file does not match the remote file anymore
+                            os.remove(part_path)
+                            raise IncompleteDownloadError(f"HTTP 416 for offset {offset}")
+                        if response.status not in (200, 206):
+                            raise self.status_error(url, response, retry)
+                        if response.status == 200 or not self.range_matches(response, offset):
+                            # the server ignored the range, start over
+                            offset = 0
+                        expected_size = self.expected_size(response, offset)
+                        transfer.start(offset, expected_size)
+                        decryptor = SegmentDecryptor(key, None if offset else iv) if key else None
+                        if validator is not None:
+                            validator.reset()
+                        size = await self.save_as_file(
+                            response,
+                            save_path=part_path,
+                            offset=offset,
+                            transfer=transfer,
+                            decryptor=decryptor,
+                            validator=validator,
+                        )
+                        nbytes = size - offset
+                        if expected_size is not None and size != expected_size:
+                            raise IncompleteDownloadError(f"got {size} of {expected_size} bytes")
+                        if validator is not None:
+                            validator.finish()
+                        os.replace(part_path, save_path)
+                except Exception as e:
+                    if isinstance(e, CorruptSegmentError):
+                        # nothing of a corrupt body is worth resuming
+                        logger.warning(f"[{url}] corrupt body: {e}")
+                        metric.rejected += 1
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                    self.limiter.record(host, ttfb, nbytes, time.monotonic() - start, error_kind(e))
+                    metric.error = error_name(e)
+                    metric.ttfb = ttfb
+                    metric.bytes += nbytes
+                    metric.transfer_time += time.monotonic() - start
+                    raise
+                self.limiter.record(host, ttfb, nbytes, time.monotonic() - start)
+                metric.ttfb = ttfb
+                metric.bytes += nbytes
+                metric.transfer_time += time.monotonic() - start
+                transfer.done()
+
+        return await self.retrying(url, metric, attempt, retry)
 
-    async def save_as_file(self, response: aiohttp.ClientResponse, save_path: str):
+    async def fetch_ranges(
+        self,
+        session: aiohttp.ClientSession,
+        task_id: TaskID,
+        url: str,
+        parts: List[TaskPart],
+        retry: int = 0,
+        metric: Optional[SegmentMetric] = None,
+        transfer: Optional[FileTransfer] = None,
+        key: bytes = b"",
+        headers: Optional[Dict[str, str]] = None,
+        validate: bool = False,
+    ) -> bool:
+        """
+        Fetch sub-ranges of URL with a single Range request and save every one to its own file.
+
+        The request spans from the first part not saved yet to the end of the
+        last part, bytes in the gaps between parts are read and dropped. Every
+        part is written to `<save_path>.part` and renamed once complete, so a
+        retry starts over at the first unfinished part. With a key, every part
+        is decrypted with its own IV.
+
+        Args:
+            session: aiohttp session
+            task_id: progress task ID
+            url: URL to download
+            parts: sub-ranges sorted by offset, none overlapping
+            retry: current retry count
+            metric: measurements of the task, summed over retries
+            transfer: byte counter of the task in the progress display
+            key: AES-128 key of encrypted parts, empty if not encrypted
+            headers: request headers on top of the session's
+            validate: check every part as a segment while it is written
+
+        Returns:
+            bool: True once every part is saved
+
+        Raises:
+            DownloadError: if download fails after all retries
+        """
+        host = urlsplit(url).netloc
+        metric = metric if metric is not None else SegmentMetric("", url, host)
+        transfer = transfer if transfer is not None else self.progress.transfer(task_id, host)
+
+        async def attempt(retry: int):
+            queued = time.monotonic()
+            async with self.limiter.slot(host):
+                start = time.monotonic()
+                metric.slot_wait += start - queued
+                ttfb, nbytes = 0.0, 0
+                try:
+                    remaining = [part for part in parts if not part.done]
+                    first, end = remaining[0].offset, remaining[-1].offset + remaining[-1].length
+                    # a range answered from another offset is asked for again as the whole file
+                    for byte_range in (f"bytes={first}-{end - 1}", None):
+                        request_headers = dict(headers or {})
+                        if byte_range is not None:
+                            request_headers["Range"] = byte_range
+                        async with session.get(
+                            url, headers=request_headers, trace_request_ctx=metric, **GetConfig
+                        ) as response:
+                            ttfb = ttfb or time.monotonic() - start
+                            if response.status not in (200, 206):
+                                raise self.status_error(url, response, retry)
+                            # a server ignoring the range sends the whole file, bytes before a part are dropped
+                            position = self.range_start(response) if response.status == 206 else 0
+                            if position is None or position > first:
+                                content_range = response.headers.get("Content-Range", "")
+                                if byte_range is None:
+                                    raise DownloadError(url, f"HTTP 206 without Range, Content-Range {content_range!r}")
+                                logger.warning(
+                                    f"[{url}] got Content-Range {content_range!r} for offset {first}, refetching"
+                                )
+                                continue
+                            transfer.start(
+                                sum(part.length for part in parts if part.done), sum(part.length for part in parts)
+                            )
+                            nbytes = await self.save_ranges(
+                                response, position, remaining, transfer=transfer, key=key, validate=validate
+                            )
+                            break
+                    if not remaining[-1].done:
+                        saved = len([part for part in parts if part.done])
+                        raise IncompleteDownloadError(f"got {saved} of {len(parts)} ranges")
+                except Exception as e:
+                    if isinstance(e, CorruptSegmentError):
+                        logger.warning(f"[{url}] corrupt range: {e}")
+                        metric.rejected += 1
+                    self.limiter.record(host, ttfb, nbytes, time.monotonic() - start, error_kind(e))
+                    metric.error = error_name(e)
+                    metric.ttfb = ttfb
+                    metric.bytes += nbytes
+                    metric.transfer_time += time.monotonic() - start
+                    raise
+                self.limiter.record(host, ttfb, nbytes, time.monotonic() - start)
+                metric.ttfb = ttfb
+                metric.bytes += nbytes
+                metric.transfer_time += time.monotonic() - start
+                transfer.done()
+
+        return await self.retrying(url, metric, attempt, retry)
+
+    async def retrying(
+        self,
+        url: str,
+        metric: SegmentMetric,
+        attempt: Callable[[int], Awaitable[None]],
+        retry: int = 0,
+    ) -> bool:
+        """
+        Run attempts of a request until one succeeds or the retries run out.
+
+        Timeouts, connection errors, incomplete bodies and the statuses of
+        RetryConfig are retried after a jittered exponential backoff, or the
+        Retry-After of the response. The wait happens outside the concurrency
+        slot, so other downloads use it meanwhile. Retryable failures count
+        towards the circuit breaker of the host, which holds every request to
+        it while open. Any other failure is fatal and not retried.
+
+        Args:
+            url: URL of the request
+            metric: measurements of the task, its retries are updated
+            attempt: sends the request once, given the current retry count, raises on failure
+            retry: retries already done
+
+        Returns:
+            bool: True once an attempt succeeded
+
+        Raises:
+            DownloadError: on a fatal failure, or a retryable one after all retries
+        """
+        host = urlsplit(url).netloc
+        while True:
+            await self.breaker.wait(host)
+            metric.retries = retry
+            try:
+                await attempt(retry)
+            except Exception as e:
+                if not is_retryable(e, self.retry_policy.retry_statuses):
+                    if isinstance(e, DownloadError):
+                        logger.error(f"FAILED: [{url}][error: {e.message}]")
+                        raise DownloadError(url, e.message, retry, status=e.status)
+                    error_msg = f"Unexpected error: {type(e).__name__}"
+                    logger.error(f"FAILED: [{url}][error: {traceback.format_exc()}]")
+                    raise DownloadError(url, error_msg, retry)
+                status = e.status if isinstance(e, DownloadError) else 0
+                retry_after = e.retry_after if isinstance(e, DownloadError) else 0.0
+                self.breaker.failure(host)
+                if retry_after:
+                    # the server throttles the host as a whole, not this request only
+                    self.breaker.pause(host, min(retry_after, self.retry_policy.max_retry_after))
+                if retry >= self.max_retry:
+                    error_msg = f"{error_name(e)} after {retry} retries"
+                    logger.error(f"FAILED: [{url}][retry_done: {retry}][error: {error_msg}]")
+                    raise DownloadError(url, error_msg, retry, status=status)
+                # a corrupt body came from a working server, it is asked again at once
+                delay = 0.0 if isinstance(e, CorruptSegmentError) else self.retry_policy.delay(retry, retry_after)
+                logger.error(f"FAILED: [{url}][retry: {retry+1}][error: {error_name(e)}][wait: {delay:.1f}s]")
+                await asyncio.sleep(delay)
+                retry += 1
+                continue
+            self.breaker.success(host)
+            return True
+
+    @staticmethod
+    def status_error(url: str, response: aiohttp.ClientResponse, retry: int) -> DownloadError:
+        """Error of a response with a bad status, carrying its Retry-After"""
+        return DownloadError(
+            url,
+            f"HTTP {response.status}",
+            retry,
+            status=response.status,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+    @staticmethod
+    def range_matches(response: aiohttp.ClientResponse, offset: int) -> bool:
+        """
+        Check that a 206 response starts at the requested offset.
+
+        Args:
+            response: aiohttp response object
+            offset: first byte requested
+
+        Returns:
+            bool: True if the response continues the part file
+        """
+        return Downloader.range_start(response) == offset
+
+    @staticmethod
+    def range_start(response: aiohttp.ClientResponse) -> Optional[int]:
+        """
+        Get the first byte of a 206 response from its Content-Range.
+
+        Args:
+            response: aiohttp response object
+
+        Returns:
+            Optional[int]: offset in the remote file of the body, None without a valid Content-Range
+        """
+        match = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match is not None else None
+
+    @staticmethod
+    def expected_size(response: aiohttp.ClientResponse, offset: int) -> Optional[int]:
+        """
+        Get the size the file should have once the response is saved.
+
+        Args:
+            response: aiohttp response object
+            offset: bytes already saved before the response body
+
+        Returns:
+            Optional[int]: expected file size, None if the server did not send Content-Length
+        """
+        if response.content_length is None or response.headers.get("Content-Encoding"):
+            # compressed bodies are longer once decoded
+            return None
+        return offset + response.content_length
+
+    async def save_as_file(
+        self,
+        response: aiohttp.ClientResponse,
+        save_path: str,
+        offset: int = 0,
+        transfer: Optional[FileTransfer] = None,
+        decryptor: Optional[SegmentDecryptor] = None,
+        validator: Optional[SegmentValidator] = None,
+    ) -> int:
         """
         Save response content to file.
 
+        Bodies up to `whole_body_size` are read at once, larger ones in
+        `chunk_size` reads gathered into pooled buffers of `write_buffer_size`
+        bytes. With `threaded_writes`, disk writes run in a worker thread so a
+        slow disk never blocks the event loop, see `config.IOConfig`.
+
         Args:
             response: aiohttp response object
             save_path: path to save the file
+            offset: append to the existing file if not 0, otherwise truncate it
+            transfer: byte counter of the progress display, counting every chunk received
+            decryptor: decrypts every chunk before it is written, finalized once the whole body arrived
+            validator: checks every chunk before it is written, after the bytes already saved when resuming
 
         Returns:
-            Optional[str]: save_path if file was saved, None if save_path is None
+            int: bytes of the remote file received so far, offset included
+
+        Raises:
+            CorruptSegmentError: as soon as the body cannot be a valid segment
         """
-        with open(save_path, "wb") as fp:
-            while True:
-                chunk = await response.content.read(1024)
-                if not chunk:
+        io_config = self.io_config
+        length = None if response.headers.get("Content-Encoding") else response.content_length
+        received = 0
+        if validator is not None and offset:
+            # a resumed body continues the file on disk, the check starts from its first byte
+            if io_config["threaded_writes"]:
+                await asyncio.get_event_loop().run_in_executor(None, validator.update_file, save_path)
+            else:
+                validator.update_file(save_path)
+        with open(save_path, "ab" if offset else "wb") as fp:
+            if io_config["preallocate"] and length:
+                preallocate(fp, offset, length)
+            if length is not None and length <= io_config["whole_body_size"]:
+                chunks = []
+                try:
+                    while received < length:
+                        chunk = await response.content.read(length - received)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                        received += len(chunk)
+                        if transfer is not None:
+                            transfer.add(len(chunk))
+                finally:
+                    # a body cut short is kept for a Range request to resume from
+                    body = b"".join(chunks)
+                    if decryptor is not None:
+                        body = decryptor.update(body)
+                        if length == received:
+                            body += decryptor.finalize()
+                    if io_config["threaded_writes"]:
+                        await asyncio.get_event_loop().run_in_executor(None, fp.write, body)
+                    else:
+                        fp.write(body)
+                if validator is not None:
+                    validator.update(body)
+                return offset + received
+            if not io_config["write_buffer_size"]:
+                while True:
+                    chunk = await response.content.read(io_config["chunk_size"])
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    if transfer is not None:
+                        transfer.add(len(chunk))
+                    data = decryptor.update(chunk) if decryptor is not None else chunk
+                    if validator is not None:
+                        validator.update(data)
+                    fp.write(data)
+                if decryptor is not None and length in (None, received):
+                    data = decryptor.finalize()
+                    if validator is not None:
+                        validator.update(data)
+                    fp.write(data)
+                return offset + received
+            writer = BufferedFileWriter(fp, self.buffers, threaded=io_config["threaded_writes"])
+            try:
+                while True:
+                    chunk = await response.content.read(io_config["chunk_size"])
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    if transfer is not None:
+                        transfer.add(len(chunk))
+                    data = decryptor.update(chunk) if decryptor is not None else chunk
+                    if validator is not None:
+                        validator.update(data)
+                    await writer.write(data)
+                # an incomplete body keeps its last blocks undecrypted to be resumed
+                if decryptor is not None and length in (None, received):
+                    data = decryptor.finalize()
+                    if validator is not None:
+                        validator.update(data)
+                    await writer.write(data)
+            finally:
+                # the buffered chunks of a body cut short are written too, for a Range request to resume from
+                try:
+                    await writer.flush()
+                finally:
+                    await writer.close()
+            return offset + received
+
+    async def save_ranges(
+        self,
+        response: aiohttp.ClientResponse,
+        position: int,
+        parts: List[TaskPart],
+        transfer: Optional[FileTransfer] = None,
+        key: bytes = b"",
+        validate: bool = False,
+    ) -> int:
+        """
+        Split a response body spanning several parts into their files.
+
+        Reading stops once the last part is saved, parts saved before the body
+        was cut are marked done.
+
+        Args:
+            response: aiohttp response object
+            position: offset in the remote file of the first byte of the body
+            parts: parts to save, sorted by offset and starting at or after position
+            transfer: byte counter of the progress display, counting the bytes of the parts
+            key: AES-128 key of encrypted parts, empty if not encrypted
+            validate: check every part as a segment while it is written
+
+        Returns:
+            int: bytes received
+
+        Raises:
+            CorruptSegmentError: as soon as a part cannot be a valid segment
+        """
+        io_config = self.io_config
+        received = 0
+        pending = iter(parts)
+        part: Optional[TaskPart] = next(pending)
+        fp = writer = decryptor = validator = None
+
+        async def write(data: bytes):
+            if validator is not None:
+                validator.update(data)
+            part.size += len(data)
+            if writer is not None:
+                await writer.write(data)
+            else:
+                fp.write(data)
+
+        try:
+            async for chunk in response.content.iter_chunked(io_config["chunk_size"]):
+                received += len(chunk)
+                data = memoryview(chunk)
+                while part is not None and data:
+                    gap = part.offset - position
+                    if gap >= len(data):
+                        position += len(data)
+                        break
+                    if gap > 0:
+                        data = data[gap:]
+                        position += gap
+                    if fp is None:
+                        fp = open(part.save_path + ".part", "wb")
+                        part.size = 0
+                        if io_config["write_buffer_size"]:
+                            writer = BufferedFileWriter(fp, self.buffers, threaded=io_config["threaded_writes"])
+                        decryptor = SegmentDecryptor(key, part.iv) if key else None
+                        validator = self.new_validator() if validate else None
+                    size = min(len(data), part.offset + part.length - position)
+                    piece, data = bytes(data[:size]), data[size:]
+                    position += size
+                    if transfer is not None:
+                        transfer.add(size)
+                    await write(decryptor.update(piece) if decryptor is not None else piece)
+                    if position < part.offset + part.length:
+                        continue
+                    if decryptor is not None:
+                        await write(decryptor.finalize())
+                    if validator is not None:
+                        validator.finish()
+                        part.checksum = validator.checksum
+                    if writer is not None:
+                        await writer.flush()
+                        await writer.close()
+                        writer = None
+                    fp.close()
+                    fp = None
+                    os.replace(part.save_path + ".part", part.save_path)
+                    part.done = True
+                    part = next(pending, None)
+                if part is None:
                     break
-                fp.write(chunk)
+        finally:
+            if writer is not None:
+                await writer.close()
+            if fp is not None:
+                fp.close()
+        return received
 
     def init_session(self) -> aiohttp.ClientSession:
         """Initialize aiohttp session with configured headers and connector.
 
+        The connection pool lives as long as the session, open one with
+        `open` or `async with` to share it between runs.
+
         Returns:
             aiohttp.ClientSession: Configured aiohttp session
         """
-        connector = aiohttp.TCPConnector(**ConnectorConfig)
-        _session = aiohttp.ClientSession(headers=HeaderConfig, connector=connector)
+        connector_config = dict(ConnectorConfig)
+        if self.adaptive:
+            # the limiter decides how many requests are in flight, max_concurrent of all hosts together included
+            connector_config["limit"] = 0
+            limit_per_host = connector_config.get("limit_per_host", 0)
+            connector_config["limit_per_host"] = min(limit_per_host or self.max_concurrent, self.max_concurrent)
+        connector = aiohttp.TCPConnector(**connector_config)
+        _session = aiohttp.ClientSession(headers=HeaderConfig, connector=connector, trace_configs=[self.trace_config])
         return _session
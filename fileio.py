@@ -0,0 +1,181 @@
+import os
+import shutil
+import asyncio
+import ctypes
+import ctypes.util
+from typing import BinaryIO, List, Optional
+
+# fallocate(2) mode reserving blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+# ioctl(2) sharing the blocks of a file with another one (reflink) on Btrfs, XFS and others
+FICLONE = 0x40049409
+
+_libc = None
+
+
+def preallocate(fp: BinaryIO, offset: int, length: int) -> bool:
+    """Reserve disk blocks for a file without changing its size
+
+    The size stays untouched so that an interrupted part file still tells
+    how many bytes were really written. Only Linux supports it, elsewhere it
+    does nothing.
+
+    Args:
+        fp (BinaryIO): Opened file
+        offset (int): First byte to reserve
+        length (int): Number of bytes to reserve
+
+    Returns:
+        bool: True if the blocks were reserved
+    """
+    global _libc
+    if length <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fallocate = getattr(_libc, "fallocate", None)
+    if fallocate is None:
+        return False
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return fallocate(fp.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+def link_file(src: str, dst: str) -> str:
+    """Make dst a copy of src without copying bytes when the filesystem allows it
+
+    A hardlink is tried first, then a reflink sharing the blocks of src
+    (Linux only), then a plain copy, e.g. across filesystems.
+
+    Args:
+        src (str): Existing file
+        dst (str): Path of the copy, replaced if it exists
+
+    Returns:
+        str: "hardlink", "reflink" or "copy"
+    """
+    tmp_path = dst + ".link"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+        method = "hardlink"
+    except OSError:
+        method = "copy"
+        with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+            try:
+                import fcntl
+
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = "reflink"
+            except (ImportError, OSError):
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    os.replace(tmp_path, dst)
+    return method
+
+
+class BufferPool:
+    """BufferPool hands out fixed-size buffers and keeps returned ones for the next writer"""
+
+    def __init__(self, buffer_size: int, max_free: int = 64):
+        """Initialize buffer pool
+
+        Args:
+            buffer_size (int): Size of every buffer
+            max_free (int, optional): Returned buffers kept for reuse. Defaults to 64.
+        """
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self.free: List[memoryview] = []
+
+    def acquire(self) -> memoryview:
+        """Get a buffer, reusing a returned one when possible"""
+        if self.free:
+            return self.free.pop()
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, buffer: memoryview):
+        """Return a buffer to the pool"""
+        if len(self.free) < self.max_free:
+            self.free.append(buffer)
+
+
+class BufferedFileWriter:
+    """BufferedFileWriter gathers chunks in pooled buffers and writes them off the event loop.
+
+    Two buffers are swapped: the event loop fills one while a worker thread
+    writes the other, so a slow disk only stalls the download that owns the
+    buffers, never the loop. Without `threaded`, buffers are written inline.
+    """
+
+    def __init__(self, fp: BinaryIO, pool: BufferPool, threaded: bool = True):
+        """Initialize buffered writer
+
+        Args:
+            fp (BinaryIO): Opened file to write into
+            pool (BufferPool): Pool providing the buffers
+            threaded (bool, optional): Whether to write in a worker thread. Defaults to True.
+        """
+        self.fp = fp
+        self.pool = pool
+        self.buffer_size = pool.buffer_size
+        self.threaded = threaded
+        self.view = pool.acquire()
+        self.spare: Optional[memoryview] = None
+        self.pos = 0
+        self.pending: Optional[asyncio.Future] = None
+
+    async def write(self, chunk: bytes):
+        """Append a chunk, writing the buffer each time it is full"""
+        data = memoryview(chunk)
+        while data:
+            size = min(len(data), self.buffer_size - self.pos)
+            self.view[self.pos : self.pos + size] = data[:size]
+            self.pos += size
+            data = data[size:]
+            if self.pos == self.buffer_size:
+                await self._submit()
+
+    async def flush(self):
+        """Write everything buffered and wait for it"""
+        if self.pos:
+            await self._submit()
+        await self._wait()
+
+    async def close(self):
+        """Wait for the running write and give the buffers back, without writing what is left"""
+        try:
+            await self._wait()
+        finally:
+            # buffers of a write still running are left to the garbage collector instead of the next writer
+            if self.pending is None:
+                for buffer in (self.view, self.spare):
+                    if buffer is not None:
+                        self.pool.release(buffer)
+            self.view = self.spare = None
+
+    async def _wait(self):
+        if self.pending is None:
+            return
+        try:
+            # a cancelled wait leaves the thread writing from the buffer, it must finish before the buffer is reused
+            await asyncio.shield(self.pending)
+        except asyncio.CancelledError:
+            await asyncio.wait([self.pending])
+            raise
+        finally:
+            if self.pending.done():
+                self.pending = None
+
+    async def _submit(self):
+        full, size = self.view, self.pos
+        if not self.threaded:
+            self.fp.write(full[:size])
+            self.pos = 0
+            return
+        # the spare buffer may still be being written
+        await self._wait()
+        if self.spare is None:
+            self.spare = self.pool.acquire()
+        self.view, self.spare, self.pos = self.spare, full, 0
+        loop = asyncio.get_event_loop()
+        self.pending = loop.run_in_executor(None, self.fp.write, full[:size])
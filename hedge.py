@@ -0,0 +1,82 @@
+from collections import deque
+from urllib.parse import urlsplit
+from typing import Deque, Dict, List, Optional
+
+
+class HedgePolicy:
+    """HedgePolicy decides when a slow download gets a duplicate request.
+
+    The durations of finished downloads are kept in a sliding window; a
+    request still running after a percentile of its peers, times
+    `multiplier`, is hedged with a second request, to a mirror host when one
+    is configured. The first one to finish wins. Hedges are capped to a share
+    of all requests, so a host that is slow for everyone is not hit twice
+    as hard.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        multiplier: float = 1.0,
+        min_delay: float = 0.2,
+        min_samples: int = 20,
+        max_ratio: float = 0.05,
+        window: int = 1000,
+        mirrors: Optional[Dict[str, List[str]]] = None,
+    ):
+        """Initialize hedge policy
+
+        Args:
+            percentile (float, optional): Percentile of the durations of finished downloads. Defaults to 0.95.
+            multiplier (float, optional): Factor of the percentile a request must exceed. Defaults to 1.0.
+            min_delay (float, optional): Seconds a request runs at least before it is hedged. Defaults to 0.2.
+            min_samples (int, optional): Finished downloads needed before hedging starts. Defaults to 20.
+            max_ratio (float, optional): Largest share of requests that are hedged. Defaults to 0.05.
+            window (int, optional): Latest durations kept. Defaults to 1000.
+            mirrors (Dict[str, List[str]], optional): Hosts serving the same files, by host. Defaults to None.
+        """
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_delay = min_delay
+        self.min_samples = max(1, min_samples)
+        self.max_ratio = max_ratio
+        self.durations: Deque[float] = deque(maxlen=window)
+        self.mirrors = mirrors or dict()
+        self.requests = 0
+        self.hedges = 0
+        # the percentile is sorted again only every few samples
+        self.threshold: Optional[float] = None
+        self.stale = 0
+
+    def observe(self, seconds: float):
+        """Record the duration of a finished download"""
+        self.durations.append(seconds)
+        self.stale += 1
+
+    def delay(self) -> Optional[float]:
+        """Seconds after which a running request is hedged, None while too few downloads finished"""
+        self.requests += 1
+        if len(self.durations) < self.min_samples:
+            return None
+        if self.threshold is None or self.stale >= 16:
+            ordered = sorted(self.durations)
+            value = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+            self.threshold = max(self.min_delay, value * self.multiplier)
+            self.stale = 0
+        return self.threshold
+
+    def allow(self) -> bool:
+        """Take one hedge from the budget, False once max_ratio of the requests were hedged"""
+        if self.hedges + 1 > self.max_ratio * self.requests:
+            return False
+        self.hedges += 1
+        return True
+
+    def hedge_url(self, url: str) -> str:
+        """URL of the duplicate request, on the next mirror of the host if any"""
+        parts = urlsplit(url)
+        mirrors = self.mirrors.get(parts.netloc)
+        if not mirrors:
+            return url
+        mirror = mirrors[self.hedges % len(mirrors)]
+        return parts._replace(netloc=mirror).geturl()
@@ -0,0 +1,233 @@
+import time
+import asyncio
+from log import logger
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+
+class FixedLimiter:
+    """FixedLimiter allows a fixed number of requests in flight, whatever the host"""
+
+    def __init__(self, max_concurrent: int = 20):
+        """Initialize fixed limiter
+
+        Args:
+            max_concurrent (int, optional): Maximum requests in flight. Defaults to 20.
+        """
+        self.max_concurrent = max_concurrent
+        # created in the loop running the requests, a limiter may be built before any loop runs
+        self.sem: Optional[asyncio.Semaphore] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @asynccontextmanager
+    async def slot(self, host: str) -> AsyncIterator[None]:
+        """Hold one request slot"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # requests of an earlier loop are gone with it
+            self.sem = asyncio.Semaphore(self.max_concurrent)
+            self.loop = loop
+        async with self.sem:
+            yield
+
+    def record(self, host: str, ttfb: float, nbytes: int, duration: float, error: str = ""):
+        """Fixed limits ignore measurements"""
+
+    def limits(self) -> Dict[str, int]:
+        """Get the current limit of every host"""
+        return dict()
+
+
+class LimitChange:
+    """LimitChange records why the limit of a host changed"""
+
+    __slots__ = ("time", "host", "old", "new", "reason")
+
+    def __init__(self, host: str, old: int, new: int, reason: str) -> None:
+        self.time = time.time()
+        self.host = host
+        self.old = old
+        self.new = new
+        self.reason = reason
+
+    def __repr__(self) -> str:
+        return f"LimitChange({self.host}: {self.old} -> {self.new}, {self.reason})"
+
+
+class HostState:
+    """HostState holds the limit and the measurements of one host"""
+
+    def __init__(self, limit: float) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # measurements of the current window
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.window_bytes = 0
+        self.window_ttfb: List[float] = []
+        self.window_errors = 0
+        # results of the previous window
+        self.last_throughput = 0.0
+        self.last_limit = limit
+        self.best_ttfb: Optional[float] = None
+        self.last_decrease = 0.0
+
+
+class AdaptiveLimiter:
+    """AdaptiveLimiter adjusts the requests in flight of every host with AIMD.
+
+    Every `limit` completed requests form a window. A window without errors
+    and with a steady time-to-first-byte raises the limit by one, unless the
+    previous raise made the throughput drop. A timeout, a disconnect or a
+    throttling answer (HTTP 429 or 5xx) cuts the limit by `backoff` at once,
+    at most once per `cooldown` seconds. Every change is kept in `history`
+    with its reason. On top of the hosts, requests of all hosts together
+    never exceed `max_total`.
+    """
+
+    THROTTLE_ERRORS = ("timeout", "disconnect", "throttle")
+
+    def __init__(
+        self,
+        max_concurrent: int = 20,
+        min_concurrent: int = 1,
+        initial_concurrent: int = 4,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+        cooldown: float = 1.0,
+        max_total: Optional[int] = None,
+    ):
+        """Initialize adaptive limiter
+
+        Args:
+            max_concurrent (int, optional): Upper bound of the limit of a host. Defaults to 20.
+            min_concurrent (int, optional): Lower bound of the limit of a host. Defaults to 1.
+            initial_concurrent (int, optional): Limit of a host never seen before. Defaults to 4.
+            backoff (float, optional): Factor applied to the limit on errors. Defaults to 0.5.
+            latency_tolerance (float, optional): Time-to-first-byte growth over the best seen that lowers the limit. Defaults to 2.0.
+            cooldown (float, optional): Minimum seconds between two decreases. Defaults to 1.0.
+            max_total (Optional[int], optional): Requests in flight to all hosts together at most.
+                Defaults to max_concurrent.
+        """
+        self.max_concurrent = max_concurrent
+        self.min_concurrent = min_concurrent
+        self.initial_concurrent = max(min_concurrent, min(initial_concurrent, max_concurrent))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.hosts: Dict[str, HostState] = dict()
+        # global budget, taken once the host granted its slot so a busy host never holds slots it cannot use
+        self.total = FixedLimiter(max_total if max_total is not None else max_concurrent)
+        self.history: Deque[LimitChange] = deque(maxlen=1000)
+
+    def _host(self, host: str) -> HostState:
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.initial_concurrent)
+        return state
+
+    @asynccontextmanager
+    async def slot(self, host: str) -> AsyncIterator[None]:
+        """Hold one request slot of a host, waiting while the host is at its limit"""
+        state = self._host(host)
+        if state.waiters or state.in_flight >= int(state.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            state.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was handed over right before the cancellation
+                    self._release(state)
+                else:
+                    state.waiters.remove(waiter)
+                raise
+        else:
+            state.in_flight += 1
+        try:
+            async with self.total.slot(host):
+                yield
+        finally:
+            self._release(state)
+
+    def _release(self, state: HostState):
+        state.in_flight -= 1
+        self._wake(state)
+
+    def _wake(self, state: HostState):
+        """Hand free slots to the waiters in FIFO order"""
+        while state.waiters and state.in_flight < int(state.limit):
+            waiter = state.waiters.popleft()
+            if waiter.done():
+                continue
+            state.in_flight += 1
+            waiter.set_result(None)
+
+    def record(self, host: str, ttfb: float, nbytes: int, duration: float, error: str = ""):
+        """Record a finished request and adjust the limit of its host
+
+        Args:
+            host (str): Host of the request
+            ttfb (float): Seconds until the response headers arrived
+            nbytes (int): Bytes received
+            duration (float): Seconds of the whole request
+            error (str, optional): "timeout", "disconnect", "throttle" or another error, empty if successful
+        """
+        state = self._host(host)
+        now = time.monotonic()
+        if error in self.THROTTLE_ERRORS:
+            state.window_errors += 1
+            if now - state.last_decrease >= self.cooldown:
+                state.last_decrease = now
+                self._set_limit(host, state, state.limit * self.backoff, error)
+            return
+
+        state.window_count += 1
+        state.window_bytes += nbytes
+        if not error:
+            state.window_ttfb.append(ttfb)
+        if state.window_count < max(int(state.limit), 4):
+            return
+
+        elapsed = max(now - state.window_start, 1e-6)
+        throughput = state.window_bytes / elapsed
+        ttfb_median = sorted(state.window_ttfb)[len(state.window_ttfb) // 2] if state.window_ttfb else 0.0
+        if ttfb_median and (state.best_ttfb is None or ttfb_median < state.best_ttfb):
+            state.best_ttfb = ttfb_median
+
+        if state.window_errors:
+            # the limit was already cut when the errors happened
+            state.last_limit = state.limit
+        elif state.best_ttfb and ttfb_median > max(state.best_ttfb * self.latency_tolerance, state.best_ttfb + 0.05):
+            # the absolute margin keeps jitter of very fast hosts from counting as congestion
+            if now - state.last_decrease >= self.cooldown:
+                state.last_decrease = now
+                self._set_limit(host, state, state.limit * 0.9, "latency rising")
+        elif state.limit > state.last_limit and throughput < state.last_throughput * 0.9:
+            self._set_limit(host, state, state.last_limit, "throughput dropped")
+        elif state.in_flight + len(state.waiters) >= int(state.limit):
+            # only probe higher when the current limit is actually used
+            state.last_limit = state.limit
+            self._set_limit(host, state, state.limit + 1, "throughput steady")
+        state.last_throughput = throughput
+
+        state.window_start = now
+        state.window_count = 0
+        state.window_bytes = 0
+        state.window_ttfb = []
+        state.window_errors = 0
+
+    def _set_limit(self, host: str, state: HostState, limit: float, reason: str):
+        limit = max(float(self.min_concurrent), min(float(self.max_concurrent), limit))
+        old, new = int(state.limit), int(limit)
+        state.limit = limit
+        if old != new:
+            self.history.append(LimitChange(host, old, new, reason))
+            logger.info(f"concurrency of {host}: {old} -> {new} ({reason})")
+        self._wake(state)
+
+    def limits(self) -> Dict[str, int]:
+        """Get the current limit of every host"""
+        return {host: int(state.limit) for host, state in self.hosts.items()}
@@ -0,0 +1,247 @@
+import os
+import time
+import asyncio
+import aiohttp
+from log import logger
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Optional
+from rich.progress import TaskID
+from downloader import DownloadError, Task, TaskPart
+from assembler import DiskBudget, SegmentAssembler
+from decrypt import AESKey, parse_iv, sequence_iv
+from metrics import VideoMetric
+from playlist import Playlist, PlaylistError, Segment, parse_playlist, select_variant
+from config import GetConfig
+
+if TYPE_CHECKING:
+    from core import BlobDownloader, VideoJob
+
+
+class LiveError(Exception):
+    """Raised when a live playlist cannot be recorded"""
+
+
+class LiveRecorder:
+    """LiveRecorder records a live or event playlist until #EXT-X-ENDLIST or a time limit.
+
+    The media playlist is polled every target duration, half of it when
+    nothing changed, as the HLS specification asks. Segments are told apart
+    by their media sequence number: only the last one seen is remembered and
+    only newer segments are queued into the download pool, which stays open
+    for the whole recording. Segments are appended to the output in order as
+    they arrive, so memory and CPU only depend on the playlist window and
+    the number of downloads in flight, not on how long the recording runs.
+    """
+
+    def __init__(
+        self,
+        blob_downloader: "BlobDownloader",
+        max_duration: float = 0,
+        start_segments: int = 3,
+        max_poll_failures: int = 5,
+    ):
+        """Initialize live recorder
+
+        Args:
+            blob_downloader (BlobDownloader): Downloader providing paths, keys and the download pool
+            max_duration (float, optional): Seconds to record, 0 to record until #EXT-X-ENDLIST. Defaults to 0.
+            start_segments (int, optional): Segments before the live edge to start with, 0 for the whole
+                playlist. Defaults to 3.
+            max_poll_failures (int, optional): Playlist polls failing in a row before giving up. Defaults to 5.
+        """
+        self.blob = blob_downloader
+        self.downloader = blob_downloader.downloader
+        self.progress = self.downloader.progress
+        self.max_duration = max_duration
+        self.start_segments = max(0, start_segments)
+        self.max_poll_failures = max(1, max_poll_failures)
+
+    def run(self, job: "VideoJob") -> str:
+        """Record a live video synchronously
+
+        Args:
+            job (VideoJob): Video job of the live playlist
+
+        Returns:
+            str: Path to the recorded video file
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.async_run(job))
+
+    async def async_run(self, job: "VideoJob") -> str:
+        """Record a live video asynchronously
+
+        Args:
+            job (VideoJob): Video job of the live playlist
+
+        Returns:
+            str: Path to the recorded video file
+
+        Raises:
+            LiveError: if the playlist cannot be polled or no segment could be recorded
+        """
+        self.blob.start_job(job)
+        metric = VideoMetric(job.save_name)
+        task_id = self.progress.add_task(description=f"recording {job.save_name}", total=0)
+        try:
+            with self.progress:
+                async with self.downloader.session_scope() as session:
+                    video_path = await self.record(session, task_id, job, metric)
+            video_path = self.blob.finish_job(job, video_path)
+            metric.status = "done"
+            return video_path
+        except Exception as e:
+            self.blob.fail_job(job, e)
+            metric.status = "failed"
+            metric.error = str(e)
+            raise
+        finally:
+            self.progress.remove_task(task_id)
+            self.blob.metrics.video(metric)
+            self.blob.metrics.flush()
+
+    async def record(
+        self, session: aiohttp.ClientSession, task_id: TaskID, job: "VideoJob", metric: VideoMetric
+    ) -> str:
+        """Download new segments as they appear and append them to the output
+
+        Returns:
+            str: Path to the recorded video
+        """
+        # segments in flight, by save path, with their position in the output
+        indexes: Dict[str, int] = dict()
+        counts = {"queued": 0, "failed": 0}
+        # with max_tmp_size, polling waits while the segments not yet appended fill the tmp space
+        budget = DiskBudget(self.blob.max_tmp_size) if self.blob.max_tmp_size > 0 else None
+        reserved: Dict[str, int] = dict()
+
+        async def on_done(task: Task, result: bool):
+            index = indexes.pop(task.save_path)
+            if budget is not None:
+                size = reserved.pop(task.save_path)
+                await (budget.done(size, task.size) if result else budget.failed(size))
+            if not result:
+                # a live segment cannot be waited for, the recording goes on without it
+                counts["failed"] += 1
+                logger.warning(f"[{job.save_name}] segment left out: {task.url}")
+            else:
+                metric.segments += 1
+                metric.bytes += task.size
+            await assembler.add(index, task.save_path if result else None)
+
+        async def tasks() -> AsyncIterator[Task]:
+            async for task in self.new_segments(session, job):
+                if not counts["queued"]:
+                    # the output is only created once there is a segment to write
+                    await assembler.open()
+                if budget is not None:
+                    # a skipped segment never blocks the output, so there is always room eventually
+                    reserved[task.save_path] = await budget.acquire()
+                indexes[task.save_path] = counts["queued"]
+                counts["queued"] += 1
+                self.progress.add_total(task_id, 1)
+                yield task
+
+        async def on_written(index: int, path: str):
+            size = os.path.getsize(path)
+            os.remove(path)
+            await budget.release(size)
+
+        if budget is not None:
+            assembler = SegmentAssembler(job.save_path, job.tmp_path, 0, on_written=on_written)
+        else:
+            assembler = SegmentAssembler(job.save_path, job.tmp_path, 0, remove_written=self.blob.clean_tmp)
+        start = time.monotonic()
+        try:
+            async for _ in self.downloader.fetch_stream(
+                session, task_id, tasks(), callback=on_done, max_workers=job.max_concurrent
+            ):
+                pass
+            if not counts["queued"]:
+                raise LiveError("the playlist ended before any segment was recorded")
+            if counts["failed"] == counts["queued"]:
+                raise LiveError(f"no segment recorded, {counts['failed']} failed")
+        except BaseException:
+            await assembler.abort()
+            raise
+        metric.download_time = time.monotonic() - start
+        assembler.total = counts["queued"]
+        return await assembler.finish()
+
+    async def new_segments(self, session: aiohttp.ClientSession, job: "VideoJob") -> AsyncIterator[Task]:
+        """Poll the media playlist and yield a task for every segment not seen before
+
+        Returns when the playlist ends or the recording reached max_duration.
+        """
+        started = time.monotonic()
+        next_sequence: Optional[int] = None
+        failures = 0
+        # keys decrypted while downloading
+        aes_keys: Dict[str, AESKey] = dict()
+        while True:
+            polled_at = time.monotonic()
+            try:
+                playlist = await self.poll(session, job)
+                failures = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError, PlaylistError) as e:
+                failures += 1
+                if failures >= self.max_poll_failures:
+                    raise LiveError(f"playlist failed {failures} times in a row: {type(e).__name__}")
+                logger.warning(f"[{job.save_name}] playlist poll failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            segments = playlist.segments
+            if next_sequence is None:
+                if self.start_segments and not playlist.endlist:
+                    segments = segments[-self.start_segments :]
+            else:
+                if segments and segments[0].sequence > next_sequence:
+                    logger.warning(
+                        f"[{job.save_name}] {segments[0].sequence - next_sequence} segments left the playlist "
+                        "before they were polled"
+                    )
+                segments = [segment for segment in segments if segment.sequence >= next_sequence]
+            for segment in segments:
+                if segment.init is not None:
+                    raise LiveError("live recording supports MPEG-TS segments only, the playlist has EXT-X-MAP")
+                yield self.segment_task(job, segment, aes_keys)
+                next_sequence = segment.sequence + 1
+            if playlist.endlist:
+                logger.info(f"[{job.save_name}] live playlist ended")
+                return
+            if self.max_duration and time.monotonic() - started >= self.max_duration:
+                logger.info(f"[{job.save_name}] recorded for {self.max_duration:.0f}s")
+                return
+            interval = playlist.target_duration if segments else playlist.target_duration / 2
+            await asyncio.sleep(max(0.0, polled_at + max(interval, 0.5) - time.monotonic()))
+
+    async def poll(self, session: aiohttp.ClientSession, job: "VideoJob") -> Playlist:
+        """Fetch and parse the media playlist in memory, selecting a variant on first poll of a master playlist"""
+        async with session.get(job.media_url, headers=job.headers, **GetConfig) as response:
+            if response.status != 200:
+                raise DownloadError(job.media_url, f"HTTP {response.status}", status=response.status)
+            text = await response.text()
+        playlist = parse_playlist(text.splitlines(), job.media_url)
+        if not playlist.is_master:
+            return playlist
+        if job.media_url != job.blob_url:
+            raise PlaylistError(f"variant is a master playlist: {job.media_url}")
+        config = self.blob.variant_config
+        # auto needs a finished playlist to size the video, a live one takes the highest variant
+        policy = "highest" if config["policy"] == "auto" else config["policy"]
+        variant = select_variant(playlist.variants, policy, config["max_bandwidth"], config["resolution"])
+        self.blob.use_variant(job, variant)
+        return await self.poll(session, job)
+
+    def segment_task(self, job: "VideoJob", segment: Segment, aes_keys: Dict[str, AESKey]) -> Task:
+        """Build the download task of a new segment, saved under its media sequence number"""
+        save_path = os.path.join(job.tmp_path, f"live{segment.sequence}.ts")
+        aes_key, iv = None, None
+        if segment.key is not None:
+            aes_key = self.blob.decrypt_key(job, segment.key, aes_keys)
+            if aes_key is None:
+                raise LiveError(f"{segment.key.method} segments cannot be decrypted while recording")
+            iv = parse_iv(segment.key.iv) if segment.key.iv else sequence_iv(segment.sequence)
+        task = Task(segment.url, save_path, job.save_name, aes_key, iv, headers=job.headers)
+        if segment.byterange is not None:
+            task.parts = [TaskPart(segment.byterange[1], segment.byterange[0], save_path, iv)]
+        return task
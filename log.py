@@ -1,8 +1,14 @@
 import logging
 
-# logger
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d:%(funcName)s] - %(message)s"
-)
-
 logger = logging.getLogger("download_blob_videos")
+
+
+def setup_logging(level: int = logging.INFO):
+    """Print log records to stderr, called by the entry points rather than on import
+
+    Args:
+        level (int, optional): Lowest level printed. Defaults to logging.INFO.
+    """
+    logging.basicConfig(
+        level=level, format="%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d:%(funcName)s] - %(message)s"
+    )
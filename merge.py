@@ -0,0 +1,103 @@
+import shutil
+import asyncio
+import subprocess
+from typing import List
+
+
+class MergeError(Exception):
+    """Custom exception for merge failures"""
+
+
+def ffmpeg_args(local_m3u8_file: str, merged_path: str) -> List[str]:
+    """Command line of the ffmpeg remuxing the segments of a local playlist into one video
+
+    Args:
+        local_m3u8_file (str): Path to local m3u8 file with local media paths
+        merged_path (str): Path of the merged video, overwritten
+
+    Returns:
+        List[str]: ffmpeg and its arguments
+    """
+    return [
+        "ffmpeg",
+        "-extension_picky",
+        "false",
+        "-allowed_segment_extensions",
+        "ALL",
+        "-protocol_whitelist",
+        "file,http,https,tcp,tls,crypto",
+        "-allowed_extensions",
+        "ALL",
+        "-i",
+        local_m3u8_file,
+        "-c",
+        "copy",
+        merged_path,
+        "-loglevel",
+        "error",
+        "-y",
+    ]
+
+
+def ffmpeg_error(returncode: int, stderr: bytes) -> MergeError:
+    """Describe a failed merge with the last lines ffmpeg wrote to stderr"""
+    lines = [line.strip() for line in stderr.decode(errors="replace").splitlines() if line.strip()]
+    return MergeError(f"ffmpeg failed (code {returncode}): {'; '.join(lines[-20:]) or 'no output'}")
+
+
+def run_ffmpeg(local_m3u8_file: str, merged_path: str):
+    """Merge a local playlist with ffmpeg, blocking until it exits
+
+    Raises:
+        MergeError: if ffmpeg is missing or failed
+    """
+    try:
+        process = subprocess.run(
+            ffmpeg_args(local_m3u8_file, merged_path), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        raise MergeError("ffmpeg is not installed or not in PATH")
+    if process.returncode != 0:
+        raise ffmpeg_error(process.returncode, process.stderr)
+
+
+async def async_run_ffmpeg(local_m3u8_file: str, merged_path: str):
+    """Merge a local playlist with ffmpeg without blocking the event loop
+
+    Raises:
+        MergeError: if ffmpeg is missing or failed
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_args(local_m3u8_file, merged_path),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise MergeError("ffmpeg is not installed or not in PATH")
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # a cancelled batch must not leave ffmpeg writing behind it
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise ffmpeg_error(process.returncode, stderr)
+
+
+def concat_segments(segment_paths: List[str], merged_path: str):
+    """Concatenate MPEG-TS segments into one video, no remuxing needed
+
+    A transport stream is a sequence of self-contained 188 byte packets, so
+    whole unencrypted segments appended in playlist order are a valid video.
+
+    Args:
+        segment_paths (List[str]): Segment files in playlist order
+        merged_path (str): Path of the merged video, overwritten
+    """
+    with open(merged_path, "wb") as fp:
+        for path in segment_paths:
+            with open(path, "rb") as src:
+                shutil.copyfileobj(src, fp, 1024 * 1024)
@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import aiohttp
+from collections import deque
+from typing import Deque, Dict, List
+
+
+class SegmentMetric:
+    """SegmentMetric holds the measurements of one downloaded file, summed over its retries"""
+
+    __slots__ = (
+        "video",
+        "url",
+        "host",
+        "status",
+        "error",
+        "retries",
+        "bytes",
+        "ttfb",
+        "transfer_time",
+        "slot_wait",
+        "pool_wait",
+        "pool_queued_at",
+        "started_at",
+        "hedge",
+        "rejected",
+        "finished_at",
+    )
+
+    def __init__(self, video: str, url: str, host: str) -> None:
+        self.video = video
+        self.url = url
+        self.host = host
+        self.status = ""
+        self.error = ""
+        self.retries = 0
+        self.bytes = 0
+        # time to first byte of the last attempt
+        self.ttfb = 0.0
+        self.transfer_time = 0.0
+        self.slot_wait = 0.0
+        self.pool_wait = 0.0
+        self.pool_queued_at = 0.0
+        # when the last attempt got its request slot
+        self.started_at = 0.0
+        # "won" or "lost" when a duplicate request was sent, see hedge.HedgePolicy
+        self.hedge = ""
+        # bodies that failed validation, see validate.SegmentValidator
+        self.rejected = 0
+        self.finished_at = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "type": "segment",
+            "video": self.video,
+            "url": self.url,
+            "host": self.host,
+            "status": self.status,
+            "error": self.error,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "ttfb": round(self.ttfb, 6),
+            "transfer_time": round(self.transfer_time, 6),
+            "slot_wait": round(self.slot_wait, 6),
+            "pool_wait": round(self.pool_wait, 6),
+            "hedge": self.hedge,
+            "rejected": self.rejected,
+            "finished_at": self.finished_at,
+        }
+
+
+class VideoMetric:
+    """VideoMetric holds the measurements of one video"""
+
+    __slots__ = (
+        "video",
+        "status",
+        "error",
+        "segments",
+        "cached",
+        "bytes",
+        "playlist_time",
+        "download_time",
+        "merge_time",
+    )
+
+    def __init__(self, video: str) -> None:
+        self.video = video
+        self.status = ""
+        self.error = ""
+        self.segments = 0
+        # files linked from the segment cache instead of downloaded
+        self.cached = 0
+        self.bytes = 0
+        self.playlist_time = 0.0
+        self.download_time = 0.0
+        self.merge_time = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "type": "video",
+            "video": self.video,
+            "status": self.status,
+            "error": self.error,
+            "segments": self.segments,
+            "cached": self.cached,
+            "bytes": self.bytes,
+            "playlist_time": round(self.playlist_time, 6),
+            "download_time": round(self.download_time, 6),
+            "merge_time": round(self.merge_time, 6),
+        }
+
+
+def pool_wait_trace_config() -> aiohttp.TraceConfig:
+    """Build a trace config adding connection pool waits to the SegmentMetric passed as trace_request_ctx"""
+
+    async def on_queued_start(session, context, params):
+        metric = context.trace_request_ctx
+        if isinstance(metric, SegmentMetric):
+            metric.pool_queued_at = time.monotonic()
+
+    async def on_queued_end(session, context, params):
+        metric = context.trace_request_ctx
+        if isinstance(metric, SegmentMetric) and metric.pool_queued_at:
+            metric.pool_wait += time.monotonic() - metric.pool_queued_at
+            metric.pool_queued_at = 0.0
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_queued_start.append(on_queued_start)
+    trace_config.on_connection_queued_end.append(on_queued_end)
+    return trace_config
+
+
+class MetricsSink:
+    """MetricsSink receives every finished segment and video"""
+
+    def segment(self, metric: SegmentMetric):
+        pass
+
+    def video(self, metric: VideoMetric):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class MemorySink(MetricsSink):
+    """MemorySink keeps totals and the latest timings to summarize a run"""
+
+    def __init__(self, window: int = 10000, max_videos: int = 1000):
+        """Initialize in-memory sink
+
+        Args:
+            window (int, optional): Latest segments whose timings are kept for percentiles. Defaults to 10000.
+            max_videos (int, optional): Latest videos whose records are kept, older ones only in the totals.
+                Defaults to 1000.
+        """
+        self.segments = 0
+        self.failed_segments = 0
+        self.bytes = 0
+        self.retries = 0
+        self.rejected = 0
+        self.hedges: Dict[str, int] = dict()
+        self.errors: Dict[str, int] = dict()
+        self.timings: Dict[str, Deque[float]] = {
+            name: deque(maxlen=window) for name in ("ttfb", "transfer_time", "slot_wait", "pool_wait", "merge_time")
+        }
+        self.videos: Deque[dict] = deque(maxlen=max_videos)
+        self.video_statuses: Dict[str, int] = dict()
+
+    def segment(self, metric: SegmentMetric):
+        self.segments += 1
+        self.bytes += metric.bytes
+        self.retries += metric.retries
+        self.rejected += metric.rejected
+        if metric.hedge:
+            self.hedges[metric.hedge] = self.hedges.get(metric.hedge, 0) + 1
+        if metric.error:
+            self.failed_segments += 1
+            self.errors[metric.error] = self.errors.get(metric.error, 0) + 1
+        else:
+            for name in ("ttfb", "transfer_time", "slot_wait", "pool_wait"):
+                self.timings[name].append(getattr(metric, name))
+
+    def video(self, metric: VideoMetric):
+        self.videos.append(metric.to_dict())
+        self.video_statuses[metric.status] = self.video_statuses.get(metric.status, 0) + 1
+        if metric.merge_time:
+            self.timings["merge_time"].append(metric.merge_time)
+
+    def summary(self) -> dict:
+        """Summarize the run
+
+        Returns:
+            dict: totals, error classes, p50/p99 of every timing in seconds and the latest videos
+        """
+        timings = dict()
+        for name, values in self.timings.items():
+            ordered = sorted(values)
+            timings[name] = {
+                "p50": percentile(ordered, 0.5),
+                "p99": percentile(ordered, 0.99),
+                "max": ordered[-1] if ordered else 0.0,
+            }
+        return {
+            "segments": self.segments,
+            "failed_segments": self.failed_segments,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "hedges": dict(self.hedges),
+            "errors": dict(self.errors),
+            "timings": timings,
+            "video_statuses": dict(self.video_statuses),
+            "videos": list(self.videos),
+        }
+
+
+class JsonLinesSink(MetricsSink):
+    """JsonLinesSink appends one JSON line per segment and per video"""
+
+    def __init__(self, path: str):
+        """Initialize JSON lines sink
+
+        Args:
+            path (str): File to append to
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fp = open(path, "a")
+
+    def segment(self, metric: SegmentMetric):
+        self.fp.write(json.dumps(metric.to_dict()) + "\n")
+
+    def video(self, metric: VideoMetric):
+        self.fp.write(json.dumps(metric.to_dict()) + "\n")
+        self.fp.flush()
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def label(name: str, value: str) -> str:
+    """Format a Prometheus label, escaping backslashes, double quotes and line feeds of its value"""
+    value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{name}="{value}"'
+
+
+class Histogram:
+    """Histogram with cumulative buckets, as Prometheus expects"""
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class PrometheusSink(MetricsSink):
+    """PrometheusSink writes counters and histograms in the Prometheus text format.
+
+    The file is replaced atomically on every flush, so it can be read by the
+    node exporter textfile collector at any time.
+    """
+
+    TIME_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+    def __init__(self, path: str, flush_interval: float = 10.0):
+        """Initialize Prometheus sink
+
+        Args:
+            path (str): File to write, e.g. in the textfile collector directory
+            flush_interval (float, optional): Minimum seconds between two writes while segments arrive. Defaults to 10.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.last_flush = 0.0
+        self.counters: Dict[str, Dict[str, float]] = dict()
+        self.histograms: Dict[str, Histogram] = {
+            name: Histogram(self.TIME_BUCKETS)
+            for name in (
+                "segment_ttfb_seconds",
+                "segment_transfer_seconds",
+                "segment_slot_wait_seconds",
+                "segment_pool_wait_seconds",
+                "video_merge_seconds",
+            )
+        }
+
+    def _inc(self, name: str, labels: str, value: float = 1):
+        series = self.counters.setdefault(name, dict())
+        series[labels] = series.get(labels, 0) + value
+
+    def segment(self, metric: SegmentMetric):
+        status = "failed" if metric.error else "done"
+        self._inc("segments_total", label("status", status))
+        self._inc("segment_bytes_total", label("host", metric.host), metric.bytes)
+        self._inc("segment_retries_total", label("host", metric.host), metric.retries)
+        if metric.rejected:
+            self._inc("segment_rejected_total", label("host", metric.host), metric.rejected)
+        if metric.hedge:
+            self._inc("segment_hedges_total", label("result", metric.hedge))
+        if metric.error:
+            self._inc("segment_errors_total", label("error", metric.error))
+        else:
+            self.histograms["segment_ttfb_seconds"].observe(metric.ttfb)
+            self.histograms["segment_transfer_seconds"].observe(metric.transfer_time)
+            self.histograms["segment_slot_wait_seconds"].observe(metric.slot_wait)
+            self.histograms["segment_pool_wait_seconds"].observe(metric.pool_wait)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def video(self, metric: VideoMetric):
+        self._inc("videos_total", label("status", metric.status))
+        if metric.merge_time:
+            self.histograms["video_merge_seconds"].observe(metric.merge_time)
+        self.flush()
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format"""
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE blob_{name} counter")
+            for labels, value in series.items():
+                lines.append(f"blob_{name}{{{labels}}} {value:g}")
+        for name, histogram in self.histograms.items():
+            lines.append(f"# TYPE blob_{name} histogram")
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'blob_{name}_bucket{{le="{bound:g}"}} {count}')
+            lines.append(f'blob_{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"blob_{name}_sum {histogram.sum:g}")
+            lines.append(f"blob_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(self.render())
+        os.replace(tmp_path, self.path)
+
+
+def percentile(ordered: List[float], ratio: float) -> float:
+    """Get a percentile of sorted values, 0 if empty"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+
+class Metrics:
+    """Metrics dispatches segment and video measurements to its sinks, the first one is always in memory"""
+
+    def __init__(self, jsonl_path: str = "", prometheus_path: str = ""):
+        """Initialize metrics
+
+        Args:
+            jsonl_path (str, optional): Also append every record to this JSON lines file. Defaults to "".
+            prometheus_path (str, optional): Also write Prometheus text format to this file. Defaults to "".
+        """
+        self.memory = MemorySink()
+        self.sinks: List[MetricsSink] = [self.memory]
+        if jsonl_path:
+            self.sinks.append(JsonLinesSink(jsonl_path))
+        if prometheus_path:
+            self.sinks.append(PrometheusSink(prometheus_path))
+
+    def add_sink(self, sink: MetricsSink):
+        """Send measurements to another sink"""
+        self.sinks.append(sink)
+
+    def segment(self, metric: SegmentMetric):
+        metric.finished_at = time.time()
+        for sink in self.sinks:
+            sink.segment(metric)
+
+    def video(self, metric: VideoMetric):
+        for sink in self.sinks:
+            sink.video(metric)
+
+    def summary(self) -> dict:
+        """Summary of everything measured so far, see MemorySink.summary"""
+        return self.memory.summary()
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,378 @@
+from urllib.parse import urljoin
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class PlaylistError(Exception):
+    """Raised when a file is not an M3U8 playlist"""
+
+
+class Key:
+    """Key holds an EXT-X-KEY tag, shared by all the segments it applies to"""
+
+    __slots__ = ("method", "uri", "url", "iv", "key_format", "line")
+
+    def __init__(self, attributes: Dict[str, str], resolve: Callable[[str], str], line: str) -> None:
+        self.method = attributes.get("METHOD", "NONE")
+        self.uri = attributes.get("URI", "")
+        self.url = resolve(self.uri) if self.uri else ""
+        # hexadecimal IV as written, e.g. 0x0000000000000000000000000000000a
+        self.iv = attributes.get("IV", "")
+        self.key_format = attributes.get("KEYFORMAT", "identity")
+        self.line = line
+
+    def __repr__(self) -> str:
+        return f"Key({self.method}, {self.url})"
+
+
+class InitSection:
+    """InitSection holds an EXT-X-MAP tag, the initialization section of the segments after it"""
+
+    __slots__ = ("uri", "url", "byterange", "line")
+
+    def __init__(self, attributes: Dict[str, str], resolve: Callable[[str], str], line: str) -> None:
+        self.uri = attributes.get("URI", "")
+        self.url = resolve(self.uri)
+        self.byterange = parse_byterange(attributes["BYTERANGE"], 0) if "BYTERANGE" in attributes else None
+        self.line = line
+
+    def __repr__(self) -> str:
+        return f"InitSection({self.url})"
+
+
+class Segment:
+    """Segment is a media segment of a playlist, kept compact for playlists of 100k segments"""
+
+    __slots__ = ("uri", "url", "duration", "sequence", "byterange", "key", "init", "discontinuity")
+
+    def __init__(
+        self,
+        uri: str,
+        url: str,
+        duration: float,
+        sequence: int,
+        byterange: Optional[Tuple[int, int]],
+        key: Optional[Key],
+        init: Optional[InitSection],
+        discontinuity: bool,
+    ) -> None:
+        self.uri = uri
+        # absolute URL, resolved against the playlist URL as RFC 3986 says
+        self.url = url
+        self.duration = duration
+        # media sequence number
+        self.sequence = sequence
+        # (length, offset) of an EXT-X-BYTERANGE sub-range, None for the whole resource
+        self.byterange = byterange
+        self.key = key
+        self.init = init
+        self.discontinuity = discontinuity
+
+    def __repr__(self) -> str:
+        return f"Segment({self.sequence}, {self.url})"
+
+
+class Variant:
+    """Variant is an EXT-X-STREAM-INF entry of a master playlist, one rendition of the video"""
+
+    __slots__ = ("uri", "url", "bandwidth", "average_bandwidth", "resolution", "codecs")
+
+    def __init__(self, attributes: Dict[str, str], uri: str, url: str) -> None:
+        self.uri = uri
+        # absolute URL of the media playlist of the variant
+        self.url = url
+        # peak and average bits per second
+        self.bandwidth = int(attributes.get("BANDWIDTH") or 0)
+        self.average_bandwidth = int(attributes.get("AVERAGE-BANDWIDTH") or 0)
+        width, _, height = attributes.get("RESOLUTION", "").partition("x")
+        self.resolution = (int(width), int(height)) if width.isdigit() and height.isdigit() else None
+        self.codecs = attributes.get("CODECS", "")
+
+    @property
+    def height(self) -> int:
+        return self.resolution[1] if self.resolution is not None else 0
+
+    def __repr__(self) -> str:
+        return f"Variant({self.bandwidth}, {self.resolution}, {self.url})"
+
+
+class Playlist:
+    """Playlist is a parsed media playlist, or a master playlist listing variants"""
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.version = 1
+        self.target_duration = 0.0
+        self.media_sequence = 0
+        self.playlist_type = ""
+        self.endlist = False
+        # tags of the whole playlist to keep in a rewritten playlist, e.g. EXT-X-VERSION
+        self.header: List[str] = []
+        self.segments: List[Segment] = []
+        self.keys: List[Key] = []
+        self.init_sections: List[InitSection] = []
+        # variants of a master playlist, which has no segments
+        self.variants: List[Variant] = []
+
+    @property
+    def is_master(self) -> bool:
+        return bool(self.variants)
+
+    @property
+    def duration(self) -> float:
+        return sum(segment.duration for segment in self.segments)
+
+    def __repr__(self) -> str:
+        return f"Playlist({self.url}, {len(self.segments)} segments)"
+
+
+def url_resolver(base_url: str) -> Callable[[str], str]:
+    """Build a function resolving URI references against a base URL as RFC 3986 says
+
+    urljoin is slow for 100k segments, so plain relative paths and absolute
+    URLs without dot segments, by far the most common, skip it.
+
+    Args:
+        base_url (str): URL of the playlist
+
+    Returns:
+        Callable[[str], str]: function returning the absolute URL of a URI reference
+    """
+    base_dir = urljoin(base_url, "_")[:-1]
+
+    def resolve(uri: str) -> str:
+        if "/." in uri or uri[0] in "./?#":
+            return urljoin(base_url, uri)
+        if ":" not in uri:
+            return base_dir + uri
+        if uri.startswith(("http://", "https://")):
+            return uri
+        return urljoin(base_url, uri)
+
+    return resolve
+
+
+def parse_attributes(text: str) -> Dict[str, str]:
+    """Parse an attribute list, e.g. METHOD=AES-128,URI="key?a=1,b=2",IV=0x01
+
+    Quoted values may contain commas, their quotes are removed.
+
+    Args:
+        text (str): attribute list after the tag name
+
+    Returns:
+        Dict[str, str]: attribute values by name
+    """
+    attributes = dict()
+    pos, length = 0, len(text)
+    while pos < length:
+        equal = text.find("=", pos)
+        if equal < 0:
+            break
+        name = text[pos:equal].strip()
+        if equal + 1 < length and text[equal + 1] == '"':
+            end = text.find('"', equal + 2)
+            end = length if end < 0 else end
+            attributes[name] = text[equal + 2 : end]
+            comma = text.find(",", end)
+        else:
+            comma = text.find(",", equal)
+            attributes[name] = text[equal + 1 : length if comma < 0 else comma].strip()
+        if comma < 0:
+            break
+        pos = comma + 1
+    return attributes
+
+
+def parse_byterange(text: str, next_offset: int) -> Tuple[int, int]:
+    """Parse an EXT-X-BYTERANGE value `<length>[@<offset>]`
+
+    Args:
+        text (str): byte range value
+        next_offset (int): offset when none is given, the end of the previous sub-range of the same resource
+
+    Returns:
+        Tuple[int, int]: length and offset
+    """
+    length, _, offset = text.strip().partition("@")
+    return int(length), int(offset) if offset else next_offset
+
+
+def parse_playlist(lines: Iterable[str], url: str) -> Playlist:
+    """Parse a media playlist line by line
+
+    Args:
+        lines (Iterable[str]): lines of the playlist, e.g. an open file
+        url (str): URL of the playlist, relative URIs are resolved against it
+
+    Returns:
+        Playlist: parsed playlist
+
+    Raises:
+        PlaylistError: if the lines do not start with #EXTM3U
+    """
+    playlist = Playlist(url)
+    segments = playlist.segments
+    resolve = url_resolver(url)
+    started = False
+    sequence = None
+    duration = 0.0
+    byterange: Optional[Tuple[int, int]] = None
+    key: Optional[Key] = None
+    init: Optional[InitSection] = None
+    discontinuity = False
+    # attributes of an EXT-X-STREAM-INF tag, the next URI is a variant
+    stream_inf: Optional[Dict[str, str]] = None
+    # end of the last sub-range of every resource, where a byte range without offset starts
+    range_ends: Dict[str, int] = dict()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if not started:
+            if not line.startswith("#EXTM3U"):
+                raise PlaylistError(f"not an M3U8 playlist: {url}")
+            started = True
+            continue
+        if line[0] != "#":
+            if stream_inf is not None:
+                playlist.variants.append(Variant(stream_inf, line, resolve(line)))
+                stream_inf = None
+                continue
+            if sequence is None:
+                sequence = playlist.media_sequence
+            segment_url = resolve(line)
+            if byterange is not None:
+                byterange = (byterange[0], range_ends.get(segment_url, 0) if byterange[1] < 0 else byterange[1])
+                range_ends[segment_url] = byterange[0] + byterange[1]
+            segments.append(Segment(line, segment_url, duration, sequence, byterange, key, init, discontinuity))
+            sequence += 1
+            duration = 0.0
+            byterange = None
+            discontinuity = False
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[8:].split(",", 1)[0] or 0)
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            # the offset is resolved once the URI is known
+            byterange = parse_byterange(line[17:], -1)
+        elif line.startswith("#EXT-X-KEY:"):
+            key = Key(parse_attributes(line[11:]), resolve, line)
+            if key.method == "NONE":
+                key = None
+            else:
+                playlist.keys.append(key)
+        elif line.startswith("#EXT-X-DISCONTINUITY") and not line.startswith("#EXT-X-DISCONTINUITY-SEQUENCE"):
+            discontinuity = True
+        elif line.startswith("#EXT-X-MAP:"):
+            init = InitSection(parse_attributes(line[11:]), resolve, line)
+            playlist.init_sections.append(init)
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            playlist.media_sequence = int(line[22:])
+            playlist.header.append(line)
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            playlist.target_duration = float(line[22:])
+            playlist.header.append(line)
+        elif line.startswith("#EXT-X-VERSION:"):
+            playlist.version = int(line[15:])
+            playlist.header.append(line)
+        elif line.startswith("#EXT-X-PLAYLIST-TYPE:"):
+            playlist.playlist_type = line[21:]
+            playlist.header.append(line)
+        elif line.startswith("#EXT-X-STREAM-INF:"):
+            stream_inf = parse_attributes(line[18:])
+        elif line.startswith("#EXT-X-ENDLIST"):
+            playlist.endlist = True
+        elif line.startswith(("#EXT-X-INDEPENDENT-SEGMENTS", "#EXT-X-DISCONTINUITY-SEQUENCE:")):
+            playlist.header.append(line)
+    if not started:
+        raise PlaylistError(f"empty playlist: {url}")
+    return playlist
+
+
+def load_playlist(path: str, url: str) -> Playlist:
+    """Parse a playlist file without reading it whole
+
+    Args:
+        path (str): path of the playlist file
+        url (str): URL the playlist was downloaded from
+
+    Returns:
+        Playlist: parsed playlist
+    """
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        return parse_playlist(fp, url)
+
+
+def is_master_playlist(path: str) -> bool:
+    """Whether a playlist file is a master playlist, reading it only up to its first variant or segment"""
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        for line in fp:
+            if line.startswith("#EXT-X-STREAM-INF:"):
+                return True
+            if line.startswith("#EXTINF:"):
+                return False
+    return False
+
+
+def parse_resolution(text: str) -> int:
+    """Parse a target resolution, e.g. 720p or 1280x720, into its height"""
+    text = text.strip().lower()
+    if "x" in text:
+        return int(text.partition("x")[2])
+    return int(text.rstrip("p"))
+
+
+def select_variant(
+    variants: List[Variant], policy: str = "highest", max_bandwidth: int = 0, resolution: str = ""
+) -> Variant:
+    """Select the variant of a master playlist to download
+
+    Args:
+        variants (List[Variant]): Variants of the master playlist
+        policy (str, optional): highest or lowest bandwidth, max_bandwidth for the highest
+            variant within max_bandwidth, resolution for the highest variant not above
+            resolution. Defaults to "highest".
+        max_bandwidth (int, optional): Bits per second, for the max_bandwidth policy. Defaults to 0.
+        resolution (str, optional): e.g. 720p or 1280x720, for the resolution policy. Defaults to "".
+
+    Returns:
+        Variant: Selected variant, the lowest one when none fits
+
+    Raises:
+        ValueError: if the policy is unknown
+    """
+    ordered = sorted(variants, key=lambda variant: variant.bandwidth)
+    if policy == "highest":
+        return ordered[-1]
+    if policy == "lowest":
+        return ordered[0]
+    if policy == "max_bandwidth":
+        fitting = [variant for variant in ordered if variant.bandwidth <= max_bandwidth]
+        return fitting[-1] if fitting else ordered[0]
+    if policy == "resolution":
+        height = parse_resolution(resolution)
+        fitting = [variant for variant in ordered if 0 < variant.height <= height]
+        if not fitting:
+            # no variant small enough, or none tells its resolution
+            return min(ordered, key=lambda variant: variant.height) if ordered[0].resolution else ordered[-1]
+        return max(fitting, key=lambda variant: (variant.height, variant.bandwidth))
+    raise ValueError(f"unknown variant policy: {policy}")
+
+
+def fit_variant(variants: List[Variant], throughput: float, duration: float, deadline: float) -> Variant:
+    """Select the highest variant whose download is expected to finish within a deadline
+
+    Args:
+        variants (List[Variant]): Variants of the master playlist
+        throughput (float): Measured download speed in bytes per second
+        duration (float): Duration of the video in seconds
+        deadline (float): Seconds the download may take
+
+    Returns:
+        Variant: Highest variant fitting the deadline, the lowest one when none does
+    """
+    ordered = sorted(variants, key=lambda variant: variant.bandwidth)
+    for variant in reversed(ordered):
+        size = duration * (variant.average_bandwidth or variant.bandwidth) / 8
+        if size <= throughput * deadline:
+            return variant
+    return ordered[0]
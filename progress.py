@@ -1,16 +1,24 @@
-from typing import Optional
+import sys
+import time
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple
 
+from log import logger
 from rich.table import Column
 from rich.text import Text
+from rich.console import RenderableType
 from rich.progress import (
     Task,
+    TaskID,
     BarColumn,
     Progress,
     TextColumn,
+    DownloadColumn,
     ProgressColumn,
     TimeElapsedColumn,
-    TimeRemainingColumn,
 )
+from rich.filesize import decimal
 
 
 class FileCountColumn(ProgressColumn):
@@ -21,7 +29,9 @@ class FileCountColumn(ProgressColumn):
 
     def render(self, task: "Task") -> Text:
         """Calculate common unit for completed and total."""
-        completed = int(task.completed)
+        # rows of a TransferProgress count bytes, their files are in the fields
+        completed = int(task.fields.get("files", task.completed))
+        files_total = task.fields["files_total"] if "files" in task.fields else task.total
 
         # unit_and_suffix_calculation_base = (
         #     int(task.total) if task.total is not None else completed
@@ -32,8 +42,8 @@ class FileCountColumn(ProgressColumn):
         completed_ratio = completed / unit
         completed_str = f"{completed_ratio:,.{precision}f}"
 
-        if task.total is not None:
-            total = int(task.total)
+        if files_total is not None:
+            total = int(files_total)
             total_ratio = total / unit
             total_str = f"{total_ratio:,.{precision}f}"
         else:
@@ -44,11 +54,333 @@ class FileCountColumn(ProgressColumn):
         return download_text
 
 
-files_progress = Progress(
-    TextColumn("[progress.description]{task.description}"),
-    BarColumn(),
-    TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-    FileCountColumn(),
-    TimeRemainingColumn(),
-    TimeElapsedColumn(),
-)
+class SpeedColumn(ProgressColumn):
+    """Transfer speed measured by TransferProgress"""
+
+    def render(self, task: "Task") -> Text:
+        speed = task.fields.get("speed")
+        if speed is None:
+            return Text("?", style="progress.data.speed")
+        return Text(f"{decimal(int(speed))}/s", style="progress.data.speed")
+
+
+class EtaColumn(ProgressColumn):
+    """Time remaining estimated by TransferProgress"""
+
+    def render(self, task: "Task") -> Text:
+        return Text(format_seconds(task.fields.get("eta")), style="progress.remaining")
+
+
+def format_seconds(seconds: Optional[float]) -> str:
+    """Format seconds as h:mm:ss, -:--:-- if unknown"""
+    if seconds is None:
+        return "-:--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+class RateMeter:
+    """RateMeter measures the growth per second of a counter over the last `window` seconds"""
+
+    __slots__ = ("window", "samples")
+
+    def __init__(self, window: float = 10.0) -> None:
+        self.window = window
+        self.samples: Deque[Tuple[float, int]] = deque()
+
+    def update(self, now: float, value: int) -> float:
+        self.samples.append((now, value))
+        # keep one sample older than the window
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        first_time, first_value = self.samples[0]
+        return (value - first_value) / (now - first_time) if now > first_time else 0.0
+
+
+class TransferStats:
+    """TransferStats holds the byte and file counters of one progress row"""
+
+    __slots__ = ("bytes", "files", "files_total", "failed", "known_files", "known_bytes")
+
+    def __init__(self, files_total: Optional[int] = None) -> None:
+        self.bytes = 0
+        self.files = 0
+        self.files_total = files_total
+        self.failed = 0
+        # files whose size is known, from Content-Length or once finished
+        self.known_files = 0
+        self.known_bytes = 0
+
+    def estimated_total(self) -> Optional[float]:
+        """Estimate the bytes of all files, files of unknown size are as large as the known ones on average"""
+        if self.files_total is None:
+            return None
+        unknown = self.files_total - self.failed - self.known_files
+        if unknown <= 0:
+            return self.known_bytes
+        if not self.known_files:
+            return None
+        return self.known_bytes + unknown * self.known_bytes / self.known_files
+
+
+class FileTransfer:
+    """FileTransfer counts the bytes of one file into its progress row and its host"""
+
+    __slots__ = ("stats", "host", "received", "size")
+
+    def __init__(self, stats: TransferStats, host: TransferStats) -> None:
+        self.stats = stats
+        self.host = host
+        # bytes of the file counted in stats.bytes
+        self.received = 0
+        self.size: Optional[int] = None
+
+    def start(self, offset: int, size: Optional[int]):
+        """Start an attempt at `offset`, `size` is the size of the whole file if known"""
+        # bytes resumed from disk count as done, a restart takes back what was received
+        self.stats.bytes += offset - self.received
+        self.received = offset
+        if size is None:
+            return
+        if self.size is None:
+            self.stats.known_files += 1
+            self.stats.known_bytes += size
+        else:
+            self.stats.known_bytes += size - self.size
+        self.size = size
+
+    def add(self, nbytes: int):
+        self.received += nbytes
+        self.stats.bytes += nbytes
+        self.host.bytes += nbytes
+
+    def done(self):
+        if self.size is None:
+            self.start(self.received, self.received)
+        self.stats.files += 1
+        self.host.files += 1
+
+    def cancel(self):
+        """Take the attempt back without counting a failure, e.g. a request that lost to its hedge"""
+        self.stats.bytes -= self.received
+        self.received = 0
+        if self.size is not None:
+            self.stats.known_files -= 1
+            self.stats.known_bytes -= self.size
+            self.size = None
+
+    def failed(self):
+        self.cancel()
+        self.stats.failed += 1
+
+
+class _SyncedProgress(Progress):
+    """Progress pulling the counters of a TransferProgress right before every render"""
+
+    def __init__(self, *columns: ProgressColumn, transfers: "TransferProgress", **kwargs) -> None:
+        self.transfers = transfers
+        super().__init__(*columns, **kwargs)
+
+    def get_renderables(self) -> Iterable[RenderableType]:
+        self.transfers.sync()
+        yield from super().get_renderables()
+        hosts = self.transfers.host_progress
+        if self.transfers.show_hosts and hosts.tasks:
+            yield hosts.make_tasks_table(hosts.tasks)
+
+
+class TransferProgress:
+    """TransferProgress shows downloads in bytes with aggregate and per-host throughput.
+
+    Downloads only add to plain counters through `FileTransfer`, the rich
+    rows are updated from them when the display refreshes, so the cost of a
+    chunk does not depend on how often the screen is drawn. Without a
+    terminal (or with `headless`), one line of stats is logged every
+    `log_interval` seconds instead.
+    """
+
+    def __init__(
+        self,
+        refresh_per_second: float = 4,
+        headless: Optional[bool] = None,
+        log_interval: float = 10.0,
+        show_hosts: bool = True,
+    ):
+        """Initialize transfer progress
+
+        Args:
+            refresh_per_second (float, optional): Redraws per second of the terminal display. Defaults to 4.
+            headless (bool, optional): Log stats lines instead of drawing bars, None to decide by whether stderr is a terminal. Defaults to None.
+            log_interval (float, optional): Seconds between two stats lines in headless mode. Defaults to 10.
+            show_hosts (bool, optional): Add a row with the throughput of every host. Defaults to True.
+        """
+        self.headless = not sys.stderr.isatty() if headless is None else headless
+        self.log_interval = log_interval
+        self.show_hosts = show_hosts
+        self.disable = False
+        self.rows: Dict[TaskID, TransferStats] = dict()
+        self.hosts: Dict[str, TransferStats] = dict()
+        self.host_rows: Dict[str, TaskID] = dict()
+        # rich resets its own speed whenever the total changes, and the estimated total always does
+        self.row_meters: Dict[TaskID, RateMeter] = dict()
+        self.host_meters: Dict[str, RateMeter] = dict()
+        # finished rows already in a stats line
+        self.reported: Set[TaskID] = set()
+        self.lock = threading.Lock()
+        # runs inside `with`, concurrent runs of one downloader share the display until the last one exits
+        self.users = 0
+        self.stop_logging = threading.Event()
+        self.logging_thread: Optional[threading.Thread] = None
+        # only rendered below the rows of self.progress, never started on its own
+        self.host_progress = Progress(
+            TextColumn("  {task.description}"),
+            FileCountColumn(),
+            DownloadColumn(),
+            SpeedColumn(),
+            disable=True,
+        )
+        # rich draws once while building, the counters must exist by then
+        self.progress = _SyncedProgress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+            FileCountColumn(),
+            DownloadColumn(),
+            SpeedColumn(),
+            EtaColumn(),
+            TimeElapsedColumn(),
+            transfers=self,
+            refresh_per_second=refresh_per_second,
+        )
+
+    def add_task(self, description: str, total: Optional[int] = None) -> TaskID:
+        """Add a progress row
+
+        Args:
+            description (str): Description of the row
+            total (int, optional): Number of files, None if unknown. Defaults to None.
+
+        Returns:
+            TaskID: ID of the row
+        """
+        task_id = self.progress.add_task(description=description, total=None, files=0, files_total=total)
+        self.rows[task_id] = TransferStats(total)
+        return task_id
+
+    def update(self, task_id: TaskID, description: Optional[str] = None, total: Optional[int] = None):
+        """Change the description or the number of files of a row"""
+        if total is not None:
+            self.rows[task_id].files_total = total
+        if description is not None:
+            self.progress.update(task_id, description=description)
+
+    def add_total(self, task_id: TaskID, count: int):
+        """Add files to a row whose total grows as the work is discovered"""
+        stats = self.rows[task_id]
+        stats.files_total = (stats.files_total or 0) + count
+
+    def remove_task(self, task_id: TaskID):
+        """Drop the row of a finished run, a long-lived downloader would keep every one otherwise"""
+        with self.lock:
+            self.rows.pop(task_id, None)
+            self.row_meters.pop(task_id, None)
+            self.reported.discard(task_id)
+            self.progress.remove_task(task_id)
+
+    def transfer(self, task_id: TaskID, host: str) -> FileTransfer:
+        """Start counting the bytes of a file downloaded from `host` into a row"""
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = self.hosts[host] = TransferStats()
+        return FileTransfer(self.rows[task_id], stats)
+
+    def sync(self):
+        """Copy the counters into the rich rows, called before every render"""
+        with self.lock:
+            now = time.monotonic()
+            for task_id, stats in list(self.rows.items()):
+                meter = self.row_meters.get(task_id)
+                if meter is None:
+                    meter = self.row_meters[task_id] = RateMeter()
+                speed = meter.update(now, stats.bytes)
+                total = stats.estimated_total()
+                eta = max(0.0, total - stats.bytes) / speed if total is not None and speed > 0 else None
+                self.progress.update(
+                    task_id,
+                    completed=stats.bytes,
+                    total=total,
+                    files=stats.files,
+                    files_total=stats.files_total,
+                    speed=speed,
+                    eta=0.0 if total is not None and stats.bytes >= total else eta,
+                )
+            for host, stats in list(self.hosts.items()):
+                task_id = self.host_rows.get(host)
+                if task_id is None:
+                    task_id = self.host_rows[host] = self.host_progress.add_task(
+                        description=host, total=None, files=0, files_total=None
+                    )
+                    self.host_meters[host] = RateMeter()
+                speed = self.host_meters[host].update(now, stats.bytes)
+                self.host_progress.update(task_id, completed=stats.bytes, files=stats.files, speed=speed)
+
+    def stats_line(self) -> str:
+        """Describe every row and host in one line"""
+        self.sync()
+        tasks = {task.id: task for task in self.progress.tasks}
+        parts = []
+        for task_id, stats in list(self.rows.items()):
+            task = tasks[task_id]
+            if task_id in self.reported or (not stats.bytes and not stats.files):
+                continue
+            if task.finished:
+                self.reported.add(task_id)
+            total = task.total
+            parts.append(
+                f"{task.description}: {stats.files}/{stats.files_total if stats.files_total is not None else '?'} files, "
+                f"{decimal(stats.bytes)}/{decimal(int(total)) if total is not None else '?'}, "
+                f"{decimal(int(task.fields['speed']))}/s, eta {format_seconds(task.fields['eta'])}"
+            )
+        if not parts:
+            return ""
+        host_tasks = {task.id: task for task in self.host_progress.tasks}
+        hosts = [
+            f"{host} {decimal(int(host_tasks[task_id].fields['speed']))}/s"
+            for host, task_id in list(self.host_rows.items())
+        ]
+        if hosts:
+            parts.append("hosts: " + ", ".join(hosts))
+        return " | ".join(parts)
+
+    def _log_stats(self):
+        while not self.stop_logging.wait(self.log_interval):
+            line = self.stats_line()
+            if line:
+                logger.info(line)
+
+    def __enter__(self) -> "TransferProgress":
+        self.users += 1
+        if self.disable or self.users > 1:
+            return self
+        if not self.headless:
+            self.progress.start()
+        elif self.logging_thread is None:
+            self.stop_logging.clear()
+            self.logging_thread = threading.Thread(target=self._log_stats, name="progress-stats", daemon=True)
+            self.logging_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.users -= 1
+        if self.users:
+            return
+        if self.logging_thread is not None:
+            self.stop_logging.set()
+            self.logging_thread.join()
+            self.logging_thread = None
+            line = self.stats_line()
+            if line:
+                logger.info(line)
+        if not self.headless and not self.disable:
+            self.progress.stop()
@@ -0,0 +1,145 @@
+import time
+import random
+import asyncio
+from log import logger
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, Optional
+
+
+class RetryPolicy:
+    """RetryPolicy decides how long to wait before retrying a failed request.
+
+    Waits grow exponentially with full jitter, so requests failing together
+    do not come back together. A Retry-After header sent with the failure
+    is honored instead, up to `max_retry_after`.
+    """
+
+    def __init__(
+        self,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        retry_statuses: Iterable[int] = (408, 425, 429, 500, 502, 503, 504),
+        max_retry_after: float = 120.0,
+    ):
+        """Initialize retry policy
+
+        Args:
+            base_delay (float, optional): Longest wait before the first retry in seconds, doubled every retry.
+                Defaults to 0.5.
+            max_delay (float, optional): Longest wait computed by the backoff. Defaults to 30.
+            retry_statuses (Iterable[int], optional): HTTP statuses worth retrying, any other one is fatal.
+                Defaults to 408, 425, 429, 500, 502, 503 and 504.
+            max_retry_after (float, optional): Longest Retry-After honored. Defaults to 120.
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self.max_retry_after = max_retry_after
+
+    def delay(self, retry: int, retry_after: float = 0.0) -> float:
+        """Seconds to wait before a retry
+
+        Args:
+            retry (int): Retries done so far
+            retry_after (float, optional): Retry-After of the failed response in seconds, 0 if none. Defaults to 0.
+
+        Returns:
+            float: Seconds to wait
+        """
+        if retry_after > 0:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**retry))
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """Parse a Retry-After header, either seconds or an HTTP date
+
+    Args:
+        value (Optional[str]): Header value
+
+    Returns:
+        float: Seconds to wait, 0 if missing or invalid
+    """
+    if not value:
+        return 0.0
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return 0.0
+
+
+class BreakerState:
+    """BreakerState holds the failures and the pause of one host"""
+
+    __slots__ = ("failures", "open_until", "cooldown")
+
+    def __init__(self, cooldown: float) -> None:
+        # failures in a row since the last success
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = cooldown
+
+
+class CircuitBreaker:
+    """CircuitBreaker pauses every request to a host that keeps failing.
+
+    After `failures` retryable failures in a row, the circuit of the host
+    opens: new requests wait `cooldown` seconds before they are sent, instead
+    of piling more load on a host that is down or throttling. The cooldown
+    doubles every time the circuit opens again without a success in between.
+    A Retry-After answer pauses the host for that long.
+    """
+
+    def __init__(self, failures: int = 10, cooldown: float = 10.0, max_cooldown: float = 300.0):
+        """Initialize circuit breaker
+
+        Args:
+            failures (int, optional): Failures in a row opening the circuit of a host, 0 never opens it. Defaults to 10.
+            cooldown (float, optional): Seconds the circuit stays open the first time. Defaults to 10.
+            max_cooldown (float, optional): Longest time the circuit stays open. Defaults to 300.
+        """
+        self.failures = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts: Dict[str, BreakerState] = dict()
+
+    def _state(self, host: str) -> BreakerState:
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = BreakerState(self.cooldown)
+        return state
+
+    async def wait(self, host: str):
+        """Wait until the circuit of the host is closed"""
+        state = self.hosts.get(host)
+        while state is not None and state.open_until > time.monotonic():
+            await asyncio.sleep(state.open_until - time.monotonic())
+
+    def success(self, host: str):
+        state = self.hosts.get(host)
+        if state is not None:
+            state.failures = 0
+            state.cooldown = self.cooldown
+
+    def failure(self, host: str):
+        """Count a retryable failure, opening the circuit after too many in a row"""
+        state = self._state(host)
+        state.failures += 1
+        if not self.failures or state.failures < self.failures:
+            return
+        logger.warning(f"[{host}] {state.failures} failures in a row, pausing requests for {state.cooldown:.0f}s")
+        self.pause(host, state.cooldown)
+        state.failures = 0
+        state.cooldown = min(self.max_cooldown, state.cooldown * 2)
+
+    def pause(self, host: str, seconds: float):
+        """Hold every request to the host for some seconds, e.g. as a Retry-After asked"""
+        state = self._state(host)
+        state.open_until = max(state.open_until, time.monotonic() + seconds)
+
+    def is_open(self, host: str) -> bool:
+        state = self.hosts.get(host)
+        return state is not None and state.open_until > time.monotonic()
@@ -0,0 +1,625 @@
+import os
+import time
+import shutil
+import asyncio
+from log import logger
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from rich.progress import TaskID
+from aiohttp import ClientSession
+from urllib.parse import urlsplit
+from downloader import Task, TaskPart
+from playlist import Playlist, Variant, fit_variant, is_master_playlist, load_playlist, select_variant
+from assembler import DiskBudget, SegmentAssembler
+from metrics import VideoMetric
+
+if TYPE_CHECKING:
+    from core import BlobDownloader, VideoJob
+
+
+class BatchScheduler:
+    """BatchScheduler downloads segments of many videos through one shared session.
+
+    Playlists of up to `prefetch_playlists` upcoming videos are fetched and
+    parsed while up to `max_active_videos` videos download their segments,
+    and finished videos are merged by up to `max_merges` ffmpeg processes,
+    or concatenated when no remuxing is needed, or assembled while they
+    download when `stream_merge` is enabled, so the network never waits for
+    playlist fetches or ffmpeg. With `max_tmp_size`, streamed segments are
+    removed once assembled and downloads wait while the segments on disk of
+    all videos reach it. All segments share the limiter of
+    the `Downloader`, so the global concurrency stays at `max_concurrent`
+    whatever the number of videos.
+    """
+
+    def __init__(
+        self,
+        blob_downloader: "BlobDownloader",
+        max_active_videos: int = 4,
+        prefetch_playlists: int = 4,
+        state_batch: int = 100,
+        max_merges: int = 0,
+    ):
+        """Initialize batch scheduler
+
+        Args:
+            blob_downloader (BlobDownloader): Downloader providing paths, parsing and merging
+            max_active_videos (int, optional): Maximum videos downloading segments at the same time. Defaults to 4.
+            prefetch_playlists (int, optional): Number of upcoming videos whose playlist is fetched ahead. Defaults to 4.
+            state_batch (int, optional): Finished segments recorded in the state store per write. Defaults to 100.
+            max_merges (int, optional): Videos merged at the same time, 0 for the number of CPUs. Defaults to 0.
+        """
+        self.blob = blob_downloader
+        self.downloader = blob_downloader.downloader
+        self.progress = self.downloader.progress
+        self.max_active_videos = max(1, max_active_videos)
+        self.prefetch_playlists = max(0, prefetch_playlists)
+        self.state_batch = max(1, state_batch)
+        self.max_merges = max_merges if max_merges > 0 else os.cpu_count() or 1
+        self.ahead: Optional[asyncio.Semaphore] = None
+        self.active: Optional[asyncio.Semaphore] = None
+        self.merges: Optional[asyncio.Semaphore] = None
+        self.disk_budget: Optional[DiskBudget] = None
+        # segment cache keys being downloaded, a video needing the same file waits instead of fetching it twice
+        self.inflight: Dict[str, asyncio.Future] = dict()
+        self.videos = 0
+        self.videos_done = 0
+
+    def run(self, jobs: List["VideoJob"]) -> List[Optional[str]]:
+        """Run a batch synchronously
+
+        Args:
+            jobs (List[VideoJob]): Video jobs to download
+
+        Returns:
+            List[Optional[str]]: Path of each video in job order, None for failed videos
+        """
+        if not jobs:
+            return list()
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.async_run(jobs))
+
+    def run_single(self, job: "VideoJob") -> str:
+        """Download a single video synchronously
+
+        Args:
+            job (VideoJob): Video job to download
+
+        Returns:
+            str: Path to the downloaded video file
+
+        Raises:
+            Exception: if the video failed to download or merge
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.async_run_single(job))
+
+    async def async_run(self, jobs: List["VideoJob"]) -> List[Optional[str]]:
+        """Run a batch asynchronously
+
+        Args:
+            jobs (List[VideoJob]): Video jobs to download
+
+        Returns:
+            List[Optional[str]]: Path of each video in job order, None for failed videos
+        """
+        task_id = self._start(len(jobs))
+        try:
+            with self.progress:
+                async with self.downloader.session_scope() as session:
+                    coros = [self._run_job(session, task_id, job) for job in jobs]
+                    return await asyncio.gather(*coros)
+        finally:
+            self.progress.remove_task(task_id)
+            self.blob.metrics.flush()
+
+    def run_stream(
+        self, jobs: Iterable["VideoJob"], on_finish: Callable[["VideoJob", Optional[str], Optional[Exception]], None]
+    ) -> Dict[str, int]:
+        """Run a stream of jobs synchronously, see async_run_stream"""
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.async_run_stream(jobs, on_finish))
+
+    async def async_run_stream(
+        self, jobs: Iterable["VideoJob"], on_finish: Callable[["VideoJob", Optional[str], Optional[Exception]], None]
+    ) -> Dict[str, int]:
+        """Run a stream of jobs asynchronously, in constant memory whatever its length
+
+        Jobs are pulled from the iterable only when a video can start, its
+        playlist being prefetched or its segments downloaded, and reported
+        to `on_finish` as they finish instead of collected. The iterable is
+        advanced in a worker thread, so a slow source like a pipe does not
+        stall the running downloads.
+
+        Args:
+            jobs (Iterable[VideoJob]): Video jobs to download, e.g. a generator reading a manifest
+            on_finish (Callable): Called with each job, the path of its video and None, or None and the error
+
+        Returns:
+            Dict[str, int]: Number of "done" and "failed" videos
+        """
+        task_id = self._start(0)
+        iterator = iter(jobs)
+        pull = asyncio.Lock()
+        counts = {"done": 0, "failed": 0}
+        loop = asyncio.get_event_loop()
+
+        async def worker(session: ClientSession):
+            while True:
+                # a generator cannot be advanced by two threads at once
+                async with pull:
+                    job = await loop.run_in_executor(None, next, iterator, None)
+                if job is None:
+                    return
+                self.videos += 1
+                self.progress.update(task_id, description=self._description())
+                video_path = await self._run_job(session, task_id, job, on_finish)
+                counts["done" if video_path is not None else "failed"] += 1
+
+        try:
+            with self.progress:
+                async with self.downloader.session_scope() as session:
+                    workers = self.max_active_videos + self.prefetch_playlists
+                    await asyncio.gather(*(worker(session) for _ in range(workers)))
+            return counts
+        finally:
+            self.progress.remove_task(task_id)
+            self.blob.metrics.flush()
+
+    async def async_run_single(self, job: "VideoJob") -> str:
+        """Download a single video asynchronously
+
+        Args:
+            job (VideoJob): Video job to download
+
+        Returns:
+            str: Path to the downloaded video file
+        """
+        task_id = self._start()
+        try:
+            with self.progress:
+                async with self.downloader.session_scope() as session:
+                    return await self.download_job(session, task_id, job)
+        finally:
+            self.progress.remove_task(task_id)
+            self.blob.metrics.flush()
+
+    def _start(self, videos: int = 1) -> TaskID:
+        """Reset the per-run state and add the progress bar of the run, shared by all its videos"""
+        # semaphores wake waiters in FIFO order, so videos start in batch order
+        self.ahead = asyncio.Semaphore(self.max_active_videos + self.prefetch_playlists)
+        self.active = asyncio.Semaphore(self.max_active_videos)
+        self.merges = asyncio.Semaphore(self.max_merges)
+        self.disk_budget = DiskBudget(self.blob.max_tmp_size) if self.blob.max_tmp_size > 0 else None
+        self.videos = videos
+        self.videos_done = 0
+        # the total grows as the playlists are parsed
+        return self.progress.add_task(description=self._description(), total=0)
+
+    async def _run_job(
+        self,
+        session: ClientSession,
+        task_id: TaskID,
+        job: "VideoJob",
+        on_finish: Optional[Callable[["VideoJob", Optional[str], Optional[Exception]], None]] = None,
+    ) -> Optional[str]:
+        """Download and merge one video of the batch, logging instead of raising
+
+        Returns:
+            Optional[str]: Path to the downloaded video file, None if failed
+        """
+        try:
+            video_path = await self.download_job(session, task_id, job)
+        except Exception as e:
+            logger.error(f"❌ Failed to download {job.blob_url}: {e}")
+            if on_finish is not None:
+                on_finish(job, None, e)
+            return None
+        finally:
+            self.videos_done += 1
+            self.progress.update(task_id, description=self._description())
+        logger.info(f"✅ Successfully downloaded: {job.save_name}")
+        if on_finish is not None:
+            on_finish(job, video_path, None)
+        return video_path
+
+    async def download_job(self, session: ClientSession, task_id: TaskID, job: "VideoJob") -> str:
+        """Fetch playlist and segments of a video and merge them
+
+        Args:
+            session (ClientSession): Session shared by the run
+            task_id (TaskID): Progress task of the run
+            job (VideoJob): Video job to download
+
+        Returns:
+            str: Path to the downloaded video file
+        """
+        if os.path.exists(job.save_path):
+            return job.save_path
+        metric = VideoMetric(job.save_name)
+        tasks: List[Task] = []
+        try:
+            async with self.ahead:
+                start = time.monotonic()
+                local_m3u8_file, tasks = await self._prepare_job(session, task_id, job)
+                metric.playlist_time = time.monotonic() - start
+                async with self.active:
+                    if self.disk_budget is not None and tasks and not job.streamable:
+                        # ffmpeg needs every segment on disk at once, no ceiling below the video size holds
+                        raise Exception("encrypted or fMP4 segments cannot be assembled within max_tmp_size")
+                    if self.blob.stream_merge and job.streamable and job.segment_paths:
+                        video_path = await self._stream_segments(session, task_id, job, tasks, metric)
+                        video_path = self.blob.finish_job(job, video_path)
+                        metric.status = "done"
+                        return video_path
+                    start = time.monotonic()
+                    await self._download_segments(session, task_id, job, tasks)
+                    metric.download_time = time.monotonic() - start
+            # merges run outside the event loop, videos keep downloading meanwhile
+            async with self.merges:
+                start = time.monotonic()
+                video_path = await self.blob.async_merge_media(job, local_m3u8_file)
+                metric.merge_time = time.monotonic() - start
+            video_path = self.blob.finish_job(job, video_path)
+            metric.status = "done"
+            return video_path
+        except Exception as e:
+            self.blob.fail_job(job, e)
+            metric.status = "failed"
+            metric.error = str(e)
+            raise
+        finally:
+            metric.segments = len(job.segment_paths)
+            metric.cached = job.cached_files
+            metric.bytes = sum(task.size for task in tasks)
+            self.blob.metrics.video(metric)
+
+    async def _prepare_job(self, session: ClientSession, task_id: TaskID, job: "VideoJob") -> Tuple[str, List[Task]]:
+        """Fetch and parse the playlist of a video
+
+        Returns:
+            str: Path to local m3u8 file
+            List[Task]: List of tasks to download media files
+        """
+        self.blob.start_job(job)
+        m3u8_file = await self._fetch_playlist(session, task_id, job)
+        if is_master_playlist(m3u8_file):
+            if not self.blob.load_variant(job):
+                master = load_playlist(m3u8_file, job.blob_url)
+                self.blob.use_variant(job, await self._select_variant(session, task_id, job, master))
+            m3u8_file = await self._fetch_playlist(session, task_id, job)
+        return self.blob.parse_m3u8_file(job, m3u8_file)
+
+    async def _fetch_playlist(self, session: ClientSession, task_id: TaskID, job: "VideoJob") -> str:
+        """Fetch the playlist at job.media_url unless it is downloaded already
+
+        Returns:
+            str: Path to the m3u8 file
+        """
+        m3u8_file, m3u8_task = self.blob.m3u8_task(job)
+        if m3u8_task is not None:
+            self._add_total(task_id, 1)
+            result = await self.downloader.fetch_tasks(session, task_id, [m3u8_task])
+            if result[0] is False:
+                raise Exception("failed to download m3u8 file")
+        return m3u8_file
+
+    async def _select_variant(
+        self, session: ClientSession, task_id: TaskID, job: "VideoJob", master: Playlist
+    ) -> Variant:
+        """Select the variant of a master playlist as configured in BlobDownloader.variant_config
+
+        The auto policy downloads the first segments of the highest variant to a
+        scratch directory and takes the highest variant the measured throughput
+        can download within the deadline, or in real time without a deadline.
+
+        Returns:
+            Variant: Variant to download
+        """
+        config = self.blob.variant_config
+        if config["policy"] != "auto":
+            return select_variant(master.variants, config["policy"], config["max_bandwidth"], config["resolution"])
+        highest = select_variant(master.variants, "highest")
+        sample_path = os.path.join(job.tmp_path, "sample")
+        os.makedirs(sample_path, exist_ok=True)
+        try:
+            playlist_task = Task(
+                highest.url,
+                os.path.join(sample_path, "sample.m3u8"),
+                job.save_name,
+                headers=job.headers,
+                validate=False,
+            )
+            self._add_total(task_id, 1)
+            result = await self.downloader.fetch_tasks(session, task_id, [playlist_task])
+            if result[0] is False:
+                raise Exception("failed to download the playlist of the sampled variant")
+            playlist = load_playlist(playlist_task.save_path, highest.url)
+            tasks = []
+            for index, segment in enumerate(playlist.segments[: max(1, config["sample_segments"])]):
+                save_path = os.path.join(sample_path, f"sample{index}.ts")
+                # fetched as received to time the transfer, an encrypted one is no valid segment
+                task = Task(segment.url, save_path, job.save_name, headers=job.headers, validate=False)
+                if segment.byterange is not None:
+                    task.parts = [TaskPart(segment.byterange[1], segment.byterange[0], save_path)]
+                tasks.append(task)
+            self._add_total(task_id, len(tasks))
+            start = time.monotonic()
+            results = await self.downloader.fetch_tasks(session, task_id, tasks)
+            seconds = time.monotonic() - start
+        finally:
+            shutil.rmtree(sample_path, ignore_errors=True)
+        received = sum(task.size for task, result in zip(tasks, results) if result)
+        if not received:
+            logger.warning(f"[{job.save_name}] no segment could be sampled, taking the lowest variant")
+            return select_variant(master.variants, "lowest")
+        throughput = received / max(seconds, 1e-3)
+        deadline = config["deadline"] or playlist.duration
+        variant = fit_variant(master.variants, throughput, playlist.duration, deadline)
+        logger.info(
+            f"[{job.save_name}] sampled {throughput / 1024 / 1024:.2f} MB/s, "
+            f"{playlist.duration:.0f}s of video within {deadline:.0f}s"
+        )
+        return variant
+
+    async def _download_segments(
+        self,
+        session: ClientSession,
+        task_id: TaskID,
+        job: "VideoJob",
+        tasks: List[Task],
+        callback: Optional[Callable[[Task, bool], Awaitable[None]]] = None,
+        gate: Optional[Callable[[List[Task]], AsyncIterator[Task]]] = None,
+    ):
+        """Download the segments of a video, raising if any of them still failed after a final pass
+
+        Segments that failed are tried once more after all the others, when
+        a host that was throttling or down may be back, instead of failing
+        the whole video on the first one. A gate yields the tasks to download
+        when they may start, tasks it holds back are left to the final pass.
+        Finished segments are recorded in the state store in batches, so a
+        crash only loses the latest ones.
+        """
+        if not tasks:
+            return
+        finished: List[Task] = []
+
+        def record():
+            if finished:
+                self.blob.record_tasks(job, finished)
+                finished.clear()
+
+        async def on_done(task: Task, result: bool):
+            if result:
+                self.blob.cache_task(task)
+            finished.append(task)
+            if len(finished) >= self.state_batch:
+                record()
+            if callback is not None:
+                await callback(task, result)
+
+        self._add_total(task_id, len(tasks))
+        try:
+            results = await self._fetch_shared(session, task_id, job, tasks, on_done, gate)
+            failed = [task for task, result in zip(tasks, results) if not result]
+            if failed and self.downloader.retry_config["final_pass"]:
+                logger.warning(f"[{job.save_name}] retrying {len(failed)} failed segments in a final pass")
+                self._add_total(task_id, len(failed))
+                results = await self._fetch_shared(session, task_id, job, failed, on_done, gate)
+                failed = [task for task, result in zip(failed, results) if not result]
+        finally:
+            record()
+        if failed:
+            raise Exception(f"total task: {len(tasks)}, failed task: {len(failed)}")
+
+    async def _fetch_shared(
+        self,
+        session: ClientSession,
+        task_id: TaskID,
+        job: "VideoJob",
+        tasks: List[Task],
+        callback: Callable[[Task, bool], Awaitable[None]],
+        gate: Optional[Callable[[List[Task]], AsyncIterator[Task]]] = None,
+    ) -> List[bool]:
+        """Download tasks, linking files another video is downloading from the segment cache once they are done
+
+        Returns:
+            List[bool]: Result of every task, False for tasks the gate held back
+        """
+        # the gate may hold tasks back or yield a task again, results are told by task
+        outcomes: Dict[int, bool] = dict()
+
+        async def on_result(task: Task, result: bool):
+            outcomes[id(task)] = result
+            await callback(task, result)
+
+        if self.blob.cache is None:
+            source = gate(tasks) if gate is not None else tasks
+            await self.downloader.fetch_tasks(
+                session, task_id, source, callback=on_result, max_workers=job.max_concurrent
+            )
+            return [outcomes.get(id(task), False) for task in tasks]
+        loop = asyncio.get_event_loop()
+        # cache key and future of every task downloaded here that other videos may wait for
+        claims: Dict[int, Tuple[str, asyncio.Future]] = dict()
+        fetched: List[Task] = []
+        waiting: List[Tuple[Task, str, asyncio.Future]] = []
+        for task in tasks:
+            key = self.blob.cache_key(task)
+            if key is None:
+                fetched.append(task)
+            elif key in self.inflight:
+                waiting.append((task, key, self.inflight[key]))
+            else:
+                future = self.inflight[key] = loop.create_future()
+                claims[id(task)] = (key, future)
+                fetched.append(task)
+
+        def release(task: Task, result: bool):
+            claim = claims.pop(id(task), None)
+            if claim is not None:
+                self.inflight.pop(claim[0], None)
+                if not claim[1].done():
+                    claim[1].set_result(result)
+
+        async def on_done(task: Task, result: bool):
+            try:
+                await on_result(task, result)
+            finally:
+                release(task, result)
+
+        async def wait(task: Task, key: str, future: asyncio.Future) -> bool:
+            if await asyncio.shield(future):
+                found = self.blob.cache.fetch({task.save_path: key})
+                if found:
+                    task.size = found[task.save_path]
+                    job.cached_files += 1
+                    transfer = self.progress.transfer(task_id, urlsplit(task.url).netloc)
+                    transfer.start(task.size, task.size)
+                    transfer.done()
+                    await on_result(task, True)
+                    return
+            # the other video failed, or the file was evicted meanwhile
+            source = gate([task]) if gate is not None else [task]
+            await self.downloader.fetch_tasks(session, task_id, source, callback=on_result)
+
+        try:
+            await asyncio.gather(
+                self.downloader.fetch_tasks(
+                    session,
+                    task_id,
+                    gate(fetched) if gate is not None else fetched,
+                    callback=on_done,
+                    max_workers=job.max_concurrent,
+                ),
+                *(wait(task, key, future) for task, key, future in waiting),
+            )
+        finally:
+            for task in fetched:
+                release(task, False)
+        return [outcomes.get(id(task), False) for task in tasks]
+
+    async def _stream_segments(
+        self,
+        session: ClientSession,
+        task_id: TaskID,
+        job: "VideoJob",
+        tasks: List[Task],
+        metric: VideoMetric,
+    ) -> str:
+        """Download the segments of a video while appending them to the output in order
+
+        The merge time of the metric is what is left to assemble once the last segment arrived.
+        Under a disk budget, every segment file is removed after its last use in the output.
+
+        Returns:
+            str: Path to the assembled video
+        """
+        indexes: Dict[str, List[int]] = dict()
+        for index, path in enumerate(job.segment_paths):
+            indexes.setdefault(path, []).append(index)
+        budget = self.disk_budget
+        # bytes reserved by every download in flight, bytes of files on disk, failed segments by index
+        # and tasks already retried out of turn
+        reserved: Dict[int, int] = dict()
+        held = [0]
+        failed_indexes: Dict[int, Task] = dict()
+        retried: Set[int] = set()
+
+        def stuck() -> bool:
+            return assembler.next_index in failed_indexes
+
+        def clear_failed(task: Task):
+            for path in task.save_paths:
+                for index in indexes.get(path, []):
+                    failed_indexes.pop(index, None)
+
+        async def gate(source: List[Task]) -> AsyncIterator[Task]:
+            for task in source:
+                clear_failed(task)
+                size = await budget.acquire(stuck)
+                while size is None:
+                    # the budget is spent and the output waits for a failed segment
+                    blocking = failed_indexes[assembler.next_index]
+                    if id(blocking) in retried:
+                        logger.warning(f"[{job.save_name}] tmp space is full, the rest waits for the final pass")
+                        return
+                    # its final-pass retry comes right away, nothing else can be downloaded meanwhile
+                    retried.add(id(blocking))
+                    clear_failed(blocking)
+                    reserved[id(blocking)] = await budget.acquire(stuck)
+                    yield blocking
+                    size = await budget.acquire(stuck)
+                reserved[id(task)] = size
+                yield task
+
+        async def on_done(task: Task, result: bool):
+            if budget is not None:
+                size = reserved.pop(id(task), None)
+                if size is None:
+                    # linked from the segment cache, not downloaded
+                    await budget.add(task.size if result else 0)
+                elif result:
+                    await budget.done(size, task.size)
+                else:
+                    await budget.failed(size)
+                held[0] += task.size if result else 0
+            if not result:
+                for path in task.save_paths:
+                    for index in indexes.get(path, []):
+                        failed_indexes[index] = task
+                return
+            for path in task.save_paths:
+                for index in indexes.get(path, []):
+                    await assembler.add(index, path)
+
+        async def on_written(index: int, path: str):
+            if indexes[path][-1] != index:
+                # used again later in the playlist
+                return
+            size = os.path.getsize(path)
+            os.remove(path)
+            held[0] -= size
+            await budget.release(size)
+
+        assembler = SegmentAssembler(
+            job.save_path, job.tmp_path, len(job.segment_paths), on_written=on_written if budget is not None else None
+        )
+        await assembler.open()
+        start = time.monotonic()
+        try:
+            pending = set(path for task in tasks for path in task.save_paths)
+            if budget is not None:
+                for path in indexes:
+                    if path not in pending:
+                        size = os.path.getsize(path)
+                        held[0] += size
+                        await budget.add(size)
+            for index, path in enumerate(job.segment_paths):
+                if path not in pending:
+                    await assembler.add(index, path)
+            await self._download_segments(
+                session, task_id, job, tasks, callback=on_done, gate=gate if budget is not None else None
+            )
+        except BaseException:
+            await assembler.abort()
+            raise
+        finally:
+            if budget is not None:
+                # files kept for a resumed run and cancelled downloads leave the budget of the other videos
+                for size in reserved.values():
+                    await budget.failed(size)
+                reserved.clear()
+                await budget.release(held[0])
+                held[0] = 0
+        metric.download_time = time.monotonic() - start
+        start = time.monotonic()
+        video_path = await assembler.finish()
+        metric.merge_time = time.monotonic() - start
+        return video_path
+
+    def _description(self) -> str:
+        return f"downloading batch ({self.videos_done}/{self.videos} videos)"
+
+    def _add_total(self, task_id: TaskID, count: int):
+        """Grow the total of the batch progress bar"""
+        self.progress.add_total(task_id, count)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class StateStore:
+    """StateStore records videos and segments of past runs in a SQLite file.
+
+    Resuming a video is one indexed query for its finished segments instead
+    of a stat call per segment, and failed segments are kept with their
+    error so that they can be retried on their own.
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, db_path: str):
+        """Initialize state store
+
+        Args:
+            db_path (str): Path of the SQLite file, created if missing
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS videos (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                save_name TEXT NOT NULL,
+                save_path TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL,
+                error TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL,
+                headers TEXT NOT NULL DEFAULT '',
+                max_concurrent INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS segments (
+                video_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                url TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT NOT NULL DEFAULT '',
+                checksum TEXT NOT NULL DEFAULT '',
+                rejected INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (video_id, path)
+            );
+            CREATE INDEX IF NOT EXISTS segments_status ON segments (video_id, status);
+            """
+        )
+        # state files of older versions lack the job overrides and the validation columns
+        for table, column, definition in (
+            ("videos", "headers", "TEXT NOT NULL DEFAULT ''"),
+            ("videos", "max_concurrent", "INTEGER NOT NULL DEFAULT 0"),
+            ("segments", "checksum", "TEXT NOT NULL DEFAULT ''"),
+            ("segments", "rejected", "INTEGER NOT NULL DEFAULT 0"),
+        ):
+            columns = set(row[1] for row in self.conn.execute(f"PRAGMA table_info({table})"))
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        self.conn.commit()
+
+    def add_video(
+        self,
+        url: str,
+        save_name: str,
+        save_path: str,
+        headers: Optional[Dict[str, str]] = None,
+        max_concurrent: int = 0,
+    ) -> int:
+        """Register a video, keeping its segments if it is already known
+
+        Args:
+            url (str): M3U8 URL of the video
+            save_name (str): Output filename
+            save_path (str): Path of the video
+            headers (Optional[Dict[str, str]], optional): Request headers of the video. Defaults to None.
+            max_concurrent (int, optional): Segments of the video downloading at the same time, 0 for no limit.
+                Defaults to 0.
+
+        Returns:
+            int: Id of the video
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO videos (url, save_name, save_path, status, updated_at, headers, max_concurrent) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (save_path) DO UPDATE SET url = excluded.url, updated_at = excluded.updated_at, "
+                "headers = excluded.headers, max_concurrent = excluded.max_concurrent",
+                (
+                    url,
+                    save_name,
+                    save_path,
+                    self.STATUS_PENDING,
+                    time.time(),
+                    json.dumps(headers) if headers else "",
+                    max_concurrent,
+                ),
+            )
+        row = self.conn.execute("SELECT id FROM videos WHERE save_path = ?", (save_path,)).fetchone()
+        return row[0]
+
+    def set_video_status(self, video_id: int, status: str, error: str = ""):
+        """Update the status of a video"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE videos SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), video_id),
+            )
+
+    def failed_videos(self) -> List[dict]:
+        """Get all failed videos as items of BlobDownloader.parse_batch_item, with the overrides of their job"""
+        rows = self.conn.execute(
+            "SELECT url, save_name, save_path, headers, max_concurrent FROM videos WHERE status = ? ORDER BY id",
+            (self.STATUS_FAILED,),
+        )
+        items = []
+        for url, save_name, save_path, headers, max_concurrent in rows:
+            item = {"url": url, "save_name": save_name, "output": save_path}
+            if headers:
+                item["headers"] = json.loads(headers)
+            if max_concurrent:
+                item["max_concurrent"] = max_concurrent
+            items.append(item)
+        return items
+
+    def add_segments(self, video_id: int, segments: Iterable[Tuple[str, str]]):
+        """Register (url, path) of the segments of a video, known segments keep their status"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO segments (video_id, url, path, status) VALUES (?, ?, ?, ?)",
+                ((video_id, url, path, self.STATUS_PENDING) for url, path in segments),
+            )
+
+    def segment_count(self, video_id: int) -> int:
+        """Get the number of known segments of a video"""
+        return self.conn.execute("SELECT COUNT(*) FROM segments WHERE video_id = ?", (video_id,)).fetchone()[0]
+
+    def done_segments(self, video_id: int) -> Set[str]:
+        """Get paths of the downloaded segments of a video"""
+        rows = self.conn.execute(
+            "SELECT path FROM segments WHERE video_id = ? AND status = ?", (video_id, self.STATUS_DONE)
+        )
+        return set(row[0] for row in rows)
+
+    def failed_segments(self, video_id: int) -> List[Tuple[str, str, int, str]]:
+        """Get (url, path, attempts, error) of the failed segments of a video"""
+        rows = self.conn.execute(
+            "SELECT url, path, attempts, error FROM segments WHERE video_id = ? AND status = ?",
+            (video_id, self.STATUS_FAILED),
+        )
+        return rows.fetchall()
+
+    def update_segments(self, video_id: int, results: Iterable[Tuple[str, str, int, int, str]]):
+        """Record (path, status, size, attempts, error) of downloaded segments, attempts are added"""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE segments SET status = ?, size = ?, attempts = attempts + ?, error = ? "
+                "WHERE video_id = ? AND path = ?",
+                ((status, size, attempts, error, video_id, path) for path, status, size, attempts, error in results),
+            )
+
+    def update_checks(self, video_id: int, results: Iterable[Tuple[str, str, int]]):
+        """Record (path, checksum, rejected) of validated segments, rejected bodies are added"""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE segments SET checksum = ?, rejected = rejected + ? WHERE video_id = ? AND path = ?",
+                ((checksum, rejected, video_id, path) for path, checksum, rejected in results),
+            )
+
+    def rejected_segments(self, video_id: int) -> List[Tuple[str, str, int, str]]:
+        """Get (url, path, rejected, status) of the segments of a video that were served corrupt at least once"""
+        rows = self.conn.execute(
+            "SELECT url, path, rejected, status FROM segments WHERE video_id = ? AND rejected > 0 ORDER BY path",
+            (video_id,),
+        )
+        return rows.fetchall()
+
+    def recheck_segments(self, video_id: int, paths: Iterable[str]):
+        """Mark downloaded segments of a video as pending, so the next run checks their files again"""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE segments SET status = ? WHERE video_id = ? AND path = ? AND status = ?",
+                ((self.STATUS_PENDING, video_id, path, self.STATUS_DONE) for path in paths),
+            )
+
+    def reset_segments(self, video_id: Optional[int] = None):
+        """Forget the segments of a video, or of all videos, e.g. after their files were removed"""
+        with self.conn:
+            if video_id is None:
+                self.conn.execute("DELETE FROM segments")
+            else:
+                self.conn.execute("DELETE FROM segments WHERE video_id = ?", (video_id,))
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
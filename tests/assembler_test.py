@@ -0,0 +1,111 @@
+import os
+import sys
+import asyncio
+import pytest
+from assembler import AssembleError, DiskBudget, SegmentAssembler
+
+
+def test_assembler_writes_in_order(tmp_path):
+    paths = []
+    for i in range(5):
+        path = os.path.join(tmp_path, f"{i}.ts")
+        with open(path, "wb") as fp:
+            fp.write(bytes([i]) * 10)
+        paths.append(path)
+    save_path = os.path.join(tmp_path, "out.ts")
+
+    async def assemble():
+        assembler = SegmentAssembler(save_path, str(tmp_path), total=len(paths))
+        await assembler.open()
+        for index in [3, 1, 0, 4, 2]:
+            await assembler.add(index, paths[index])
+        return await assembler.finish()
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(assemble()) == save_path
+    loop.close()
+    with open(save_path, "rb") as fp:
+        assert fp.read() == b"".join(bytes([i]) * 10 for i in range(5))
+
+
+def test_assembler_skips_and_removes(tmp_path):
+    paths = []
+    for i in range(3):
+        path = os.path.join(tmp_path, f"{i}.ts")
+        with open(path, "wb") as fp:
+            fp.write(bytes([i]) * 10)
+        paths.append(path)
+    save_path = os.path.join(tmp_path, "out.ts")
+
+    async def assemble():
+        # the total of a live recording is only known at the end
+        assembler = SegmentAssembler(save_path, str(tmp_path), total=0, remove_written=True)
+        await assembler.open()
+        await assembler.add(2, paths[2])
+        await assembler.add(1, None)
+        await assembler.add(0, paths[0])
+        assembler.total = 3
+        return await assembler.finish()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(assemble())
+    loop.close()
+    with open(save_path, "rb") as fp:
+        assert fp.read() == bytes([0]) * 10 + bytes([2]) * 10
+    assert not os.path.exists(paths[0]) and not os.path.exists(paths[2]) and os.path.exists(paths[1])
+
+
+def test_assembler_reports_ffmpeg_errors(tmp_path, monkeypatch):
+    # an ffmpeg that rejects its input
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    ffmpeg = bin_path / "ffmpeg"
+    ffmpeg.write_text(
+        f"#!{sys.executable}\nimport sys\nsys.stdin.buffer.read()\n"
+        "sys.stderr.write('pipe:0: Invalid data found when processing input\\n')\nsys.exit(1)\n"
+    )
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    path = os.path.join(tmp_path, "0.ts")
+    with open(path, "wb") as fp:
+        fp.write(b"not a transport stream")
+
+    async def assemble():
+        assembler = SegmentAssembler(os.path.join(tmp_path, "out.mp4"), str(tmp_path), total=1)
+        await assembler.open()
+        await assembler.add(0, path)
+        return await assembler.finish()
+
+    loop = asyncio.new_event_loop()
+    with pytest.raises(AssembleError, match="Invalid data found"):
+        loop.run_until_complete(assemble())
+    loop.close()
+    assert not os.path.exists(os.path.join(tmp_path, "out.mp4"))
+
+
+def test_disk_budget_backpressure():
+    async def run():
+        budget = DiskBudget(100)
+        # nothing tells the size of the first download, it runs alone
+        first = await budget.acquire()
+        second = asyncio.ensure_future(budget.acquire())
+        await asyncio.sleep(0)
+        assert not second.done()
+        await budget.done(first, 40)
+        assert await second == 40
+        third = asyncio.ensure_future(budget.acquire())
+        await asyncio.sleep(0)
+        assert not third.done() and budget.used == 80
+        # an assembled file gives its bytes back
+        await budget.release(40)
+        assert await third == 40
+        await budget.failed(40)
+        await budget.failed(40)
+        # over budget with nothing in flight, a failed segment blocking the output cannot be waited for
+        await budget.add(200)
+        assert await budget.acquire(stuck=lambda: True) is None
+        assert await budget.acquire(stuck=lambda: False) == 40
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.wait_for(run(), 5))
+    loop.close()
@@ -0,0 +1,40 @@
+import os
+from cache import SegmentCache, normalize_url
+
+
+def test_normalize_url():
+    url = "HTTPS://CDN.example.com:443/a/seg1.ts?b=2&a=1#x"
+    assert normalize_url(url) == "https://cdn.example.com/a/seg1.ts?a=1&b=2"
+    assert normalize_url("http://host:8080/seg1.ts?token=abc&v=1", ["token"]) == "http://host:8080/seg1.ts?v=1"
+
+
+def test_segment_cache_lru(tmp_path):
+    cache = SegmentCache(os.path.join(tmp_path, "cache"), max_size=25, ignore_params=["token"])
+    paths = []
+    for index in range(3):
+        path = os.path.join(tmp_path, f"seg{index}.ts")
+        with open(path, "wb") as fp:
+            fp.write(bytes([index]) * 10)
+        paths.append(path)
+    key0 = cache.key("http://host/seg0.ts?token=a")
+    assert key0 == cache.key("http://HOST/seg0.ts?token=b")
+    assert key0 != cache.key("http://host/seg0.ts", byterange=(10, 0))
+    cache.store(key0, "http://host/seg0.ts", paths[0])
+    cache.store(cache.key("http://host/seg1.ts"), "http://host/seg1.ts", paths[1])
+
+    # seg0 is used again, seg1 becomes the least recently used
+    target = os.path.join(tmp_path, "video", "0.ts")
+    os.makedirs(os.path.dirname(target))
+    assert cache.fetch({target: key0}) == {target: 10}
+    with open(target, "rb") as fp:
+        assert fp.read() == bytes([0]) * 10
+    cache.store(cache.key("http://host/seg2.ts"), "http://host/seg2.ts", paths[2])
+    assert cache.size == 20
+    assert cache.fetch({target + "1": cache.key("http://host/seg1.ts")}) == {}
+    assert cache.hits == 1 and cache.misses == 1
+    cache.close()
+
+    # the index survives the run
+    cache = SegmentCache(os.path.join(tmp_path, "cache"), max_size=25)
+    assert cache.size == 20
+    cache.close()
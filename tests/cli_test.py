@@ -0,0 +1,45 @@
+import io
+import os
+import sys
+import subprocess
+from cli import read_manifest
+from core import BlobDownloader
+
+
+def test_read_manifest():
+    jsonl = io.StringIO(
+        '{"url": "http://host/a.m3u8", "referer": "http://site/", "max_concurrent": 4}\n'
+        "\n"
+        '# "http://host/skipped.m3u8"\n'
+        '"http://host/b.m3u8"\n'
+        '{"url": "http://host/c.m3u8", "max_concurrent": -1}\n'
+        "{oops\n"
+    )
+    entries = list(read_manifest(jsonl))
+    assert [entry.line for entry in entries] == [1, 4, 5, 6]
+    assert entries[0].item == {"url": "http://host/a.m3u8", "referer": "http://site/", "max_concurrent": 4}
+    assert entries[1].item == {"url": "http://host/b.m3u8"}
+    assert entries[2].error.message == "max_concurrent must be a non-negative integer"
+    assert entries[3].error.line == 6 and entries[3].item is None
+
+    rows = io.StringIO('url,save_name,output,headers\nhttp://host/a.m3u8,,/videos/,"{""X-Token"": ""1""}"\n,b.mp4,,\n')
+    entries = list(read_manifest(rows, "csv"))
+    assert entries[0].item == {"url": "http://host/a.m3u8", "output": "/videos/", "headers": {"X-Token": "1"}}
+    assert (entries[1].line, entries[1].error.message) == (3, "url is missing")
+
+
+def test_batch_item_overrides(tmp_path):
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"))
+    job = blob.parse_batch_item({"url": "http://host/a.m3u8", "output": str(tmp_path / "out") + "/", "referer": "r"})
+    assert job.save_path == str(tmp_path / "out" / "a.mp4")
+    assert job.headers == {"Referer": "r"} and job.max_concurrent == 0
+    job = blob.parse_batch_item({"url": "http://host/a.m3u8", "output": "/videos/b.ts", "max_concurrent": 2})
+    assert (job.save_name, job.save_path, job.headers, job.max_concurrent) == ("b.ts", "/videos/b.ts", None, 2)
+    blob.state.close()
+
+
+def test_cli_starts_without_heavy_imports():
+    code = "import sys, cli; cli.build_parser(); print(sorted({'aiohttp', 'rich', 'core'} & set(sys.modules)))"
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=cwd, stdout=subprocess.PIPE, text=True, check=True)
+    assert output.stdout.strip() == "[]"
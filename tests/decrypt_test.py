@@ -0,0 +1,49 @@
+import os
+import pytest
+
+pytest.importorskip("cryptography")
+
+from cryptography.hazmat.primitives import padding  # noqa: E402
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes  # noqa: E402
+from decrypt import SegmentDecryptor, parse_iv, sequence_iv  # noqa: E402
+
+
+def encrypt(data: bytes, key: bytes, iv: bytes) -> bytes:
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+def test_segment_decryptor_resume():
+    key, iv = os.urandom(16), sequence_iv(5)
+    assert parse_iv("0x5") == iv
+    data = os.urandom(1000)
+    encrypted = encrypt(data, key, iv)
+
+    decryptor = SegmentDecryptor(key, iv)
+    first = b"".join(decryptor.update(encrypted[i : i + 100]) for i in range(0, 500, 100))
+    assert len(first) % 16 == 0 and data.startswith(first)
+
+    # resume from the block before the cleartext already written
+    resumed = SegmentDecryptor(key)
+    offset = len(first) - 16
+    rest = resumed.update(encrypted[offset:]) + resumed.finalize()
+    assert first + rest == data
+
+
+def test_key_files_named_after_key_url(tmp_path):
+    from core import BlobDownloader
+    from playlist import Key
+
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"))
+    job = blob.new_job("http://host/live.m3u8", "live.ts")
+
+    def key(uri: str) -> Key:
+        return Key({"METHOD": "AES-128", "URI": uri}, lambda uri: "http://host/" + uri, "")
+
+    first = blob.decrypt_key(job, key("k1"), dict())
+    # a rotated key, first again in the playlist of a new run
+    rotated = blob.decrypt_key(job, key("k2"), dict())
+    assert first.path != rotated.path
+    assert first.path == blob.decrypt_key(job, key("k1"), dict()).path
+    blob.state.close()
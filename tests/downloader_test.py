@@ -1,8 +1,352 @@
+import os
+import asyncio
+import hashlib
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from config import DownloaderConfig
-from downloader import Downloader, Task
+from downloader import DownloadError, Downloader, Task, TaskPart
 
 
 def test_downloader():
     downloader = Downloader(**DownloaderConfig)
     tasks = [Task(url="", save_path="")]
     downloader.run(tasks=tasks, desc="test")
+
+
+class FakeContent:
+    def __init__(self, body: bytes, chunk: int, error: Exception = None):
+        self.chunks = [body[i : i + chunk] for i in range(0, len(body), chunk)]
+        self.error = error
+
+    async def iter_chunked(self, size: int):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def read(self, size: int) -> bytes:
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.error is not None:
+            raise self.error
+        return b""
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, chunk: int, content_length: int = None, error: Exception = None):
+        self.content = FakeContent(body, chunk, error)
+        self.content_length = content_length
+        self.headers = {}
+        self.status = 200
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class RangeMismatchSession:
+    """Answers range requests from offset 0 as if the range was 0-, and plain requests with the whole file"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        response = FakeResponse(self.body, 7)
+        if headers:
+            response.status = 206
+            response.headers = {"Content-Range": f"bytes 10-{len(self.body) - 1}/{len(self.body)}"}
+            response.content = FakeContent(self.body[10:], 7)
+        return response
+
+
+class CorruptOnceSession:
+    """Answers the first request with an HTML error page served as 200, then with the segment"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.requests = 0
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests += 1
+        body = b"<!DOCTYPE html><html><body>504 Gateway Time-out</body></html>" if self.requests == 1 else self.body
+        return FakeResponse(body, 64 * 1024, content_length=len(body))
+
+
+@pytest.mark.parametrize("packets", [100, 20000])
+def test_corrupt_segment_fetched_again(tmp_path, packets):
+    downloader = Downloader(**DownloaderConfig)
+    downloader.validate_config["checksum"] = "sha256"
+    body = (b"\x47" + bytes(187)) * packets
+    session = CorruptOnceSession(body)
+    task = Task("http://host/0.ts", str(tmp_path / "0.ts"))
+    task_id = downloader.progress.add_task(description="test", total=1)
+    assert asyncio.get_event_loop().run_until_complete(downloader._safe_fetch_url(session, task_id, task))
+    assert session.requests == 2 and task.rejected == 1 and task.attempts == 2
+    assert task.checksum == hashlib.sha256(body).hexdigest()
+    with open(task.save_path, "rb") as fp:
+        assert fp.read() == body
+
+
+def test_save_ranges(tmp_path):
+    downloader = Downloader(**DownloaderConfig)
+    body = bytes(range(256)) * 4
+    # two adjacent ranges and one after a gap, the body starts at offset 100
+    parts = [TaskPart(100, 50, str(tmp_path / "a")), TaskPart(150, 30, str(tmp_path / "b"))]
+    parts.append(TaskPart(300, 40, str(tmp_path / "c")))
+    response = FakeResponse(body[100:], 7)
+    asyncio.get_event_loop().run_until_complete(downloader.save_ranges(response, 100, parts))
+    assert all(part.done for part in parts)
+    for part in parts:
+        with open(part.save_path, "rb") as fp:
+            assert fp.read() == body[part.offset : part.offset + part.length]
+
+
+@pytest.mark.parametrize("size", [1000, 3 * 1024 * 1024])
+def test_save_as_file_keeps_a_cut_body(tmp_path, size):
+    # bodies read at once and bodies gathered in write buffers
+    downloader = Downloader(**DownloaderConfig)
+    body = bytes(range(256)) * (size // 256)
+    received = body[: len(body) // 2]
+    error = aiohttp.ClientPayloadError("Response payload is not completed")
+    response = FakeResponse(received, 64 * 1024, content_length=len(body), error=error)
+    path = str(tmp_path / "seg.ts.part")
+    with pytest.raises(aiohttp.ClientPayloadError):
+        asyncio.get_event_loop().run_until_complete(downloader.save_as_file(response, path))
+    with open(path, "rb") as fp:
+        assert fp.read() == received
+
+
+def test_fetch_ranges_refetches_on_content_range_mismatch(tmp_path):
+    downloader = Downloader(**DownloaderConfig)
+    body = bytes(range(256))
+    parts = [TaskPart(5, 20, str(tmp_path / "a")), TaskPart(40, 10, str(tmp_path / "b"))]
+    session = RangeMismatchSession(body)
+    task_id = downloader.progress.add_task(description="test", total=1)
+    fetch = downloader.fetch_ranges(session, task_id, "http://host/v.ts", parts)
+    assert asyncio.get_event_loop().run_until_complete(fetch)
+    # the body from offset 10 misses the first part, the whole file is requested once instead of retrying
+    assert session.requests == [{"Range": "bytes=5-49"}, {}]
+    for part in parts:
+        with open(part.save_path, "rb") as fp:
+            assert fp.read() == body[part.offset : part.offset + part.length]
+
+
+def test_session_shared_until_closed():
+    downloader = Downloader()
+
+    async def run():
+        async with downloader:
+            async with downloader.session_scope() as first:
+                pass
+            async with downloader.session_scope() as second:
+                assert second is first and not first.closed
+        async with downloader.session_scope() as own:
+            assert own is not first
+        return first, own
+
+    first, own = asyncio.get_event_loop().run_until_complete(run())
+    assert first.closed and own.closed and downloader.session is None
+
+
+class SegmentServer:
+    """Serves one file, answering Range requests, the first `cut` responses stop halfway through the body"""
+
+    def __init__(self, body: bytes, cut: int = 0, ranges: bool = True):
+        self.body = body
+        self.cut = cut
+        self.ranges = ranges
+        # Range header of every request, None without one
+        self.requests = []
+        self.app = web.Application()
+        self.app.router.add_get("/seg.ts", self.handle)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        byte_range = request.headers.get("Range")
+        self.requests.append(byte_range)
+        offset = 0
+        if byte_range is not None and self.ranges:
+            offset = int(byte_range[len("bytes=") : -1])
+            if offset >= len(self.body):
+                return web.Response(status=416)
+        body = self.body[offset:]
+        response = web.StreamResponse(status=206 if offset else 200)
+        if offset:
+            response.headers["Content-Range"] = f"bytes {offset}-{len(self.body) - 1}/{len(self.body)}"
+        response.content_length = len(body)
+        await response.prepare(request)
+        if self.cut:
+            self.cut -= 1
+            await response.write(body[: len(body) // 2])
+            # the connection drops before Content-Length bytes were sent
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+
+def fetch_served(server: SegmentServer, save_path: str, max_retry: int = 3, key: bytes = b"", iv: bytes = None):
+    """Download the file of a server with fetch_url, without waiting between retries"""
+    downloader = Downloader(max_retry=max_retry)
+    downloader.retry_policy.base_delay = 0.0
+
+    async def fetch():
+        async with TestServer(server.app) as test_server, downloader:
+            task_id = downloader.progress.add_task(description="test", total=1)
+            url = str(test_server.make_url("/seg.ts"))
+            return await downloader.fetch_url(downloader.session, task_id, url, save_path, key=key, iv=iv)
+
+    return asyncio.get_event_loop().run_until_complete(fetch())
+
+
+def test_fetch_url_resumes_interrupted_download(tmp_path):
+    body = os.urandom(300 * 1024)
+    server = SegmentServer(body, cut=1)
+    path = str(tmp_path / "seg.ts")
+    assert fetch_served(server, path)
+    assert server.requests == [None, f"bytes={len(body) // 2}-"]
+    with open(path, "rb") as fp:
+        assert fp.read() == body
+    assert not os.path.exists(path + ".part")
+
+
+def test_fetch_url_restarts_when_range_is_ignored(tmp_path):
+    body = os.urandom(1000)
+    server = SegmentServer(body, ranges=False)
+    path = str(tmp_path / "seg.ts")
+    with open(path + ".part", "wb") as fp:
+        fp.write(b"stale bytes of another version")
+    assert fetch_served(server, path)
+    assert server.requests == ["bytes=30-"]
+    with open(path, "rb") as fp:
+        assert fp.read() == body
+
+
+def test_fetch_url_starts_over_after_416(tmp_path):
+    body = os.urandom(1000)
+    server = SegmentServer(body)
+    path = str(tmp_path / "seg.ts")
+    # a part file longer than the remote file, which changed since
+    with open(path + ".part", "wb") as fp:
+        fp.write(bytes(2000))
+    assert fetch_served(server, path)
+    assert server.requests == ["bytes=2000-", None]
+    with open(path, "rb") as fp:
+        assert fp.read() == body
+
+
+def test_fetch_url_rejects_short_body(tmp_path):
+    body = os.urandom(1000)
+    server = SegmentServer(body, cut=2)
+    path = str(tmp_path / "seg.ts")
+    with pytest.raises(DownloadError):
+        fetch_served(server, path, max_retry=1)
+    # a file with a missing tail is never renamed to its save path
+    assert not os.path.exists(path)
+    assert server.requests == [None, "bytes=500-"]
+    with open(path + ".part", "rb") as fp:
+        assert fp.read() == body[:750]
+
+
+def test_fetch_url_resumes_encrypted_segment(tmp_path):
+    pytest.importorskip("cryptography")
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    key, iv = os.urandom(16), os.urandom(16)
+    data = os.urandom(5000)
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    body = encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+    server = SegmentServer(body)
+    path = str(tmp_path / "seg.ts")
+    # cleartext of the first 100 blocks is on disk
+    with open(path + ".part", "wb") as fp:
+        fp.write(data[:1600])
+    assert fetch_served(server, path, key=key, iv=iv)
+    # the block before the cleartext is fetched again as the IV of the rest
+    assert server.requests == ["bytes=1584-"]
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+
+
+def pool_downloader(max_concurrent: int) -> Downloader:
+    """Downloader whose tasks finish right away, failing for URLs ending with "fail\" """
+    downloader = Downloader(max_concurrent=max_concurrent)
+
+    async def fetch(session, task_id, task):
+        await asyncio.sleep(0)
+        return not task.url.endswith("fail")
+
+    downloader._safe_fetch_url = fetch
+    return downloader
+
+
+def test_pool_pulls_lazily():
+    downloader = pool_downloader(max_concurrent=2)
+    pulled = 0
+
+    def tasks():
+        nonlocal pulled
+        for index in range(50):
+            pulled += 1
+            yield Task(f"http://host/{index}.ts", "")
+
+    ahead = []
+    for count, (task, result) in enumerate(downloader.run_iter(tasks()), 1):
+        ahead.append(pulled - count)
+    # 2 workers and 4 queued tasks
+    assert len(ahead) == 50 and max(ahead) == 6
+
+    async def async_tasks():
+        nonlocal pulled
+        pulled = 0
+        for index in range(50):
+            pulled += 1
+            yield Task(f"http://host/{index}.ts", "")
+
+    async def stream():
+        ahead = []
+        async with downloader.session_scope() as session:
+            task_id = downloader.progress.add_task(description="test", total=None)
+            fetched = downloader.fetch_stream(session, task_id, async_tasks(), max_workers=1)
+            async for task, result in fetched:
+                ahead.append(pulled - int(task.url.rsplit("/", 1)[1][:-3]) - 1)
+        return ahead
+
+    assert max(asyncio.get_event_loop().run_until_complete(stream())) <= 3
+
+
+def test_pool_callback_and_errors():
+    downloader = pool_downloader(max_concurrent=3)
+    finished = []
+
+    async def callback(task: Task, result: bool):
+        finished.append((task.url, result))
+
+    async def fetch(tasks, callback=None):
+        async with downloader.session_scope() as session:
+            task_id = downloader.progress.add_task(description="test", total=None)
+            return await downloader.fetch_tasks(session, task_id, tasks, callback)
+
+    urls = [f"http://host/{index}.ts" for index in range(10)] + ["http://host/fail"]
+    results = asyncio.get_event_loop().run_until_complete(fetch((Task(url, "") for url in urls), callback))
+    assert results == [True] * 10 + [False]
+    assert sorted(finished) == sorted((url, not url.endswith("fail")) for url in urls)
+
+    async def broken_callback(task: Task, result: bool):
+        raise ValueError(f"callback failed for {task.url}")
+
+    with pytest.raises(ValueError, match="callback failed"):
+        asyncio.get_event_loop().run_until_complete(fetch([Task(url, "") for url in urls], broken_callback))
+
+    def broken_source():
+        yield Task("http://host/0.ts", "")
+        raise KeyError("bad manifest line")
+
+    with pytest.raises(KeyError, match="bad manifest line"):
+        asyncio.get_event_loop().run_until_complete(fetch(broken_source()))
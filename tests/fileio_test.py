@@ -0,0 +1,33 @@
+import time
+import asyncio
+from fileio import BufferPool, BufferedFileWriter
+
+
+class SlowFile:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        time.sleep(0.2)
+        self.data += bytes(data)
+
+
+def test_cancelled_writer_waits_for_its_write():
+    pool = BufferPool(4)
+    fp = SlowFile()
+
+    async def run():
+        writer = BufferedFileWriter(fp, pool)
+        await writer.write(b"abcd")
+        task = asyncio.ensure_future(writer.close())
+        await asyncio.sleep(0.05)
+        # e.g. the losing request of a hedged download
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the buffer went back to the pool only once the thread was done with it
+        assert fp.data == b"abcd"
+        assert len(pool.free) == 2
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.wait_for(run(), 5))
+    loop.close()
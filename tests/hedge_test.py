@@ -0,0 +1,16 @@
+from hedge import HedgePolicy
+
+
+def test_hedge_policy():
+    policy = HedgePolicy(percentile=0.9, multiplier=2.0, min_samples=10, max_ratio=0.1, mirrors={"a.com": ["b.com"]})
+    assert policy.delay() is None
+    for index in range(10):
+        policy.observe(0.1 * (index + 1))
+    # 90th percentile of 0.1..1.0 is 1.0
+    assert abs(policy.delay() - 2.0) < 1e-9
+    for _ in range(8):
+        policy.delay()
+    # one hedge for 10 requests
+    assert policy.allow() and not policy.allow()
+    assert policy.hedge_url("https://a.com/x/seg1.ts?t=1") == "https://b.com/x/seg1.ts?t=1"
+    assert policy.hedge_url("https://c.com/seg1.ts") == "https://c.com/seg1.ts"
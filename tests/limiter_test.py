@@ -0,0 +1,98 @@
+import time
+import asyncio
+import itertools
+from types import SimpleNamespace
+from contextlib import AsyncExitStack
+from downloader import DownloadError, error_kind
+from limiter import AdaptiveLimiter, FixedLimiter
+
+
+async def fill(stack: AsyncExitStack, limiter: AdaptiveLimiter, host: str):
+    """Hold slots of a host up to its limit, the limit is only raised while it is used"""
+    while limiter._host(host).in_flight < limiter.limits()[host]:
+        await stack.enter_async_context(limiter.slot(host))
+
+
+def steady_window(limiter: AdaptiveLimiter, host: str):
+    for _ in range(max(limiter.limits()[host], 4)):
+        limiter.record(host, 0.1, 1000, 0.2)
+
+
+def test_additive_increase_up_to_ceiling(monkeypatch):
+    # every measurement one second later, windows of the same requests have the same throughput
+    clock = itertools.count()
+    monkeypatch.setattr("limiter.time", SimpleNamespace(monotonic=lambda: float(next(clock)), time=time.time))
+    limiter = AdaptiveLimiter(max_concurrent=6, initial_concurrent=4, max_total=100)
+
+    async def run():
+        limits = []
+        async with AsyncExitStack() as stack:
+            for _ in range(3):
+                await fill(stack, limiter, "a.com")
+                steady_window(limiter, "a.com")
+                limits.append(limiter.limits()["a.com"])
+        return limits
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == [5, 6, 6]
+    assert [(change.old, change.new, change.reason) for change in limiter.history] == [
+        (4, 5, "throughput steady"),
+        (5, 6, "throughput steady"),
+    ]
+
+
+def test_multiplicative_decrease_down_to_floor():
+    limiter = AdaptiveLimiter(max_concurrent=20, min_concurrent=2, initial_concurrent=16, cooldown=0.0)
+    errors = [DownloadError("u", "HTTP 429", status=429), DownloadError("u", "HTTP 502", status=502)]
+    errors.append(asyncio.TimeoutError())
+    for error in errors:
+        limiter.record("a.com", 0.0, 0, 1.0, error_kind(error))
+    assert [change.new for change in limiter.history] == [8, 4, 2]
+    limiter.record("a.com", 0.0, 0, 1.0, "timeout")
+    assert limiter.limits() == {"a.com": 2}
+    # a fatal answer says nothing about the load of the host
+    assert error_kind(DownloadError("u", "HTTP 404", status=404)) == "error"
+
+    limiter = AdaptiveLimiter(initial_concurrent=16, cooldown=60.0)
+    for _ in range(3):
+        limiter.record("a.com", 0.0, 0, 1.0, "throttle")
+    # errors of one burst cut the limit once
+    assert limiter.limits() == {"a.com": 8}
+
+
+def test_global_cap_across_hosts():
+    limiter = AdaptiveLimiter(max_concurrent=4, initial_concurrent=4, max_total=5)
+    peak = in_flight = 0
+
+    async def request(host: str):
+        nonlocal peak, in_flight
+        async with limiter.slot(host):
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def run():
+        await asyncio.gather(*(request(host) for host in ("a.com", "b.com", "c.com") for _ in range(4)))
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert peak == 5
+    assert all(state.in_flight == 0 for state in limiter.hosts.values())
+
+
+def test_limiters_built_outside_the_loop():
+    for limiter in (FixedLimiter(2), AdaptiveLimiter(max_concurrent=2, initial_concurrent=2)):
+
+        async def request():
+            async with limiter.slot("a.com"):
+                await asyncio.sleep(0.001)
+
+        async def run():
+            await asyncio.gather(*(request() for _ in range(5)))
+
+        # like a BlobDownloader built at import time and awaited under asyncio.run, twice
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(run())
+            finally:
+                loop.close()
@@ -0,0 +1,61 @@
+import os
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from core import BlobDownloader
+from live import LiveError
+
+
+def segment(sequence: int) -> bytes:
+    return (bytes([0x47, sequence]) + bytes(186)) * 2
+
+
+class LiveServer:
+    """Serves a sliding window of 3 segments, one segment further at every poll, ended after `polls` polls"""
+
+    def __init__(self, polls: int):
+        self.polls = polls
+        self.polled = 0
+        self.app = web.Application()
+        self.app.router.add_get("/live.m3u8", self.playlist)
+        self.app.router.add_get("/{sequence}.ts", self.segment)
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        first = self.polled
+        self.polled += 1
+        lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:0.1", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        if self.polls:
+            for sequence in range(first, first + 3):
+                lines += ["#EXTINF:0.1,", f"{sequence}.ts"]
+        if self.polled >= self.polls:
+            lines.append("#EXT-X-ENDLIST")
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def segment(self, request: web.Request) -> web.Response:
+        return web.Response(body=segment(int(request.match_info["sequence"])))
+
+
+def record(tmp_path, server: LiveServer) -> str:
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"))
+    test_server = TestServer(server.app)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test_server.start_server())
+    try:
+        return blob.record_live(str(test_server.make_url("/live.m3u8")), "live.ts")
+    finally:
+        loop.run_until_complete(test_server.close())
+        blob.state.close()
+
+
+def test_live_recording_in_order(tmp_path):
+    video_path = record(tmp_path, LiveServer(polls=3))
+    with open(video_path, "rb") as fp:
+        assert fp.read() == b"".join(segment(sequence) for sequence in range(5))
+
+
+def test_live_playlist_ending_at_once(tmp_path):
+    with pytest.raises(LiveError, match="ended before any segment"):
+        record(tmp_path, LiveServer(polls=0))
+    assert not os.path.exists(tmp_path / "videos" / "live.ts")
+    assert not os.path.exists(tmp_path / "tmp" / "live.ts" / "stream.ts")
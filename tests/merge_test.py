@@ -0,0 +1,38 @@
+import os
+import sys
+import asyncio
+import pytest
+from core import BlobDownloader
+from merge import MergeError, async_run_ffmpeg
+
+
+def test_ts_videos_merged_without_ffmpeg(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"))
+    job = blob.new_job("http://host/index.m3u8", "video.ts")
+    blob.start_job(job)
+    job.streamable = True
+    job.segment_paths = [os.path.join(job.tmp_path, f"{index}.ts") for index in [0, 1, 0]]
+    for index in range(2):
+        with open(job.segment_paths[index], "wb") as fp:
+            fp.write(bytes([0x47, index]) * 94)
+    video_path = asyncio.get_event_loop().run_until_complete(blob.async_merge_media(job, "unused.m3u8"))
+    with open(video_path, "rb") as fp:
+        assert fp.read() == bytes([0x47, 0]) * 94 + bytes([0x47, 1]) * 94 + bytes([0x47, 0]) * 94
+    # encrypted, fMP4 or non-TS outputs still need ffmpeg
+    job.save_path = os.path.join(str(tmp_path / "videos"), "video.mp4")
+    with pytest.raises(MergeError, match="not installed"):
+        blob.merge_media(job, "unused.m3u8")
+    blob.state.close()
+
+
+def test_ffmpeg_failure_reports_stderr(tmp_path, monkeypatch):
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    ffmpeg = bin_path / "ffmpeg"
+    ffmpeg.write_text(f"#!{sys.executable}\nimport sys\nsys.stderr.write('local.m3u8: No such file\\n')\nsys.exit(1)\n")
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    merge = async_run_ffmpeg("local.m3u8", str(tmp_path / "out.mp4"))
+    with pytest.raises(MergeError, match=r"code 1\): local.m3u8: No such file"):
+        asyncio.get_event_loop().run_until_complete(merge)
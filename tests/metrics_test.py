@@ -0,0 +1,21 @@
+from metrics import MemorySink, PrometheusSink, SegmentMetric, VideoMetric, label
+
+
+def test_prometheus_labels_are_escaped(tmp_path):
+    assert label("error", 'a "b" \\ c\nd') == 'error="a \\"b\\" \\\\ c\\nd"'
+    sink = PrometheusSink(str(tmp_path / "blob.prom"))
+    metric = SegmentMetric("video", "http://host/seg0.ts", "host")
+    metric.error = 'bad "header"\nline'
+    sink.segment(metric)
+    assert 'blob_segment_errors_total{error="bad \\"header\\"\\nline"} 1' in sink.render().splitlines()
+
+
+def test_memory_sink_keeps_latest_videos():
+    sink = MemorySink(max_videos=2)
+    for index in range(5):
+        metric = VideoMetric(f"video{index}")
+        metric.status = "failed" if index == 0 else "done"
+        sink.video(metric)
+    summary = sink.summary()
+    assert [video["video"] for video in summary["videos"]] == ["video3", "video4"]
+    assert summary["video_statuses"] == {"failed": 1, "done": 4}
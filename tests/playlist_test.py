@@ -0,0 +1,65 @@
+from urllib.parse import urljoin
+from playlist import fit_variant, parse_attributes, parse_playlist, select_variant, url_resolver
+
+
+def test_parse_playlist():
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:4",
+        "#EXT-X-MEDIA-SEQUENCE:10",
+        '#EXT-X-KEY:METHOD=AES-128,URI="../key?a=1,b=2",IV=0x01',
+        "#EXTINF:4.5,title",
+        "#EXT-X-BYTERANGE:100@0",
+        "media.ts",
+        "#EXTINF:4,",
+        "#EXT-X-BYTERANGE:50",
+        "media.ts",
+        "#EXT-X-KEY:METHOD=NONE",
+        "#EXT-X-DISCONTINUITY",
+        "#EXTINF:4,",
+        "https://other.example.com/a/b.ts",
+        "#EXT-X-ENDLIST",
+    ]
+    playlist = parse_playlist(lines, "https://example.com/vod/x/index.m3u8?token=1")
+    first, second, third = playlist.segments
+    assert playlist.endlist and playlist.media_sequence == 10
+    assert [segment.sequence for segment in playlist.segments] == [10, 11, 12]
+    assert first.url == "https://example.com/vod/x/media.ts" and first.duration == 4.5
+    assert (first.byterange, second.byterange, third.byterange) == ((100, 0), (50, 100), None)
+    assert first.key is second.key and first.key.url == "https://example.com/vod/key?a=1,b=2"
+    assert first.key.iv == "0x01"
+    assert third.key is None and third.discontinuity and not second.discontinuity
+    assert third.url == "https://other.example.com/a/b.ts"
+
+
+def test_url_resolver():
+    base = "https://example.com/vod/x/index.m3u8?token=1"
+    resolve = url_resolver(base)
+    for uri in ["a.ts", "a.ts?b=1", "../a.ts", "/a.ts", "//cdn/a.ts", "https://cdn/a/../a.ts", "?q=1", "a:b.ts"]:
+        assert resolve(uri) == urljoin(base, uri)
+    assert parse_attributes('METHOD=AES-128,URI="k,1",IV=0x0A') == {"METHOD": "AES-128", "URI": "k,1", "IV": "0x0A"}
+
+
+def test_select_variant():
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360",
+        "360p/index.m3u8",
+        "#EXT-X-STREAM-INF:BANDWIDTH=5000000,AVERAGE-BANDWIDTH=4000000,RESOLUTION=1920x1080",
+        "1080p/index.m3u8",
+        '#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"',
+        "720p/index.m3u8",
+    ]
+    playlist = parse_playlist(lines, "https://example.com/vod/x/master.m3u8")
+    low, high, middle = playlist.variants
+    assert playlist.is_master and not playlist.segments
+    assert middle.url == "https://example.com/vod/x/720p/index.m3u8" and middle.codecs == "avc1.4d401f,mp4a.40.2"
+    assert select_variant(playlist.variants) is high and select_variant(playlist.variants, "lowest") is low
+    assert select_variant(playlist.variants, "max_bandwidth", max_bandwidth=3000000) is middle
+    assert select_variant(playlist.variants, "max_bandwidth", max_bandwidth=100) is low
+    assert select_variant(playlist.variants, "resolution", resolution="720p") is middle
+    assert select_variant(playlist.variants, "resolution", resolution="1280x719") is low
+    # 600 seconds of video at 1 MB/s: 1080p (300 MB on average) needs 300 seconds
+    assert fit_variant(playlist.variants, 1000000, 600, 300) is high
+    assert fit_variant(playlist.variants, 1000000, 600, 299) is middle
+    assert fit_variant(playlist.variants, 1000, 600, 300) is low
@@ -0,0 +1,71 @@
+from progress import TransferProgress
+
+
+def test_transfer_progress_counts_bytes():
+    progress = TransferProgress(headless=True)
+    task_id = progress.add_task(description="test", total=3)
+
+    first = progress.transfer(task_id, "host")
+    first.start(0, 100)
+    first.add(100)
+    first.done()
+    # no Content-Length, the unknown files count as large as the known ones
+    assert progress.rows[task_id].estimated_total() == 300
+
+    second = progress.transfer(task_id, "host")
+    second.start(50, 250)
+    second.add(100)
+    # the server ignored the range, the retry starts over
+    second.start(0, 250)
+    assert progress.rows[task_id].bytes == 100
+    second.add(250)
+    second.done()
+
+    third = progress.transfer(task_id, "other")
+    third.start(0, None)
+    third.add(10)
+    third.failed()
+
+    stats = progress.rows[task_id]
+    assert (stats.bytes, stats.files, stats.failed) == (350, 2, 1)
+    assert stats.estimated_total() == 350
+    assert progress.hosts["host"].bytes == 450
+    assert "2/3 files" in progress.stats_line()
+
+
+def test_transfer_progress_removes_rows():
+    progress = TransferProgress(headless=True)
+    for _ in range(3):
+        task_id = progress.add_task(description="run", total=1)
+        progress.transfer(task_id, "host").start(0, 10)
+        progress.stats_line()
+        progress.remove_task(task_id)
+    assert not progress.rows and not progress.row_meters and not progress.progress.tasks
+    assert progress.stats_line() == ""
+
+
+def test_concurrent_runs_share_the_display():
+    import asyncio
+    from downloader import Downloader, Task
+
+    downloader = Downloader()
+    downloader.progress = TransferProgress(headless=True, log_interval=60.0)
+    # whether the stats thread still ran while the slow run downloaded after the fast one ended
+    running = []
+
+    async def fetch(session, task_id, task):
+        if task.url.endswith("slow"):
+            await asyncio.sleep(0.05)
+            running.append(downloader.progress.logging_thread is not None)
+        return True
+
+    downloader._safe_fetch_url = fetch
+
+    async def run():
+        fast = downloader.async_run([Task("http://host/fast", "")], "fast")
+        slow = downloader.async_run([Task("http://host/slow", "")], "slow")
+        return await asyncio.gather(fast, slow)
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == [[True], [True]]
+    assert running == [True]
+    assert downloader.progress.users == 0 and downloader.progress.logging_thread is None
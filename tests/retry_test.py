@@ -0,0 +1,25 @@
+from retry import CircuitBreaker, RetryPolicy, parse_retry_after
+
+
+def test_retry_policy():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, max_retry_after=60.0)
+    for retry in range(6):
+        assert 0 <= policy.delay(retry) <= min(5.0, 2**retry)
+    assert policy.delay(0, retry_after=3.0) == 3.0
+    assert policy.delay(0, retry_after=600.0) == 60.0
+    assert 503 in policy.retry_statuses and 404 not in policy.retry_statuses
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") == 0.0 and parse_retry_after(None) == 0.0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failures=3, cooldown=10.0, max_cooldown=15.0)
+    for _ in range(2):
+        breaker.failure("a.com")
+    assert not breaker.is_open("a.com")
+    breaker.failure("a.com")
+    assert breaker.is_open("a.com") and not breaker.is_open("b.com")
+    assert breaker.hosts["a.com"].cooldown == 15.0
+    breaker.success("a.com")
+    assert breaker.hosts["a.com"].failures == 0 and breaker.hosts["a.com"].cooldown == 10.0
@@ -0,0 +1,81 @@
+import os
+import asyncio
+from core import BlobDownloader
+from downloader import Task
+from metrics import VideoMetric
+from scheduler import BatchScheduler
+
+
+def test_stream_segments_within_disk_budget(tmp_path):
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"), max_tmp_size=250)
+    job = blob.new_job("http://host/index.m3u8", "video.ts")
+    blob.start_job(job)
+    job.segment_paths = [os.path.join(job.tmp_path, f"{index}.ts") for index in range(6)]
+    job.streamable = True
+    tasks = [Task(f"http://host/{index}.ts", path, job.save_name) for index, path in enumerate(job.segment_paths)]
+    attempts = {}
+    peak = [0]
+
+    async def fetch_tasks(session, task_id, source, callback=None, max_workers=0):
+        # one download at a time, the first segment fails once
+        results = []
+        async for task in source:
+            attempts[task.url] = attempts.get(task.url, 0) + 1
+            result = not (task.url.endswith("/0.ts") and attempts[task.url] == 1)
+            if result:
+                with open(task.save_path, "wb") as fp:
+                    fp.write(os.path.basename(task.save_path).encode() * 25)
+                task.size = os.path.getsize(task.save_path)
+            task.attempts += 1
+            on_disk = [name for name in os.listdir(job.tmp_path) if name[0].isdigit()]
+            peak[0] = max(peak[0], sum(os.path.getsize(os.path.join(job.tmp_path, name)) for name in on_disk))
+            await callback(task, result)
+            results.append(result)
+        return results
+
+    blob.downloader.fetch_tasks = fetch_tasks
+    scheduler = BatchScheduler(blob)
+
+    async def run():
+        task_id = scheduler._start()
+        return await scheduler._stream_segments(None, task_id, job, tasks, VideoMetric(job.save_name))
+
+    video_path = asyncio.get_event_loop().run_until_complete(run())
+    blob.state.close()
+    # the failed segment blocking the output is retried out of turn instead of failing the video
+    assert attempts["http://host/0.ts"] == 2
+    with open(video_path, "rb") as fp:
+        assert fp.read() == b"".join(f"{index}.ts".encode() * 25 for index in range(6))
+    assert peak[0] <= 250 + 100
+    assert scheduler.disk_budget.used == 0
+    assert not [name for name in os.listdir(job.tmp_path) if name[0].isdigit()]
+
+
+def test_segments_recorded_while_downloading(tmp_path):
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"))
+    job = blob.new_job("http://host/index.m3u8", "video.ts")
+    blob.start_job(job)
+    tasks = [Task(f"http://host/{index}.ts", os.path.join(job.tmp_path, f"{index}.ts")) for index in range(5)]
+    blob.state.add_segments(job.video_id, [(task.url, task.save_path) for task in tasks])
+    recorded = []
+
+    async def fetch_tasks(session, task_id, source, callback=None, max_workers=0):
+        for task in source:
+            recorded.append(len(blob.state.done_segments(job.video_id)))
+            task.size = 10
+            task.attempts += 1
+            await callback(task, True)
+        return [True] * len(source)
+
+    blob.downloader.fetch_tasks = fetch_tasks
+    scheduler = BatchScheduler(blob, state_batch=2)
+
+    async def run():
+        task_id = scheduler._start()
+        await scheduler._download_segments(None, task_id, job, tasks)
+
+    asyncio.get_event_loop().run_until_complete(run())
+    # a crash loses at most the latest batch
+    assert recorded == [0, 0, 2, 2, 4]
+    assert len(blob.state.done_segments(job.video_id)) == 5
+    blob.state.close()
@@ -0,0 +1,45 @@
+import os
+from core import BlobDownloader
+from state import StateStore
+
+
+def test_state_store_resume(tmp_path):
+    store = StateStore(os.path.join(tmp_path, "state.db"))
+    video_id = store.add_video("http://host/index.m3u8", "a.mp4", "/videos/a.mp4")
+    assert store.add_video("http://host/index.m3u8", "a.mp4", "/videos/a.mp4") == video_id
+
+    store.add_segments(video_id, [("http://host/0.ts", "/tmp/0.ts"), ("http://host/1.ts", "/tmp/1.ts")])
+    store.update_segments(
+        video_id,
+        [
+            ("/tmp/0.ts", StateStore.STATUS_DONE, 10, 1, ""),
+            ("/tmp/1.ts", StateStore.STATUS_FAILED, 0, 4, "HTTP 503"),
+        ],
+    )
+    assert store.done_segments(video_id) == {"/tmp/0.ts"}
+    assert store.failed_segments(video_id) == [("http://host/1.ts", "/tmp/1.ts", 4, "HTTP 503")]
+
+    store.set_video_status(video_id, StateStore.STATUS_FAILED, "merge media failed")
+    assert store.failed_videos() == [{"url": "http://host/index.m3u8", "save_name": "a.mp4", "output": "/videos/a.mp4"}]
+    store.recheck_segments(video_id, ["/tmp/0.ts"])
+    assert store.done_segments(video_id) == set()
+    store.close()
+
+
+def test_failed_video_keeps_job_overrides(tmp_path):
+    blob = BlobDownloader(save_path=str(tmp_path / "videos"), tmp_path=str(tmp_path / "tmp"))
+    item = {"url": "http://host/a.m3u8", "output": str(tmp_path / "out" / "b.ts"), "referer": "r", "max_concurrent": 2}
+    job = blob.parse_batch_item(item)
+    blob.start_job(job)
+    segments = [("http://host/0.ts", os.path.join(job.tmp_path, "0.ts")), ("http://host/1.ts", job.tmp_path + "/1.ts")]
+    blob.state.add_segments(job.video_id, segments)
+    blob.state.update_segments(job.video_id, [(path, StateStore.STATUS_DONE, 1, 1, "") for _, path in segments])
+    open(segments[0][1], "wb").close()
+    blob.fail_job(job, Exception("HTTP 404"))
+    # only the segment whose file is gone is checked again
+    assert blob.state.done_segments(job.video_id) == {segments[0][1]}
+
+    retried = blob.parse_batch_item(blob.state.failed_videos()[0])
+    assert (retried.save_name, retried.save_path, retried.tmp_path) == ("b.ts", job.save_path, job.tmp_path)
+    assert retried.headers == {"Referer": "r"} and retried.max_concurrent == 2
+    blob.state.close()
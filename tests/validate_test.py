@@ -0,0 +1,54 @@
+import pytest
+from validate import CorruptSegmentError, SegmentValidator
+
+
+def box(kind: bytes, payload: bytes) -> bytes:
+    return (8 + len(payload)).to_bytes(4, "big") + kind + payload
+
+
+def validate(body: bytes, chunk: int):
+    validator = SegmentValidator("md5")
+    for start in range(0, len(body), chunk):
+        validator.update(body[start : start + chunk])
+    validator.finish()
+    return validator
+
+
+@pytest.mark.parametrize("chunk", [1, 5, 188, 1000])
+def test_segment_validator(chunk):
+    ts = (b"\x47" + bytes(187)) * 20
+    assert validate(ts, chunk).kind == "ts"
+    fmp4 = box(b"styp", b"msdh") + box(b"moof", bytes(40)) + b"\0\0\0\1mdat" + (316).to_bytes(8, "big") + bytes(300)
+    assert validate(fmp4, chunk).kind == "mp4"
+    # packed audio, subtitles and playlists are not checked
+    assert validate(b"WEBVTT\n\n00:00.000 --> 00:01.000\nhello\n", chunk).kind == "other"
+
+    broken = bytearray(ts)
+    broken[188 * 7] = 0
+    for body, reason in [
+        (bytes(broken), "sync byte at byte 1316"),
+        (ts[:-10], "ends within a packet"),
+        (fmp4[:-1], "runs to byte"),
+        (b"  <html><head><title>404</title></head></html>" + bytes(100), "HTML page"),
+        (b"", "empty body"),
+    ]:
+        with pytest.raises(CorruptSegmentError, match=reason):
+            validate(body, chunk)
+
+
+def test_validate_file_in_chunks(tmp_path):
+    path = str(tmp_path / "seg.ts.part")
+    with open(path, "wb") as fp:
+        fp.write((b"\x47" + bytes(187)) * 20)
+    validator = SegmentValidator()
+    validator.update_file(path, read_size=100)
+    # the resumed body goes on where the file ends
+    validator.update(b"\x47" + bytes(187))
+    validator.finish()
+    assert (validator.kind, validator.size) == ("ts", 188 * 21)
+
+    with open(path, "r+b") as fp:
+        fp.seek(188 * 15)
+        fp.write(b"\0")
+    with pytest.raises(CorruptSegmentError, match="at byte 2820"):
+        SegmentValidator().update_file(path, read_size=100)
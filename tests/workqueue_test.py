@@ -0,0 +1,90 @@
+import os
+import time
+import threading
+from workqueue import QueueWorker, WorkQueue, local_tmp_path, worker_blob_config
+
+
+def test_work_queue_leases(tmp_path):
+    path = os.path.join(tmp_path, "queue.db")
+    queue = WorkQueue(path, lease=60, max_attempts=2)
+    assert queue.add([("http://host/a.m3u8", "a.mp4"), "http://host/b.m3u8", ("http://host/a.m3u8", "a.mp4")]) == 2
+    first = queue.claim("w1")
+    second = queue.claim("w2")
+    assert (first.save_name, second.url, queue.claim("w3")) == ("a.mp4", "http://host/b.m3u8", None)
+    assert not queue.complete(first.id, "w2", "/videos/a.mp4")
+    assert queue.complete(first.id, "w1", "/videos/a.mp4")
+
+    # w2 died, its lease expires and the video is claimed again
+    queue.conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() - 1, second.id))
+    again = queue.claim("w3")
+    assert (again.id, again.attempts) == (second.id, 2)
+    assert not queue.heartbeat(second.id, "w2") and queue.heartbeat(second.id, "w3")
+    assert queue.fail(second.id, "w3", "HTTP 404")
+    assert queue.counts() == {"done": 1, "failed": 1}
+    assert queue.retry_failed() == 1 and queue.claim("w1").id == second.id
+    queue.close()
+
+
+def test_work_queue_claims_are_exclusive(tmp_path):
+    path = os.path.join(tmp_path, "queue.db")
+    queue = WorkQueue(path)
+    queue.add(f"http://host/{index}.m3u8" for index in range(200))
+    queue.close()
+    claimed = []
+
+    def work(worker: str):
+        queue = WorkQueue(path)
+        while True:
+            item = queue.claim(worker)
+            if item is None:
+                break
+            claimed.append(item.id)
+            queue.complete(item.id, worker, "")
+        queue.close()
+
+    threads = [threading.Thread(target=work, args=(f"w{index}",)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == list(range(1, 201))
+
+
+class FakeBlob:
+    def __init__(self):
+        self.runs = []
+
+    def parse_batch_item(self, item):
+        from core import VideoJob
+
+        return VideoJob(item[0], item[1] or "video.mp4", "/videos", "/tmp")
+
+    def run(self, blob_url, save_name):
+        self.runs.append(save_name)
+        if save_name == "bad.mp4":
+            raise Exception("failed to download m3u8 file")
+        time.sleep(0.05)
+        return f"/videos/{save_name}"
+
+
+def test_queue_worker(tmp_path):
+    path = os.path.join(tmp_path, "queue.db")
+    queue = WorkQueue(path)
+    queue.add([("http://host/a.m3u8", "a.mp4"), ("http://host/bad.m3u8", "bad.mp4")])
+    blob = FakeBlob()
+    worker = QueueWorker(blob, path, "w1", heartbeat=0.01, max_attempts=2, poll_interval=0.01)
+    assert worker.run() == {"done": 1, "failed": 2}
+    # the failed video was claimed until its attempts ran out
+    assert blob.runs == ["a.mp4", "bad.mp4", "bad.mp4"]
+    row = queue.conn.execute("SELECT status, attempts, error FROM jobs WHERE save_name = 'bad.mp4'").fetchone()
+    assert row == ("failed", 2, "failed to download m3u8 file")
+    assert queue.conn.execute("SELECT path FROM jobs WHERE save_name = 'a.mp4'").fetchone() == ("/videos/a.mp4",)
+    queue.close()
+
+
+def test_worker_tmp_path_is_local():
+    assert worker_blob_config({"save_path": "/shared/videos"}) == {
+        "save_path": "/shared/videos",
+        "tmp_path": local_tmp_path(),
+    }
+    assert worker_blob_config({"tmp_path": "/scratch/tmp"})["tmp_path"] == "/scratch/tmp"
@@ -0,0 +1,158 @@
+import hashlib
+from typing import Optional
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# top-level boxes a MP4 file, an fMP4 init section or media segment starts with
+MP4_BOXES = frozenset(
+    [b"ftyp", b"styp", b"moov", b"moof", b"mdat", b"sidx", b"ssix", b"emsg", b"prft", b"free", b"skip", b"uuid"]
+)
+# bytes looked at to tell the container
+SNIFF_SIZE = 64
+# bytes of a file read at once when it is checked again
+READ_SIZE = 1024 * 1024
+
+
+class CorruptSegmentError(Exception):
+    """Raised when a body is not the segment it claims to be, the download starts over"""
+
+
+class SegmentValidator:
+    """SegmentValidator checks a segment chunk by chunk while it is written.
+
+    The container is told from the first bytes. MPEG-TS needs the sync
+    byte at the start of every 188 byte packet and whole packets, MP4 and
+    fMP4 a chain of boxes ending exactly at the end of the file. An HTML
+    page served with a 200 status is rejected at once; other formats, like
+    packed audio or subtitles, are only checked for an empty body. The
+    checksum of the data, when enabled, is computed on the way.
+    """
+
+    def __init__(self, checksum: str = ""):
+        """Initialize segment validator
+
+        Args:
+            checksum (str, optional): hashlib algorithm of the checksum, e.g. "sha256", empty for none.
+                Defaults to "".
+        """
+        self.algorithm = checksum
+        self.reset()
+
+    def reset(self):
+        """Forget the data checked so far, before a body is written again from its start"""
+        # "ts", "mp4" or "other", empty until SNIFF_SIZE bytes arrived
+        self.kind = ""
+        self.size = 0
+        self.head = b""
+        # offset of the next MP4 box and the bytes of its header received so far, None once a box runs to the end
+        self.next_box: Optional[int] = 0
+        self.box_header = b""
+        self.hash = hashlib.new(self.algorithm) if self.algorithm else None
+        self.checksum = ""
+
+    def update(self, data: bytes):
+        """Check the next bytes of the segment
+
+        Raises:
+            CorruptSegmentError: as soon as the data cannot belong to a valid segment
+        """
+        if not data:
+            return
+        if self.hash is not None:
+            self.hash.update(data)
+        if not self.kind:
+            self.head += bytes(data[: SNIFF_SIZE - len(self.head)])
+            if len(self.head) < SNIFF_SIZE:
+                self.size += len(data)
+                return
+            self.sniff()
+            # the whole head is checked with the container known
+            position, self.size = self.size, 0
+            self.check(self.head)
+            data = data[SNIFF_SIZE - position :]
+        self.check(data)
+
+    def update_file(self, path: str, read_size: int = READ_SIZE):
+        """Check the bytes of a file already written, e.g. the part file of a resumed download
+
+        The file is read in chunks, so memory does not grow with its size.
+
+        Raises:
+            CorruptSegmentError: as soon as the data cannot belong to a valid segment
+        """
+        with open(path, "rb") as fp:
+            while True:
+                data = fp.read(read_size)
+                if not data:
+                    break
+                self.update(data)
+
+    def finish(self):
+        """Check the end of the segment once its whole body was written
+
+        Raises:
+            CorruptSegmentError: if the body is empty or its last packet or box is cut
+        """
+        if not self.kind:
+            if not self.head:
+                raise CorruptSegmentError("empty body")
+            self.sniff()
+            self.size = 0
+            self.check(self.head)
+        if self.kind == "ts" and self.size % TS_PACKET_SIZE:
+            raise CorruptSegmentError(f"MPEG-TS body of {self.size} bytes ends within a packet")
+        if self.kind == "mp4" and self.next_box is not None and self.next_box != self.size:
+            raise CorruptSegmentError(f"MP4 box runs to byte {self.next_box}, body has {self.size} bytes")
+        if self.hash is not None:
+            self.checksum = self.hash.hexdigest()
+
+    def sniff(self):
+        """Tell the container from the first bytes"""
+        head = self.head
+        if head[0] == TS_SYNC_BYTE:
+            self.kind = "ts"
+        elif head[4:8] in MP4_BOXES:
+            self.kind = "mp4"
+        elif head.lstrip()[:14].lower() == b"<!doctype html" or head.lstrip()[:5].lower() == b"<html":
+            raise CorruptSegmentError("HTML page instead of a segment")
+        else:
+            self.kind = "other"
+
+    def check(self, data: bytes):
+        """Check bytes at the current size of a known container"""
+        if self.kind == "ts":
+            first = -self.size % TS_PACKET_SIZE
+            syncs = bytes(memoryview(data)[first::TS_PACKET_SIZE])
+            if syncs.count(TS_SYNC_BYTE) != len(syncs):
+                packet = next(index for index, byte in enumerate(syncs) if byte != TS_SYNC_BYTE)
+                offset = self.size + first + packet * TS_PACKET_SIZE
+                raise CorruptSegmentError(f"MPEG-TS packet without sync byte at byte {offset}")
+        elif self.kind == "mp4":
+            self.check_boxes(data)
+        self.size += len(data)
+
+    def check_boxes(self, data: bytes):
+        """Follow the chain of MP4 box headers through the data"""
+        while self.next_box is not None:
+            header = self.box_header
+            # a size of 1 is followed by a 64-bit size
+            needed = 16 if header[:4] == b"\0\0\0\1" else 8
+            if len(header) < needed:
+                index = self.next_box + len(header) - self.size
+                if index >= len(data):
+                    return
+                self.box_header = header + bytes(data[index : index + needed - len(header)])
+                continue
+            size, box = int.from_bytes(header[:4], "big"), header[4:8]
+            if not all(32 <= byte < 127 for byte in box):
+                raise CorruptSegmentError(f"MP4 box of type {box!r} at byte {self.next_box}")
+            if size == 0:
+                # the last box runs to the end of the file
+                self.next_box = None
+                return
+            if size == 1:
+                size = int.from_bytes(header[8:16], "big")
+            if size < len(header):
+                raise CorruptSegmentError(f"MP4 box {box.decode()} of {size} bytes at byte {self.next_box}")
+            self.next_box += size
+            self.box_header = b""
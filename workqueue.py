@@ -0,0 +1,429 @@
+import os
+import time
+import socket
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
+from log import logger, setup_logging
+from config import BlobDownloaderConfig, QueueConfig
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+
+class QueueItem(NamedTuple):
+    """A video claimed from the work queue"""
+
+    id: int
+    url: str
+    save_name: str
+    attempts: int
+
+
+class WorkQueue:
+    """WorkQueue shares the videos of a batch between worker processes through an SQLite file.
+
+    A worker claims one video at a time with a lease, renews it with
+    heartbeats while the video downloads and reports the outcome. A lease
+    that was not renewed, e.g. because its worker was killed, expires and
+    the video is claimed again by another worker, up to `max_attempts`
+    claims. Claims run in an immediate transaction, so two workers never
+    lease the same video.
+
+    The rollback journal is used instead of WAL: WAL needs memory shared by
+    every process of the database, which workers on several hosts of a
+    shared filesystem do not have. Leases compare wall clocks, the hosts'
+    clocks must be synchronized.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_LEASED = "leased"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, db_path: str, lease: float = 300.0, max_attempts: int = 3):
+        """Initialize work queue
+
+        Args:
+            db_path (str): Path of the SQLite file, created if missing
+            lease (float, optional): Seconds a claim lasts without a heartbeat. Defaults to 300.
+            max_attempts (int, optional): Claims of a video before it is failed for good. Defaults to 3.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.lease = lease
+        self.max_attempts = max(1, max_attempts)
+        # transactions are opened explicitly, claims need BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                save_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT NOT NULL DEFAULT '',
+                lease_until REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT NOT NULL DEFAULT '',
+                path TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL,
+                UNIQUE (url, save_name)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+            """
+        )
+
+    def add(self, items: Iterable, chunk_size: int = 1000) -> int:
+        """Queue videos, videos already in the queue are kept as they are
+
+        Args:
+            items (Iterable): (url, save_name) tuples or just URLs, read lazily
+            chunk_size (int, optional): Videos inserted per transaction. Defaults to 1000.
+
+        Returns:
+            int: Number of videos added
+        """
+        added = 0
+        chunk: List[tuple] = []
+        for item in items:
+            if isinstance(item, (list, tuple)) and len(item) >= 2:
+                url, save_name = item[0], item[1] or ""
+            elif isinstance(item, str):
+                url, save_name = item, ""
+            else:
+                logger.error(f"Invalid item format: {item}")
+                continue
+            chunk.append((url.strip(), save_name, self.STATUS_QUEUED, time.time()))
+            if len(chunk) >= chunk_size:
+                added += self._insert(chunk)
+                chunk = []
+        if chunk:
+            added += self._insert(chunk)
+        return added
+
+    def _insert(self, rows: List[tuple]) -> int:
+        with self._transaction():
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (url, save_name, status, updated_at) VALUES (?, ?, ?, ?)", rows
+            )
+            return self.conn.total_changes - before
+
+    def claim(self, worker: str) -> Optional[QueueItem]:
+        """Lease the next queued video, or a video whose lease expired
+
+        Args:
+            worker (str): Id of the claiming worker
+
+        Returns:
+            Optional[QueueItem]: Claimed video, None if no video can be claimed now
+        """
+        now = time.time()
+        with self._transaction():
+            # a video whose workers keep dying is not claimed forever
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? "
+                "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                (self.STATUS_FAILED, "lease expired", now, self.STATUS_LEASED, now, self.max_attempts),
+            )
+            row = self.conn.execute(
+                "SELECT id, url, save_name, attempts FROM jobs "
+                "WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY id LIMIT 1",
+                (self.STATUS_QUEUED, self.STATUS_LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[3]:
+                logger.warning(f"claiming {row[1]} again, attempt {row[3] + 1}")
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ?",
+                (self.STATUS_LEASED, worker, now + self.lease, now, row[0]),
+            )
+        return QueueItem(row[0], row[1], row[2], row[3] + 1)
+
+    def heartbeat(self, item_id: int, worker: str) -> bool:
+        """Renew the lease of a claimed video
+
+        Returns:
+            bool: False if the lease expired and the video was claimed by another worker
+        """
+        now = time.time()
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                (now + self.lease, now, item_id, worker, self.STATUS_LEASED),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, item_id: int, worker: str, path: str) -> bool:
+        """Report a downloaded video
+
+        Returns:
+            bool: False if the lease was lost meanwhile, the report is dropped
+        """
+        return self._finish(item_id, worker, self.STATUS_DONE, "", path)
+
+    def fail(self, item_id: int, worker: str, error: str) -> bool:
+        """Report a failed video, it is queued again until it was claimed max_attempts times
+
+        Returns:
+            bool: False if the lease was lost meanwhile, the report is dropped
+        """
+        with self._transaction():
+            row = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (item_id,)).fetchone()
+            status = self.STATUS_FAILED if row is None or row[0] >= self.max_attempts else self.STATUS_QUEUED
+            return self._finish(item_id, worker, status, error, "")
+
+    def release(self, item_id: int, worker: str) -> bool:
+        """Give a claimed video back without counting the attempt, e.g. when the worker is stopped
+
+        Returns:
+            bool: False if the lease was lost meanwhile
+        """
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = ?, worker = '', lease_until = 0, attempts = attempts - 1, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (self.STATUS_QUEUED, time.time(), item_id, worker, self.STATUS_LEASED),
+            )
+            return cursor.rowcount == 1
+
+    def _finish(self, item_id: int, worker: str, status: str, error: str, path: str) -> bool:
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, path = ?, lease_until = 0, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (status, error, path, time.time(), item_id, worker, self.STATUS_LEASED),
+            )
+            return cursor.rowcount == 1
+
+    def retry_failed(self) -> int:
+        """Queue the failed videos again with fresh attempts
+
+        Returns:
+            int: Number of videos queued
+        """
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = ?, attempts = 0, updated_at = ? WHERE status = ?",
+                (self.STATUS_QUEUED, time.time(), self.STATUS_FAILED),
+            )
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Get the number of videos of every status"""
+        rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(rows.fetchall())
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self.conn)
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, taking the write lock upfront so that a claim never reads a stale row"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.depth = 0
+
+    def __enter__(self):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.depth = 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.depth:
+            self.conn.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+class QueueWorker:
+    """QueueWorker downloads the videos of a work queue one after another until none is left.
+
+    Every video goes through `BlobDownloader.run`, while a thread renews its
+    lease. A worker claims one video at a time, so videos only overlap
+    across workers: run several worker processes per host, as `run_workers`
+    does, to keep the network busy while a video is merged. Workers in
+    processes of one host or of several hosts sharing the queue file and the
+    save path split a batch between them. The tmp path of the downloader
+    must be on a local disk of each host, its state store uses WAL, which is
+    unsafe on network filesystems, see `worker_blob_config`.
+    """
+
+    def __init__(
+        self,
+        blob_downloader,
+        queue_path: str,
+        worker_id: str = "",
+        lease: float = 300.0,
+        heartbeat: float = 30.0,
+        max_attempts: int = 3,
+        poll_interval: float = 10.0,
+    ):
+        """Initialize queue worker
+
+        Args:
+            blob_downloader (BlobDownloader): Downloader running every video
+            queue_path (str): Path of the work queue file
+            worker_id (str, optional): Id of the worker in the queue. Defaults to "<hostname>-<pid>".
+            lease (float, optional): Seconds a claim lasts without a heartbeat. Defaults to 300.
+            heartbeat (float, optional): Seconds between two lease renewals. Defaults to 30.
+            max_attempts (int, optional): Claims of a video before it is failed for good. Defaults to 3.
+            poll_interval (float, optional): Seconds between two claims while other workers hold every video.
+                Defaults to 10.
+        """
+        self.blob = blob_downloader
+        self.queue_path = queue_path
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.queue = WorkQueue(queue_path, lease, max_attempts)
+
+    def run(self, max_videos: int = 0) -> Dict[str, int]:
+        """Claim and download videos until the queue is drained
+
+        Args:
+            max_videos (int, optional): Stop after this many videos, 0 for no limit. Defaults to 0.
+
+        Returns:
+            Dict[str, int]: Downloads of this worker that succeeded ("done") and failed ("failed"), a video
+                queued again after a failure counts every attempt
+        """
+        outcomes = {WorkQueue.STATUS_DONE: 0, WorkQueue.STATUS_FAILED: 0}
+        try:
+            while not max_videos or sum(outcomes.values()) < max_videos:
+                item = self.queue.claim(self.worker_id)
+                if item is None:
+                    if not self.queue.counts().get(WorkQueue.STATUS_LEASED):
+                        break
+                    # leases of other workers may still expire
+                    time.sleep(self.poll_interval)
+                    continue
+                outcomes[self.run_item(item)] += 1
+        finally:
+            self.queue.close()
+        done, failed = outcomes[WorkQueue.STATUS_DONE], outcomes[WorkQueue.STATUS_FAILED]
+        logger.info(f"worker {self.worker_id}: {done} done, {failed} failed")
+        return outcomes
+
+    def run_item(self, item: QueueItem) -> str:
+        """Download a claimed video while renewing its lease, and report it
+
+        Returns:
+            str: "done" or "failed"
+        """
+        stop = threading.Event()
+        renewing = threading.Thread(target=self._renew, args=(item.id, stop), name="queue-heartbeat", daemon=True)
+        renewing.start()
+        try:
+            job = self.blob.parse_batch_item((item.url, item.save_name))
+            if job is None:
+                raise ValueError(f"invalid queue item: {item.url!r}")
+            path = self.blob.run(job.blob_url, job.save_name)
+        except BaseException as e:
+            stop.set()
+            renewing.join()
+            if not isinstance(e, Exception):
+                # stopped by hand, another worker takes the video over
+                self.queue.release(item.id, self.worker_id)
+                raise
+            logger.error(f"❌ Failed to download {item.url}: {e}")
+            self.queue.fail(item.id, self.worker_id, str(e))
+            return WorkQueue.STATUS_FAILED
+        stop.set()
+        renewing.join()
+        if not self.queue.complete(item.id, self.worker_id, path):
+            logger.warning(f"lease of {item.url} was lost, another worker may download it again")
+        return WorkQueue.STATUS_DONE
+
+    def _renew(self, item_id: int, stop: threading.Event):
+        # SQLite connections stay in the thread that opened them
+        queue = WorkQueue(self.queue_path, self.lease, self.max_attempts)
+        try:
+            while not stop.wait(self.heartbeat):
+                if not queue.heartbeat(item_id, self.worker_id):
+                    logger.warning(f"lease of queue item {item_id} was lost")
+                    return
+        except sqlite3.Error as e:
+            # the lease is renewed at the next beat, or expires
+            logger.warning(f"failed to renew the lease of queue item {item_id}: {e}")
+        finally:
+            queue.close()
+
+
+def local_tmp_path() -> str:
+    """Tmp path of the workers of this host, on a local disk
+
+    Returns:
+        str: Directory under the system temporary directory, named after the host
+    """
+    return os.path.join(tempfile.gettempdir(), f"blob-videos-{socket.gethostname()}")
+
+
+def worker_blob_config(blob_config: Optional[dict] = None) -> dict:
+    """Arguments of the BlobDownloader of a worker process
+
+    Without a tmp path, the default one under the code directory would put
+    the SQLite state store in WAL mode on the shared filesystem the workers
+    of several hosts may run from, a local per-host directory is used instead.
+
+    Args:
+        blob_config (Optional[dict], optional): Arguments given by the caller. Defaults to config.BlobDownloaderConfig.
+
+    Returns:
+        dict: Arguments with a tmp path
+    """
+    blob_config = dict(BlobDownloaderConfig if blob_config is None else blob_config)
+    if not blob_config.get("tmp_path"):
+        blob_config["tmp_path"] = local_tmp_path()
+    return blob_config
+
+
+def _work(queue_path: str, blob_config: dict, queue_config: dict):
+    """Entry point of a worker process"""
+    from core import BlobDownloader
+
+    # spawned processes do not inherit the logging setup of the parent
+    setup_logging()
+    QueueWorker(BlobDownloader(**blob_config), queue_path, **queue_config).run()
+
+
+def run_workers(queue_path: str, processes: int = 0, blob_config: Optional[dict] = None) -> Dict[str, int]:
+    """Drain a work queue with several worker processes on this host
+
+    Workers on other hosts may drain the same queue file at the same time.
+
+    Args:
+        queue_path (str): Path of the work queue file
+        processes (int, optional): Worker processes, 0 for the number of CPUs. Defaults to 0.
+        blob_config (Optional[dict], optional): Arguments of every worker's BlobDownloader, the tmp path
+            defaults to a local directory of the host. Defaults to config.BlobDownloaderConfig.
+
+    Returns:
+        Dict[str, int]: Number of videos of every status in the queue once the workers exited
+    """
+    blob_config = worker_blob_config(blob_config)
+    queue_config = dict(QueueConfig)
+    # fork would copy the event loop and the open SQLite connections of the parent
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_work, args=(queue_path, blob_config, queue_config), name=f"queue-worker-{index}")
+        for index in range(processes or os.cpu_count() or 1)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue = WorkQueue(queue_path)
+    try:
+        return queue.counts()
+    finally:
+        queue.close()